@@ -0,0 +1,43 @@
+"""
+bcrypt throughput through the hashing pool, reported as hashes/sec per core.
+
+    BCRYPT_ROUNDS=12 python bench_hashing.py --workers 1 2 4 --hashes 64
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import hashing
+import utils
+
+
+def run(workers, hashes):
+    pool = hashing.HashingPool(workers=workers, queue_depth=hashes)
+    # Warm the worker processes so start-up is not measured
+    with ThreadPoolExecutor(max(1, workers)) as threads:
+        list(threads.map(lambda _: pool.run(utils.hash_password, "warm-up"), range(max(1, workers))))
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max(1, workers) * 2) as threads:
+        list(threads.map(lambda i: pool.run(utils.hash_password, f"password-{i}"), range(hashes)))
+    elapsed = time.monotonic() - started
+    pool.shutdown()
+    return hashes / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", nargs="+", type=int, default=[0, 1, os.cpu_count() or 1],
+                        help="pool sizes to test; 0 hashes inline on the calling threads")
+    parser.add_argument("--hashes", type=int, default=32)
+    args = parser.parse_args()
+
+    print(f"bcrypt rounds: {utils.BCRYPT_ROUNDS}")
+    print(f"{'workers':>8}{'hashes/s':>12}{'per core':>12}")
+    for workers in args.workers:
+        rate = run(workers, args.hashes)
+        print(f"{workers:>8}{rate:>12.1f}{rate / max(1, workers):>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Throughput of the auth routes with and without the database connection pool.
+
+Drives the Flask app in-process from several threads against the PostgreSQL
+configured through the usual POSTGRES_* variables. /readiness is pure database
+round trips; /login also includes one bcrypt verification per call.
+
+    python bench_login.py --seconds 10 --threads 8
+"""
+import argparse
+import threading
+import time
+import db
+from main import app
+
+BENCH_USER = {"username": "bench-user", "password": "bench-password", "email": "bench-user@example.com"}
+
+
+def run(path, payload, seconds, threads):
+    counts = [0] * threads
+    errors = [0] * threads
+    deadline = time.monotonic() + seconds
+
+    def worker(i):
+        client = app.test_client()
+        while time.monotonic() < deadline:
+            if payload is None:
+                response = client.get(path)
+            else:
+                response = client.post(path, json=payload)
+            if response.status_code == 200:
+                counts[i] += 1
+            else:
+                errors[i] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return sum(counts) / seconds, sum(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    db.create_db_and_tables()
+    app.test_client().post("/create", json=BENCH_USER)
+
+    print(f"{'route':<12}{'pool':<8}{'req/s':>10}{'errors':>8}")
+    for path, payload in (("/readiness", None), ("/login", BENCH_USER)):
+        for pooled in (False, True):
+            db.DB_POOL_ENABLED = pooled
+            rate, errors = run(path, payload, args.seconds, args.threads)
+            print(f"{path:<12}{'on' if pooled else 'off':<8}{rate:>10.1f}{errors:>8}")
+
+
+if __name__ == "__main__":
+    main()
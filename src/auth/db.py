@@ -1,9 +1,13 @@
+import math
 import os
 import time
+import queue
+import threading
 import psycopg2
-from psycopg2 import sql, OperationalError
+from psycopg2 import sql, OperationalError, InterfaceError
+from psycopg2.extras import execute_values
 from logger import get_logger
-from contextlib import closing
+from contextlib import closing, contextmanager
 
 # Get logger instance
 logger = get_logger(__name__)
@@ -11,19 +15,35 @@ logger = get_logger(__name__)
 MAX_RETRIES = 5  # Maximum number of retries
 INITIAL_DELAY = 2  # Initial delay in seconds
 
+# Connection pool settings
+DB_POOL_ENABLED = os.environ.get("DB_POOL_ENABLED", "true").lower() == "true"
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 5.0))  # seconds to wait for a free connection
+DB_POOL_CHECK_IDLE = float(os.environ.get("DB_POOL_CHECK_IDLE", 30.0))  # ping connections idle longer than this
+DB_POOL_MAX_AGE = float(os.environ.get("DB_POOL_MAX_AGE", 30 * 60))  # seconds before a connection is recycled
+DB_CONNECT_TIMEOUT = int(os.environ.get("DB_CONNECT_TIMEOUT", 5))  # seconds for one pooled connection attempt
+
+def open_connection(connect_timeout=None):
+    """
+    Opens one connection in a single attempt; libpq gives up after `connect_timeout` seconds (at least 2).
+    """
+    return psycopg2.connect(
+        host=os.environ.get("POSTGRES_HOST", "localhost"),
+        user=os.environ.get("POSTGRES_USER", "postgres"),
+        password=os.environ.get("POSTGRES_PASSWORD", "password"),
+        dbname=os.environ.get("POSTGRES_DB", "auth_db"),
+        port=int(os.environ.get("POSTGRES_PORT", 5432)),
+        connect_timeout=connect_timeout,
+    )
+
 def get_db_connection():
     retries = 0
     delay = INITIAL_DELAY
 
     while retries < MAX_RETRIES:
         try:
-            connection = psycopg2.connect(
-                host=os.environ.get("POSTGRES_HOST", "localhost"),
-                user=os.environ.get("POSTGRES_USER", "postgres"),
-                password=os.environ.get("POSTGRES_PASSWORD", "password"),
-                dbname=os.environ.get("POSTGRES_DB", "auth_db"),
-                port=int(os.environ.get("POSTGRES_PORT", 5432))
-            )
+            connection = open_connection()
             logger.info("Database connection established.")
             return connection
         except OperationalError as e:
@@ -37,25 +57,216 @@ def get_db_connection():
                 logger.exception("Max retries reached. Could not connect to the database.")
                 raise
 
-def check_database_connection():
-    try:
-        connection = get_db_connection()
-        if connection is None:
-            logger.error("Failed to obtain database connection.")
+class PoolTimeout(Exception):
+    """
+    Raised when no pooled connection becomes available within DB_POOL_TIMEOUT.
+    """
+
+
+class ConnectionPool:
+    """
+    Thread-safe PostgreSQL connection pool.
+
+    Holds at most `maxconn` connections and keeps up to `minconn` of them warm.
+    Connections idle for longer than DB_POOL_CHECK_IDLE are pinged on checkout,
+    connections older than DB_POOL_MAX_AGE are recycled, and any connection that
+    failed with a connection-level error is closed instead of being returned.
+
+    New connections are opened in a single attempt bounded by DB_CONNECT_TIMEOUT
+    and by what is left of the checkout's `timeout`, so a database outage fails
+    requests quickly instead of holding slots through retries.
+    """
+
+    def __init__(self, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT, connect=None):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self._connect = connect or open_connection
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._size = 0
+        self._closed = False
+
+    def _open(self, deadline=None):
+        connect_timeout = DB_CONNECT_TIMEOUT
+        if deadline is not None:
+            connect_timeout = min(connect_timeout, max(1, math.ceil(deadline - time.monotonic())))
+        connection = self._connect(connect_timeout=connect_timeout)
+        with self._lock:
+            self._size += 1
+        return connection, time.monotonic(), time.monotonic()
+
+    def _discard(self, connection):
+        with self._lock:
+            self._size -= 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _healthy(self, connection, created_at, last_used):
+        if connection.closed or time.monotonic() - created_at > DB_POOL_MAX_AGE:
             return False
-        
-        with closing(connection.cursor()) as cursor:
-            cursor.execute("SELECT 1")
-            cursor.fetchone()
-        
+        if time.monotonic() - last_used < DB_POOL_CHECK_IDLE:
+            return True
+        try:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+            connection.rollback()
+            return True
+        except (OperationalError, InterfaceError):
+            return False
+
+    def getconn(self):
+        if self._closed:
+            raise InterfaceError("connection pool is closed")
+        deadline = time.monotonic() + self.timeout
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"No database connection available within {self.timeout}s")
+        try:
+            while True:
+                try:
+                    connection, created_at, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._open(deadline)
+                if self._healthy(connection, created_at, last_used):
+                    return connection, created_at, last_used
+                logger.info("Recycling stale database connection.")
+                self._discard(connection)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, entry, discard=False):
+        connection, created_at, _ = entry
+        try:
+            if discard or self._closed or connection.closed:
+                self._discard(connection)
+            else:
+                self._idle.put((connection, created_at, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection; uncommitted work is rolled back when the block exits.
+        """
+        entry = self.getconn()
+        connection = entry[0]
+        broken = False
+        try:
+            yield connection
+        except (OperationalError, InterfaceError):
+            broken = True
+            raise
+        finally:
+            if not broken and not connection.closed:
+                try:
+                    connection.rollback()
+                except (OperationalError, InterfaceError):
+                    broken = True
+            self.putconn(entry, discard=broken)
+
+    def warm(self):
+        for _ in range(max(0, self.minconn - self._idle.qsize())):
+            self._slots.acquire()
+            try:
+                entry = self._open()
+            except BaseException:
+                self._slots.release()
+                raise
+            self.putconn(entry)
+
+    def closeall(self):
+        self._closed = True
+        while True:
+            try:
+                connection, _, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(connection)
+
+    @property
+    def size(self):
+        return self._size
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the process-wide pool, creating it on first use.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+            _pool.warm()
+            logger.info(f"Database connection pool ready (min={_pool.minconn}, max={_pool.maxconn}).")
+        return _pool
+
+
+@contextmanager
+def db_connection():
+    """
+    Context manager the routes use to borrow a connection.
+
+    Falls back to a dedicated connection per call when DB_POOL_ENABLED is false.
+    """
+    if DB_POOL_ENABLED:
+        with get_pool().connection() as connection:
+            yield connection
+        return
+
+    connection = get_db_connection()
+    try:
+        yield connection
+    finally:
         connection.close()
+
+
+def check_database_connection():
+    try:
+        with db_connection() as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+
         logger.info("Database connection verified successfully.")
         return True
-    except (OperationalError, InterfaceError) as e:
+    except (OperationalError, InterfaceError, PoolTimeout) as e:
         logger.error(f"Database connection failed: {e}", exc_info=True)
         return False
     
 
+# Names PostgreSQL gives the UNIQUE constraints declared in create_db_and_tables
+USERNAME_CONSTRAINT = "users_username_key"
+EMAIL_CONSTRAINT = "users_email_key"
+
+
+def bulk_create_users(connection, users, page_size=1000):
+    """
+    Inserts many (username, hashed_password, email) rows in batched multi-row INSERTs.
+
+    Rows whose username or email already exists are skipped. Returns the number
+    of rows inserted; the caller commits.
+    """
+    with closing(connection.cursor()) as cursor:
+        rows = execute_values(
+            cursor,
+            "INSERT INTO users (username, password, email) VALUES %s ON CONFLICT DO NOTHING RETURNING id",
+            users,
+            page_size=page_size,
+            fetch=True,
+        )
+    return len(rows)
+
+
 def create_db_and_tables():
     """
     Create the database and tables if they don't exist.
@@ -0,0 +1,31 @@
+import multiprocessing
+import os
+
+# Served with: gunicorn --config gunicorn.conf.py main:app
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+
+# bcrypt runs in the hashing pool, so request threads mostly wait on it and on PostgreSQL
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+threads = int(os.getenv("GUNICORN_THREADS", 4))  # keep DB_POOL_MAX at or above this
+# Every worker starts its own hashing pool; share the CPUs between them instead of starting cpu_count each
+os.environ.setdefault("HASH_WORKERS", str(max(1, multiprocessing.cpu_count() // workers)))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 30))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+
+# Import the app once in the master; database and hashing pools are created per worker in post_fork
+preload_app = True
+
+accesslog = "-"
+errorlog = "-"
+
+
+def when_ready(server):
+    # Runs once in the master before any worker is forked
+    from db import create_db_and_tables
+    create_db_and_tables()
+
+
+def post_fork(server, worker):
+    from main import init_worker
+    init_worker()
@@ -0,0 +1,88 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+import utils
+from logger import get_logger
+
+# Get logger instance
+logger = get_logger(__name__)
+
+# bcrypt runs in worker processes so it neither holds the GIL nor blocks request threads
+# Per process; gunicorn.conf.py defaults it to the CPUs divided among the workers. 0 hashes inline
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", os.cpu_count() or 1))
+HASH_QUEUE_DEPTH = int(os.environ.get("HASH_QUEUE_DEPTH", HASH_WORKERS * 4))  # queued + running jobs
+HASH_TIMEOUT = float(os.environ.get("HASH_TIMEOUT", 10.0))  # seconds
+
+
+class HashingOverloaded(Exception):
+    """
+    Raised when HASH_QUEUE_DEPTH jobs are already pending or a job times out; callers answer 503.
+    """
+
+
+class HashingPool:
+    """
+    Bounded process pool for bcrypt work.
+
+    Submissions beyond `queue_depth` are rejected immediately instead of
+    queueing, so a login burst sheds load rather than stalling every route.
+    A job holds its slot until it finishes, also after its caller gave up
+    waiting, so timed-out jobs still count against the depth.
+    """
+
+    def __init__(self, workers=HASH_WORKERS, queue_depth=HASH_QUEUE_DEPTH, timeout=HASH_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max(1, queue_depth))
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Spawned rather than forked: gunicorn's gthread workers already run request threads
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+                logger.info(f"Password hashing pool started with {self.workers} workers")
+            return self._executor
+
+    def start(self):
+        if self.workers > 0:
+            self._get_executor()
+
+    def run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            raise HashingOverloaded("Password hashing queue is full")
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # Only a job that has not started yet can be cancelled; a running one keeps its slot
+            future.cancel()
+            raise HashingOverloaded(f"Password hashing took longer than {self.timeout}s")
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+pool = HashingPool()
+
+
+def hash_password(password):
+    return pool.run(utils.hash_password, password)
+
+
+def verify_and_update_password(password, hashed_password):
+    return pool.run(utils.verify_and_update_password, password, hashed_password)
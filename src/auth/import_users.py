@@ -0,0 +1,61 @@
+"""
+Bulk-imports users from a CSV file with a `username,password,email` header.
+
+Passwords are bcrypt-hashed across all cores unless --prehashed is given
+(e.g. when migrating hashes from another system). Existing usernames or
+emails are skipped.
+
+    python import_users.py users.csv --batch-size 1000
+"""
+import argparse
+import csv
+import itertools
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import utils
+from db import create_db_and_tables, db_connection, bulk_create_users
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def batches(rows, size):
+    iterator = iter(rows)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("csv_file")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--prehashed", action="store_true", help="the password column already holds bcrypt hashes")
+    args = parser.parse_args()
+
+    create_db_and_tables()
+    total_read = total_inserted = 0
+    with open(args.csv_file, newline="") as handle, ProcessPoolExecutor() as executor:
+        rows = csv.DictReader(handle)
+        for batch in batches(rows, args.batch_size):
+            passwords = [row["password"] for row in batch]
+            if not args.prehashed:
+                passwords = list(executor.map(utils.hash_password, passwords, chunksize=16))
+            users = [(row["username"], password, row["email"]) for row, password in zip(batch, passwords)]
+
+            with db_connection() as connection:
+                inserted = bulk_create_users(connection, users, page_size=args.batch_size)
+                connection.commit()
+
+            total_read += len(batch)
+            total_inserted += inserted
+            logger.info(f"Imported {total_inserted}/{total_read} users")
+
+    print(f"Read {total_read} rows, inserted {total_inserted}, skipped {total_read - total_inserted} existing users")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
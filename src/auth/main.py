@@ -1,8 +1,10 @@
 import os
 import jwt
 from flask import Flask, request, jsonify
-import utils
-from db import create_db_and_tables, check_database_connection, get_db_connection
+import hashing
+from hashing import HashingOverloaded
+from psycopg2 import errors
+from db import create_db_and_tables, check_database_connection, db_connection, get_pool, DB_POOL_ENABLED, EMAIL_CONSTRAINT
 from utils import createJWT
 from logger import get_logger
 
@@ -14,6 +16,23 @@ logger = get_logger(__name__)
 
 JWT_SECRET = os.environ.get("JWT_SECRET", "mysecret")
 
+
+def init_worker():
+    """
+    Starts this process's hashing pool and warms its database pool.
+
+    Under gunicorn this runs in every worker after fork (see gunicorn.conf.py),
+    so no connection is ever shared between processes.
+    """
+    hashing.pool.start()
+    if not DB_POOL_ENABLED:
+        return
+    try:
+        get_pool()
+    except Exception as e:
+        # The pool is retried on the first request; /readiness reports the outage meanwhile
+        logger.error(f"Could not warm the database pool: {e}")
+
 # Check readiness
 @app.route('/readiness', methods=["GET"])
 def readiness():
@@ -41,41 +60,57 @@ def create_user():
                         "required_fields": {"username": "", "password": "", "email": ""}
                         }), 401
 
-    hashed_password = utils.hash_password(auth["password"])
-    logger.info(f"Hashed password: {hashed_password}")
-    connection = get_db_connection()
-    cursor = connection.cursor()
-
     try:
-        # check for username is exists or not
-        cursor.execute("SELECT username FROM users WHERE username = %s", (auth["username"],))
-        existing_user = cursor.fetchone()
+        hashed_password = hashing.hash_password(auth["password"])
+    except HashingOverloaded as e:
+        logger.warning(f"Shedding create request: {e}")
+        return overloaded_response()
+    logger.info(f"Hashed password: {hashed_password}")
 
-        if existing_user:
+    with db_connection() as connection:
+        cursor = connection.cursor()
+
+        try:
+            # One round trip; the unique constraints reject duplicate usernames and emails atomically
+            logger.info("Creating user...")
+            cursor.execute("INSERT INTO users (username, password, email) VALUES (%s, %s, %s)", (auth["username"], hashed_password, auth["email"]))
+            connection.commit()
+            logger.info(f"User {auth['username']} created successfully")
+            return jsonify({"msg": "User created successfully"}), 201
+
+        except errors.UniqueViolation as e:
+            connection.rollback()
+            if e.diag.constraint_name == EMAIL_CONSTRAINT:
+                logger.warning(f"Email {auth['email']} already exists")
+                return jsonify({"msg": "Email already exists"}), 406
             logger.warning(f"User with username {auth['username']} already exists")
             return jsonify({"msg": "User already exists"}), 406
-        
-        # now check email is exist or not
-        cursor.execute("SELECT email FROM users WHERE email = %s", (auth["email"],))
-        existing_email = cursor.fetchone()
-        if existing_email:
-            logger.warning(f"Email {auth['email']} already exists")
-            return jsonify({"msg": "Email already exists"}), 406
-
-        logger.info("Creating user...")
-        cursor.execute("INSERT INTO users (username, password, email) VALUES (%s, %s, %s)", (auth["username"], hashed_password, auth["email"]))
-        connection.commit()
-        logger.info(f"User {auth['username']} created successfully")
-        return jsonify({"msg": "User created successfully"}), 201
-    
+
+        except Exception as e:
+            connection.rollback()
+            logger.exception(f"Error creating user: {e}")
+            return jsonify({"msg": "Internal Server Error"}), 500
+
+        finally:
+            cursor.close()
+
+
+def overloaded_response():
+    return jsonify({"msg": "Server busy, please retry"}), 503, {"Retry-After": "1"}
+
+
+def rehash_password(username, new_hash):
+    """
+    Stores a hash upgraded to the current bcrypt cost; failures only cost another rehash next login.
+    """
+    try:
+        with db_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("UPDATE users SET password = %s WHERE username = %s", (new_hash, username))
+            connection.commit()
+        logger.info(f"Upgraded password hash for user {username}")
     except Exception as e:
-        connection.rollback()
-        logger.exception(f"Error creating user: {e}")
-        return jsonify({"msg": "Internal Server Error"}), 500
-    
-    finally:
-        cursor.close()
-        connection.close()
+        logger.exception(f"Failed to upgrade password hash for user {username}: {e}")
 
 
 # Login
@@ -86,21 +121,26 @@ def login():
         logger.error("Missing credentials")
         return jsonify({"msg": "missing credentials"}), 401
 
-    connection = get_db_connection()
-    cursor = connection.cursor()
-    cursor.execute("SELECT username, password, email FROM users WHERE username = %s", (auth["username"],))
-    user = cursor.fetchone()
-
-    cursor.close()
-    connection.close()
+    with db_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT username, password, email FROM users WHERE username = %s", (auth["username"],))
+            user = cursor.fetchone()
 
     if user:
         logger.info(f"User {auth['username']} found")
         username, password, email = user
         
-        if auth["username"] != username or not utils.verify_password(auth["password"], password):
+        try:
+            valid, new_hash = hashing.verify_and_update_password(auth["password"], password)
+        except HashingOverloaded as e:
+            logger.warning(f"Shedding login request: {e}")
+            return overloaded_response()
+
+        if auth["username"] != username or not valid:
             logger.error(f"Invalid credentials for user {auth['username']}")
             return jsonify({"msg": "bad username or password"}), 401
+        if new_hash:
+            rehash_password(username, new_hash)
         logger.info(f"User {auth['username']} logged in successfully")
         data = {"username": username, "email": email}
         return jsonify({"token": createJWT(data, JWT_SECRET, True)})
@@ -135,5 +175,7 @@ def validate():
 
 
 if __name__ == "__main__":
+    # Development server; production serves through gunicorn (see gunicorn.conf.py)
     create_db_and_tables()
+    init_worker()
     app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The auth service's modules import each other from the service directory, as they do in the image
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
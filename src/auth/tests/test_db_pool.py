@@ -0,0 +1,69 @@
+import time
+import pytest
+from psycopg2 import OperationalError
+import db
+
+
+class FakeConnection:
+    closed = False
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_connect_timeout_is_bounded_by_pool_timeout(monkeypatch):
+    monkeypatch.setattr(db, "DB_CONNECT_TIMEOUT", 30)
+    timeouts = []
+
+    def connect(connect_timeout):
+        timeouts.append(connect_timeout)
+        return FakeConnection()
+
+    pool = db.ConnectionPool(maxconn=1, timeout=3, connect=connect)
+    with pool.connection():
+        pass
+
+    assert timeouts == [3]
+
+
+def test_failed_connect_is_not_retried_and_frees_the_slot():
+    attempts = []
+
+    def connect(connect_timeout):
+        attempts.append(connect_timeout)
+        raise OperationalError("connection refused")
+
+    pool = db.ConnectionPool(maxconn=1, timeout=1, connect=connect)
+    started = time.monotonic()
+    for _ in range(2):
+        with pytest.raises(OperationalError):
+            pool.getconn()
+
+    assert len(attempts) == 2
+    assert time.monotonic() - started < 1
+    assert pool.size == 0
+
+
+def test_checkout_times_out_when_pool_is_exhausted():
+    pool = db.ConnectionPool(maxconn=1, timeout=0.05, connect=lambda connect_timeout: FakeConnection())
+    entry = pool.getconn()
+
+    with pytest.raises(db.PoolTimeout):
+        pool.getconn()
+    pool.putconn(entry)
+    assert pool.getconn()[0] is entry[0]
+
+
+def test_warm_frees_the_slot_when_connecting_fails():
+    def connect(connect_timeout):
+        raise OperationalError("connection refused")
+
+    pool = db.ConnectionPool(minconn=1, maxconn=1, timeout=0.05, connect=connect)
+    with pytest.raises(OperationalError):
+        pool.warm()
+
+    pool._connect = lambda connect_timeout: FakeConnection()
+    assert pool.getconn()[0].closed is False
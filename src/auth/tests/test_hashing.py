@@ -0,0 +1,42 @@
+import time
+import pytest
+import hashing
+
+
+@pytest.fixture
+def pool():
+    pool = hashing.HashingPool(workers=1, queue_depth=1, timeout=0.05)
+    yield pool
+    pool.shutdown()
+
+
+def wait_for_free_slot(pool, deadline=10):
+    started = time.monotonic()
+    while time.monotonic() - started < deadline:
+        if pool._slots.acquire(blocking=False):
+            pool._slots.release()
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_runs_jobs_in_the_pool(pool):
+    pool.timeout = 30
+    assert pool.run(abs, -3) == 3
+
+
+def test_inline_without_workers():
+    assert hashing.HashingPool(workers=0).run(abs, -3) == 3
+
+
+def test_timed_out_job_keeps_its_slot_until_it_finishes(pool):
+    with pytest.raises(hashing.HashingOverloaded, match="longer than"):
+        pool.run(time.sleep, 1)
+
+    # The sleeping job still occupies the only slot
+    with pytest.raises(hashing.HashingOverloaded, match="queue is full"):
+        pool.run(abs, -1)
+
+    assert wait_for_free_slot(pool)
+    pool.timeout = 30
+    assert pool.run(abs, -1) == 1
@@ -1,9 +1,13 @@
+import os
 from passlib.context import CryptContext
 import jwt
 import datetime
 
+# bcrypt cost factor; hashes made with a different cost are upgraded on the next login
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+
 # Initialize the password hashing context
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
 def hash_password(password: str) -> str:
     """
@@ -17,6 +21,14 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     """
     return pwd_context.verify(plain_password, hashed_password)
 
+def verify_and_update_password(plain_password: str, hashed_password: str):
+    """
+    Verify a password and, if its hash uses outdated settings, return a replacement hash.
+
+    Returns (valid, new_hash) where new_hash is None when no rehash is needed.
+    """
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
 def createJWT(user, secret, authz):
     return jwt.encode(
         {
@@ -27,4 +39,4 @@ def createJWT(user, secret, authz):
         },
         secret,
         algorithm="HS256"
-    )
\ No newline at end of file
+    )
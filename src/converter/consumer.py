@@ -2,9 +2,19 @@ import pika
 import sys
 import os
 import time
+import functools
+import json
 from pymongo import MongoClient, errors
 import gridfs
-from convert import to_mp3
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from convert import dedup, jobs as job_store, ledger as ledger_store, metadata as mp3_metadata, segments, to_mp3
+from worker import ConversionPool
+from publisher import Publisher, OUTBOX_COLLECTION
+import lifecycle
+import metrics
+import retry
+import scheduler
 from dotenv import load_dotenv
 from logger import get_logger
 
@@ -20,6 +30,15 @@ RABBITMQ_PASSWORD = os.getenv("RABBITMQ_PASSWORD", "securepassword")
 RABBITMQ_PORT = os.getenv("RABBITMQ_PORT", 5672)
 RABBITMQ_RETRY_COUNT = 5
 RABBITMQ_RETRY_DELAY = 5  # seconds
+RABBITMQ_HEARTBEAT = int(os.getenv("RABBITMQ_HEARTBEAT", 60))  # seconds
+
+# Number of parallel conversions per pod; 0 converts inline on the consumer thread
+WORKERS = int(os.getenv("WORKERS", os.cpu_count() or 1))
+
+# Unacked deliveries per queue consumer; the scheduler picks fairly among what it holds
+FAIR_PREFETCH = int(os.getenv("FAIR_PREFETCH", 2 * max(1, WORKERS)))
+
+METRICS_LOG_INTERVAL = int(os.getenv("METRICS_LOG_INTERVAL", 60))  # seconds; 0 disables metrics logging
 
 
 def initialize_mongo_client(uri, db_name):
@@ -46,6 +65,13 @@ def initialize_mongo_client(uri, db_name):
         raise
 
 
+def rabbitmq_parameters():
+    credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASSWORD)
+    return pika.ConnectionParameters(
+        host=RABBITMQ_HOST, port=RABBITMQ_PORT, credentials=credentials, heartbeat=RABBITMQ_HEARTBEAT
+    )
+
+
 def connect_rabbitmq():
     """
     Connects to RabbitMQ with retries on failure.
@@ -53,10 +79,7 @@ def connect_rabbitmq():
     for attempt in range(1, RABBITMQ_RETRY_COUNT + 1):
         try:
             logger.info(f"Attempting to connect to RabbitMQ (Attempt {attempt}/{RABBITMQ_RETRY_COUNT})")
-            credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASSWORD)
-            connection = pika.BlockingConnection(pika.ConnectionParameters(
-                host=RABBITMQ_HOST, port=RABBITMQ_PORT, credentials=credentials
-            ))
+            connection = pika.BlockingConnection(rabbitmq_parameters())
             channel = connection.channel()
             channel.queue_declare(queue='video', durable=True)
             channel.queue_declare(queue='mp3', durable=True)
@@ -80,25 +103,233 @@ def main():
     db_videos, fs_videos = initialize_mongo_client(mongo_uri, upload_folder)
     db_mp3s, fs_mp3s = initialize_mongo_client(mongo_uri, download_folder)
 
+    content_index = db_videos[dedup.CONTENT_INDEX_COLLECTION]
+    jobs = db_videos[job_store.JOBS_COLLECTION]
+    mp3_files = db_mp3s[mp3_metadata.MP3_FILES_COLLECTION]
+    video_files = db_videos[lifecycle.FILES_COLLECTION]
+    segment_plans = db_videos[segments.SEGMENT_PLANS_COLLECTION]
+    segments.ensure_indexes(segment_plans)
+    ledger = db_videos[ledger_store.LEDGER_COLLECTION]
+    ledger_store.ensure_indexes(ledger)
+
+    # Whole videos arrive on the priority lanes, segments of long ones on their own queue
+    segment_queue = segments.SEGMENT_QUEUE
+    queues = (*scheduler.LANES, segment_queue)
+
     # Initialize RabbitMQ connection
     connection, channel = connect_rabbitmq()    
+    for queue in queues:
+        channel.queue_declare(queue=queue, durable=True)
+        retry.declare(channel, queue)
+
+    # mp3 messages go out with publisher confirms on a separate connection
+    publisher = Publisher(rabbitmq_parameters(), outbox=db_videos[OUTBOX_COLLECTION]).start()
+    if METRICS_LOG_INTERVAL > 0:
+        connection.call_later(METRICS_LOG_INTERVAL, functools.partial(log_metrics, connection))
+
+    def inline_callback(queue):
+        def callback(ch, method, properties, body):
+            """
+            Callback function for processing RabbitMQ messages.
+            """
+            error = to_mp3.start(
+                body, fs_videos, fs_mp3s, publisher, content_index, jobs, mp3_files, video_files, segment_plans, ledger
+            )
+            if error:
+                fail(ch, queue, method.delivery_tag, properties, body, error, content_index, jobs)
+            else:
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+
+        return callback
+
+    pool = None
+    if WORKERS > 0:
+        pool = ConversionPool(WORKERS, (mongo_uri, upload_folder, download_folder))
+        # Segments continue conversions that already started, so they share the default lane's weight
+        fair = scheduler.FairScheduler(
+            weights={**scheduler.LANE_WEIGHTS, segment_queue: scheduler.LANE_WEIGHTS[scheduler.LANE_DEFAULT]}
+        )
+        metrics.register("conversion_scheduler", fair)
+        callback_for = pool_callbacks(
+            connection, pool, fair, fs_mp3s, publisher, content_index, jobs, mp3_files, video_files, ledger
+        )
+        # Hold a few more messages than there are workers, so the scheduler has users to choose between
+        channel.basic_qos(prefetch_count=max(1, FAIR_PREFETCH))
+    else:
+        callback_for = inline_callback
+        channel.basic_qos(prefetch_count=1)
+
+    # Every lane and the segment queue share the workers
+    for queue in queues:
+        channel.basic_consume(queue=queue, on_message_callback=callback_for(queue))
+
+    print(f"Waiting for messages on queues {', '.join(queues)} with {WORKERS or 'inline'} workers. To exit press CTRL+C")
+    try:
+        channel.start_consuming()
+    finally:
+        if pool:
+            pool.shutdown()
+        publisher.close()
+
+
+def log_metrics(connection):
+    logger.info(f"Metrics: {json.dumps(metrics.snapshot())}")
+    connection.call_later(METRICS_LOG_INTERVAL, functools.partial(log_metrics, connection))
+
+
+def fail(ch, queue, delivery_tag, properties, body, error, content_index=None, jobs=None):
+    """
+    Schedules a delayed retry; once the message is dead-lettered, its content and jobs are marked failed.
+
+    A message waiting on another worker's claim (`busy_for` seconds) is not
+    failing: it is deferred until the claim can be taken over and keeps its
+    attempts, and its job and content are left alone.
+    """
+    if error.get("busy_for") is not None:
+        retry.defer(ch, queue, delivery_tag, properties, body, error["busy_for"], error["message"])
+        return
+    dead = retry.handle_failure(ch, queue, delivery_tag, properties, body, error["message"])
+    try:
+        message = json.loads(body)
+    except ValueError:
+        return
+    if not isinstance(message, dict):
+        return
+    if not dead:
+        job_store.mark_retrying(jobs, message.get("job_id"), error["message"])
+        return
+
+    job_store.mark_failed(jobs, message.get("job_id"), error["message"])
+    sha256 = message.get("content_sha256")
+    if content_index is None or not sha256:
+        return
+    try:
+        # Duplicate uploads waiting on this conversion fail with it
+        for waiter in dedup.mark_failed(content_index, sha256):
+            job_store.mark_failed(jobs, waiter.get("job_id"), error["message"])
+    except Exception as e:
+        logger.error(f"Failed to mark dead-lettered content as failed: {e}", exc_info=True)
+
+
+def demote(publisher, delivery):
+    """
+    Republishes a delivery on the bulk lane, for a user who already has a full share waiting on this pod.
+
+    Returns the publisher's Future; the delivery is acked only once the broker
+    confirms the copy, so a lost or rejected copy never loses the message.
+    """
+    properties = delivery.properties
+    return publisher.publish(
+        scheduler.LANE_BULK,
+        delivery.body,
+        pika.BasicProperties(
+            delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE,
+            content_type=properties.content_type if properties else None,
+            headers=properties.headers if properties else None,
+        ),
+    )
+
+
+def pool_callbacks(
+    connection, pool, fair, fs_mp3s, publisher, content_index=None, jobs=None, mp3_files=None, video_files=None, ledger=None
+):
+    """
+    Builds the consumer callbacks that run conversions in the process pool.
+
+    Deliveries from every queue are buffered in `fair`, a FairScheduler, and
+    handed to the pool whenever a worker is free, so the order of conversions
+    is decided per user rather than by arrival. A user who already has a full
+    share waiting is moved to the bulk lane, leaving the prefetch window of the
+    other lanes to everyone else; if the broker does not confirm the move, the
+    delivery is scheduled here after all.
+
+    The callbacks return immediately, so the connection thread keeps servicing
+    heartbeats during long conversions. Finished conversions are published on
+    a small thread pool, where waiting for the broker's confirm does not hold up
+    the connection thread. The ack or retry is then handed back to the
+    connection thread with add_callback_threadsafe, since only it may use the
+    channel and the scheduler. Returns a function building the callback for a queue.
+    """
+    finishers = ThreadPoolExecutor(max_workers=max(1, pool.workers), thread_name_prefix="publish")
+    scheduler_wait = metrics.histogram("conversion_scheduler_wait_seconds")
+    demotable = (scheduler.LANE_PRIORITY, scheduler.LANE_DEFAULT)
+    running = []
+
+    def finish(ch, delivery, future):
+        try:
+            message, error = future.result()
+        except Exception as e:
+            logger.error(f"Conversion worker failed: {e}", exc_info=True)
+            if isinstance(e, BrokenProcessPool):
+                pool.reset()
+            message, error = None, {"status": False, "message": str(e)}
+
+        if not error and message is not None:
+            try:
+                to_mp3.publish(message, publisher, content_index, jobs, mp3_files, video_files, ledger)
+            except Exception as e:
+                logger.error(f"Failed to publish converted message: {e}", exc_info=True)
+                to_mp3.rollback(message, fs_mp3s, ledger)
+                error = {"message": str(e)}
+
+        def settle():
+            running.remove(delivery)
+            fair.done(delivery)
+            if error:
+                fail(
+                    ch, delivery.queue, delivery.method.delivery_tag, delivery.properties, delivery.body,
+                    error, content_index, jobs,
+                )
+            else:
+                ch.basic_ack(delivery_tag=delivery.method.delivery_tag)
+            dispatch(ch)
+
+        connection.add_callback_threadsafe(settle)
+
+    def dispatch(ch):
+        while len(running) < pool.workers:
+            delivery = fair.next()
+            if delivery is None:
+                return
+            scheduler_wait.observe(time.monotonic() - delivery.received)
+            running.append(delivery)
+            future = pool.submit(delivery.body)
+            future.add_done_callback(lambda f, d=delivery: finishers.submit(finish, ch, d, f))
+
+    def schedule(ch, delivery):
+        fair.add(delivery)
+        dispatch(ch)
+
+    def move_to_bulk(ch, delivery):
+        def moved(future):
+            def settle():
+                error = future.exception()
+                if error is None:
+                    ch.basic_ack(delivery_tag=delivery.method.delivery_tag)
+                    logger.info(f"Moved message of {delivery.user} from '{delivery.queue}' to '{scheduler.LANE_BULK}'")
+                else:
+                    logger.error(f"Failed to move message of {delivery.user} to '{scheduler.LANE_BULK}': {error}")
+                    schedule(ch, delivery)
+
+            connection.add_callback_threadsafe(settle)
+
+        try:
+            demote(publisher, delivery).add_done_callback(moved)
+        except Exception as e:
+            logger.error(f"Failed to move message of {delivery.user} to '{scheduler.LANE_BULK}': {e}")
+            schedule(ch, delivery)
+
+    def callback_for(queue):
+        def callback(ch, method, properties, body):
+            delivery = scheduler.delivery_for(queue, method, properties, body)
+            if queue in demotable and fair.max_inflight > 0 and fair.waiting[delivery.user] >= fair.max_inflight:
+                move_to_bulk(ch, delivery)
+                return
+            schedule(ch, delivery)
+
+        return callback
 
-    def callback(ch, method, properties, body):
-        """
-        Callback function for processing RabbitMQ messages.
-        """
-        error = to_mp3.start(body, fs_videos, fs_mp3s, ch)
-        if error:
-            ch.basic_nack(delivery_tag=method.delivery_tag)
-        else:
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-
-    # Queue names
-    video_queue = os.getenv("VIDEO_QUEUE", "video")
-    channel.basic_consume(queue=video_queue, on_message_callback=callback)
-
-    print(f"Waiting for messages on queue '{video_queue}'. To exit press CTRL+C")
-    channel.start_consuming()
+    return callback_for
 
 
 if __name__ == "__main__":
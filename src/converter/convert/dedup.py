@@ -0,0 +1,55 @@
+import datetime
+from pymongo import ReturnDocument
+from logger import get_logger
+
+# Initialize logger for the current module
+logger = get_logger(__name__)
+
+# Shared with the gateway: maps content SHA-256 to its video and converted mp3
+CONTENT_INDEX_COLLECTION = "content_index"
+
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+
+def find_converted(content_index, sha256):
+    """
+    Returns the mp3 file id already produced for this content, or None.
+    """
+    entry = content_index.find_one({"_id": sha256, "state": STATE_DONE}, {"mp3_file_id": 1})
+    return entry["mp3_file_id"] if entry else None
+
+
+def complete(content_index, sha256, mp3_fid):
+    """
+    Marks the content as converted and returns the users who uploaded duplicates meanwhile.
+
+    Flipping the state and taking the waiters happens in one atomic update, so
+    a gateway either lands in the returned list or sees the done state itself.
+    """
+    entry = content_index.find_one_and_update(
+        {"_id": sha256},
+        {"$set": {
+            "state": STATE_DONE,
+            "mp3_file_id": mp3_fid,
+            "waiters": [],
+            "updated_at": datetime.datetime.now(tz=datetime.timezone.utc),
+        }},
+        return_document=ReturnDocument.BEFORE,
+    )
+    return entry.get("waiters", []) if entry else []
+
+
+def mark_failed(content_index, sha256):
+    """
+    Lets the next upload of this content start a fresh conversion.
+
+    Returns the users who uploaded duplicates meanwhile; they are taken off the
+    entry, as that conversion will not happen.
+    """
+    entry = content_index.find_one_and_update(
+        {"_id": sha256, "state": {"$ne": STATE_DONE}},
+        {"$set": {"state": STATE_FAILED, "waiters": []}},
+        return_document=ReturnDocument.BEFORE,
+    )
+    return entry.get("waiters", []) if entry else []
@@ -0,0 +1,408 @@
+import json
+import os
+import subprocess
+import threading
+from collections import deque
+from bson.objectid import ObjectId
+from convert import metadata as mp3_metadata
+from logger import get_logger
+
+# Initialize logger for the current module
+logger = get_logger(__name__)
+
+FFMPEG_BINARY = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+FFPROBE_BINARY = os.environ.get("FFPROBE_BINARY", "ffprobe")
+MP3_BITRATE = os.environ.get("MP3_BITRATE", "192k")
+PROBE_BYTES = int(os.environ.get("FFMPEG_PROBE_BYTES", 2 * 1024 * 1024))  # head of the video used to detect the audio codec
+PIPE_CHUNK_SIZE = 255 * 1024  # one GridFS chunk
+
+# Segmented encoding: every segment is resampled to one rate so frames line up across segments
+SEGMENT_SAMPLE_RATE = 44100
+MP3_FRAME_SAMPLES = 1152  # samples per MPEG-1 Layer III frame
+SEGMENT_WARMUP_FRAMES = 2  # must cover the encoder delay (1105 samples for LAME) plus the MDCT overlap
+SEGMENT_SEEK_MARGIN = 1  # seconds decoded before a seeked segment's warm-up, so the decoder and resampler settle
+
+# Keys of the `-progress` report ffmpeg writes to stderr between its error messages
+PROGRESS_KEYS = {
+    "frame", "fps", "bitrate", "total_size", "out_time_us", "out_time_ms", "out_time",
+    "dup_frames", "drop_frames", "speed", "progress",
+}
+
+
+class ConversionError(Exception):
+    """
+    Raised when ffmpeg cannot produce audio from the piped input.
+    """
+
+
+def probe_media(head):
+    """
+    Returns (codec, duration in seconds, bitrate in bits/s) of the first audio stream found in `head`.
+
+    Any value is None if it cannot be determined. Only the start of the
+    file is probed, which is enough for streamable containers (faststart MP4,
+    MKV, WebM, MPEG-TS).
+    """
+    try:
+        result = subprocess.run(
+            [FFPROBE_BINARY, "-v", "error", "-select_streams", "a:0",
+             "-show_entries", "stream=codec_name,bit_rate:format=duration", "-of", "json", "pipe:0"],
+            input=head, capture_output=True, timeout=30,
+        )
+        info = json.loads(result.stdout or b"{}")
+    except (OSError, subprocess.TimeoutExpired, ValueError) as e:
+        logger.warning(f"ffprobe unavailable or failed: {e}")
+        return None, None, None
+
+    streams = info.get("streams") or [{}]
+    codec = streams[0].get("codec_name") or None
+    bitrate = mp3_metadata.parse_bitrate(streams[0].get("bit_rate"))
+    try:
+        duration = float(info.get("format", {}).get("duration"))
+    except (TypeError, ValueError):
+        duration = None
+    return codec, duration if duration and duration > 0 else None, bitrate
+
+
+def probe_audio_start(head):
+    """
+    Returns the seconds between the start of the container and its first audio sample, or None if unknown.
+
+    ffmpeg's input `-ss` counts from the start of the container, while segment
+    positions count from the first audio sample.
+    """
+    try:
+        result = subprocess.run(
+            [FFPROBE_BINARY, "-v", "error", "-select_streams", "a:0",
+             "-show_entries", "stream=start_time:format=start_time", "-of", "json", "pipe:0"],
+            input=head, capture_output=True, timeout=30,
+        )
+        info = json.loads(result.stdout or b"{}")
+        stream_start = float((info.get("streams") or [{}])[0]["start_time"])
+        format_start = float(info.get("format", {}).get("start_time") or 0)
+    except (OSError, subprocess.TimeoutExpired, ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Could not probe the audio start time: {e}")
+        return None
+    return max(0.0, stream_start - format_start)
+
+
+def is_seekable_from_pipe(head):
+    """
+    Checks that ffmpeg can seek into the input on a pipe by reading forward only.
+
+    True for MP4/MOV with the index at the front: the demuxer skips to the
+    wanted samples without decoding the data before them. Other containers
+    (e.g. Matroska, whose cues are at the end) seek backwards and fail on a pipe.
+    """
+    return head[4:8] == b"ftyp" and is_pipe_readable(head)
+
+
+def is_pipe_readable(head):
+    """
+    Checks that an MP4/MOV stores its index (moov) before the media data (mdat).
+
+    Without seeking back, ffmpeg cannot demux such files from a pipe and
+    silently produces empty output. Non-MP4 inputs are assumed readable.
+    """
+    if head[4:8] != b"ftyp":
+        return True
+    offset = 0
+    while offset + 8 <= len(head):
+        size = int.from_bytes(head[offset:offset + 4], "big")
+        box_type = head[offset + 4:offset + 8]
+        if box_type == b"moov":
+            return True
+        if box_type == b"mdat":
+            return False
+        if size == 1 and offset + 16 <= len(head):
+            size = int.from_bytes(head[offset + 8:offset + 16], "big")
+        if size < 8:
+            break
+        offset += size
+    return True
+
+
+def build_command(codec):
+    command = [FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-nostdin",
+               "-i", "pipe:0", "-vn", "-map", "0:a:0"]
+    if codec == "mp3":
+        # Already MP3: remux the audio stream without re-encoding
+        command += ["-c:a", "copy"]
+    else:
+        command += ["-c:a", "libmp3lame", "-b:a", MP3_BITRATE]
+    return command + ["-progress", "pipe:2", "-nostats", "-f", "mp3", "pipe:1"]
+
+
+def _feed(video_file, head, stdin, errors, on_fed=None):
+    try:
+        stdin.write(head)
+        while True:
+            data = video_file.read(PIPE_CHUNK_SIZE)
+            if not data:
+                break
+            stdin.write(data)
+            if on_fed:
+                on_fed(video_file.tell())
+    except BrokenPipeError:
+        # ffmpeg exited early; its exit status and stderr explain why
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def _drain(stream, lines, on_out_time=None):
+    for line in iter(stream.readline, b""):
+        line = line.decode(errors="replace").rstrip()
+        key, sep, value = line.partition("=")
+        if sep and key in PROGRESS_KEYS:
+            if key == "out_time_us" and on_out_time and value.isdigit():
+                on_out_time(int(value) / 1_000_000)
+            continue
+        lines.append(line)
+    stream.close()
+
+
+def _progress_callbacks(progress, duration, length):
+    """
+    Maps ffmpeg's output position (or, without a known duration, the bytes fed) to a percentage.
+
+    Returns (on_out_time, on_fed); 100% is left for the completed job.
+    """
+    if progress is None:
+        return None, None
+    if duration:
+        return lambda seconds: progress(min(99.0, 100.0 * seconds / duration)), None
+    if length:
+        return None, lambda fed: progress(min(99.0, 100.0 * fed / length))
+    return None, None
+
+
+def _transcode(command, video_file, head, write, on_out_time=None, on_fed=None):
+    """
+    Runs `command` on the video piped from GridFS and hands its stdout to `write` chunk by chunk.
+
+    Raises ConversionError if the video cannot be read or ffmpeg fails; the
+    process is killed if `write` raises.
+    """
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    feed_errors = []
+    stderr_tail = deque(maxlen=20)
+    feeder = threading.Thread(target=_feed, args=(video_file, head, process.stdin, feed_errors, on_fed), daemon=True)
+    drainer = threading.Thread(target=_drain, args=(process.stderr, stderr_tail, on_out_time), daemon=True)
+    feeder.start()
+    drainer.start()
+
+    try:
+        while True:
+            data = process.stdout.read(PIPE_CHUNK_SIZE)
+            if not data:
+                break
+            write(data)
+        returncode = process.wait()
+        feeder.join()
+        drainer.join()
+        if feed_errors:
+            raise ConversionError(f"Failed to read video {video_file._id} from GridFS: {feed_errors[0]}")
+        if returncode != 0:
+            raise ConversionError(f"ffmpeg exited with {returncode}: {' | '.join(stderr_tail)}")
+    except BaseException:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        raise
+    finally:
+        process.stdout.close()
+
+
+def _open_video(fs_videos, video_fid):
+    """
+    Returns the video's GridOut and its first PROBE_BYTES, checking that ffmpeg can read it from a pipe.
+    """
+    video_file = fs_videos.get(ObjectId(video_fid))
+    head = video_file.read(PROBE_BYTES)
+    if not is_pipe_readable(head):
+        raise ConversionError(f"Video {video_fid} is not streamable (MP4 index stored after the media data)")
+    return video_file, head
+
+
+def probe_video(fs_videos, video_fid):
+    """
+    Returns the duration in seconds of a video in GridFS, or None if it is unknown or not streamable.
+    """
+    video_file = fs_videos.get(ObjectId(video_fid))
+    head = video_file.read(PROBE_BYTES)
+    if not is_pipe_readable(head):
+        return None
+    _, duration, _ = probe_media(head)
+    return duration
+
+
+def convert(fs_videos, fs_mp3s, video_fid, progress=None, metadata=None):
+    """
+    Streams a video from GridFS through ffmpeg and the MP3 output straight back into GridFS.
+
+    GridFS chunks are piped into ffmpeg's stdin by a feeder thread while the
+    audio on stdout is written to a GridIn, so memory use stays constant
+    regardless of the video size and nothing touches the local disk.
+
+    `progress`, if given, is called with the completed percentage as ffmpeg
+    reports its position. `metadata` is stored on the MP3 file, completed with
+    its duration, bitrate and size.
+
+    Returns:
+    - ObjectId: ID of the MP3 file stored in `fs_mp3s`.
+    """
+    video_file, head = _open_video(fs_videos, video_fid)
+    codec, duration, source_bitrate = probe_media(head)
+    command = build_command(codec)
+    bitrate = source_bitrate if codec == "mp3" else mp3_metadata.parse_bitrate(MP3_BITRATE)
+    report_out_time, on_fed = _progress_callbacks(progress, duration, video_file.length)
+    out_time = [None]
+
+    def on_out_time(seconds):
+        out_time[0] = seconds
+        if report_out_time:
+            report_out_time(seconds)
+
+    logger.info(f"Converting video {video_fid} with ffmpeg (source audio codec: {codec or 'unknown'})")
+
+    grid_in = fs_mp3s.new_file(filename=f"{video_fid}.mp3", content_type="audio/mpeg")
+    written = [0]
+
+    def write(data):
+        grid_in.write(data)
+        written[0] += len(data)
+
+    try:
+        _transcode(command, video_file, head, write, on_out_time, on_fed)
+        if not written[0]:
+            raise ConversionError("ffmpeg produced no audio")
+        # The output position ffmpeg last reported is the MP3's own duration
+        grid_in.metadata = mp3_metadata.complete(metadata, out_time[0] or duration, bitrate, written[0])
+        grid_in.close()
+    except BaseException:
+        grid_in.abort()
+        raise
+
+    logger.info(f"ffmpeg conversion of video {video_fid} stored as MP3 {grid_in._id}")
+    return grid_in._id
+
+
+# MPEG-1 Layer III frame sizes: bitrates in kbit/s by header index, and sample rates
+_MPEG1_L3_BITRATES = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+_MPEG1_SAMPLE_RATES = (44100, 48000, 32000)
+
+
+def mp3_frame_length(header):
+    """
+    Returns the length in bytes of the MPEG-1 Layer III frame starting with `header` (4 bytes), or None.
+    """
+    if header[0] != 0xFF or header[1] & 0xFE != 0xFA:  # sync, MPEG-1, Layer III
+        return None
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 0x03
+    if not 0 < bitrate_index < len(_MPEG1_L3_BITRATES) or rate_index == 3:
+        return None
+    padding = (header[2] >> 1) & 0x01
+    return 144000 * _MPEG1_L3_BITRATES[bitrate_index] // _MPEG1_SAMPLE_RATES[rate_index] + padding
+
+
+class FrameSlicer:
+    """
+    Splits a raw MP3 stream into frames and passes on frames [skip, skip + count) only.
+    """
+
+    def __init__(self, write, skip=0, count=None):
+        self.write = write
+        self.skip = skip
+        self.count = count
+        self.frames = 0  # frames seen
+        self.kept = 0
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer += data
+        offset = 0
+        out = bytearray()
+        while len(self._buffer) - offset >= 4:
+            length = mp3_frame_length(self._buffer[offset:offset + 4])
+            if length is None:
+                raise ConversionError(f"Unexpected data in MP3 output after {self.frames} frames")
+            if len(self._buffer) - offset < length:
+                break
+            if self.frames >= self.skip and (self.count is None or self.kept < self.count):
+                out += self._buffer[offset:offset + length]
+                self.kept += 1
+            self.frames += 1
+            offset += length
+        del self._buffer[:offset]
+        if out:
+            self.write(bytes(out))
+
+
+def encode_segment(fs_videos, fs_mp3s, video_fid, first_frame, frames=None, metadata=None):
+    """
+    Encodes MP3 frames [first_frame, first_frame + frames) of a video, or up to its end if `frames` is None.
+
+    Segments encoded this way concatenate without gaps: the input is resampled
+    to SEGMENT_SAMPLE_RATE and trimmed at exact sample positions, and each
+    segment starts SEGMENT_WARMUP_FRAMES frames early so its first kept frame
+    lines up with the same frame of a single-pass encode (the encoder delay
+    shifts both alike). The warm-up frames are dropped. The bit reservoir is
+    off, so no kept frame borrows bytes from a dropped one.
+
+    When the container can be seeked on a pipe, ffmpeg seeks the input to a
+    whole second (counted from the first audio sample) SEGMENT_SEEK_MARGIN
+    before the warm-up, so only the segment's own span is decoded. Whole
+    seconds fall on the same resampled sample grid as a single pass. Other
+    inputs are decoded from the start and trimmed.
+
+    Returns:
+    - tuple: (ObjectId of the segment file stored in `fs_mp3s`, number of frames stored).
+    """
+    video_file, head = _open_video(fs_videos, video_fid)
+    skip = min(first_frame, SEGMENT_WARMUP_FRAMES)
+    start_sample = (first_frame - skip) * MP3_FRAME_SAMPLES
+    end_sample = None
+    if frames is not None:
+        # Enough input past the last kept frame to cover the encoder delay and the MDCT overlap
+        end_sample = (first_frame + frames + SEGMENT_WARMUP_FRAMES) * MP3_FRAME_SAMPLES
+
+    seek_args = []
+    seek_seconds = start_sample // SEGMENT_SAMPLE_RATE - SEGMENT_SEEK_MARGIN
+    if seek_seconds > 0 and is_seekable_from_pipe(head):
+        audio_start = probe_audio_start(head)
+        if audio_start is not None:
+            seek_args = ["-ss", f"{audio_start + seek_seconds:.6f}"]
+            start_sample -= seek_seconds * SEGMENT_SAMPLE_RATE
+            if end_sample is not None:
+                end_sample -= seek_seconds * SEGMENT_SAMPLE_RATE
+
+    trim = f"start_sample={start_sample}"
+    if end_sample is not None:
+        trim += f":end_sample={end_sample}"
+    command = [FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-nostdin",
+               *seek_args, "-i", "pipe:0", "-vn", "-map", "0:a:0",
+               "-af", f"aresample={SEGMENT_SAMPLE_RATE},asetpts=N/SR/TB,atrim={trim},asetpts=PTS-STARTPTS",
+               "-c:a", "libmp3lame", "-b:a", MP3_BITRATE, "-reservoir", "0",
+               "-write_xing", "0", "-id3v2_version", "0", "-f", "mp3", "pipe:1"]
+
+    grid_in = fs_mp3s.new_file(filename=f"{video_fid}.{first_frame}.mp3", content_type="audio/mpeg", metadata=metadata)
+    slicer = FrameSlicer(grid_in.write, skip=skip, count=frames)
+    try:
+        _transcode(command, video_file, head, slicer.feed)
+        grid_in.close()
+    except BaseException:
+        grid_in.abort()
+        raise
+
+    logger.info(
+        f"Encoded frames {first_frame}+{slicer.kept} of video {video_fid} as segment {grid_in._id}"
+        f"{' after seeking to ' + seek_args[1] + 's' if seek_args else ''}"
+    )
+    return grid_in._id, slicer.kept
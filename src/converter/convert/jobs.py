@@ -0,0 +1,84 @@
+import datetime
+import os
+import time
+from bson.objectid import ObjectId
+from logger import get_logger
+
+# Initialize logger for the current module
+logger = get_logger(__name__)
+
+# Shared with the gateway, which creates a job per upload and serves it to clients
+JOBS_COLLECTION = "jobs"
+
+STATE_QUEUED = "queued"
+STATE_CONVERTING = "converting"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+# Progress is written at most this often, whichever comes first
+JOB_PROGRESS_STEP = float(os.environ.get("JOB_PROGRESS_STEP", 5))  # percentage points
+JOB_PROGRESS_INTERVAL = float(os.environ.get("JOB_PROGRESS_INTERVAL", 5))  # seconds
+
+
+def _now():
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+
+def _update(jobs, job_id, update, final_ok=False):
+    """
+    Applies `update` to a job; tracking failures are logged and never fail a conversion.
+
+    Unless `final_ok`, jobs that are already done or failed are left alone, so
+    a late progress report cannot reopen them.
+    """
+    if jobs is None or not job_id:
+        return
+    query = {"_id": ObjectId(job_id)}
+    if not final_ok:
+        query["state"] = {"$nin": [STATE_DONE, STATE_FAILED]}
+    update.setdefault("$set", {})["updated_at"] = _now()
+    try:
+        jobs.update_one(query, update)
+    except Exception as e:
+        logger.error(f"Failed to update job {job_id}: {e}")
+
+
+def mark_converting(jobs, job_id):
+    _update(jobs, job_id, {"$set": {"state": STATE_CONVERTING, "error": None}})
+
+
+def progress_reporter(jobs, job_id):
+    """
+    Returns a callable taking a percentage that stores it on the job, throttled.
+    """
+    last = {"percent": 0.0, "at": 0.0}
+
+    def report(percent):
+        now = time.monotonic()
+        if percent - last["percent"] < JOB_PROGRESS_STEP and now - last["at"] < JOB_PROGRESS_INTERVAL:
+            return
+        last.update(percent=percent, at=now)
+        report_progress(jobs, job_id, percent)
+
+    return report
+
+
+def report_progress(jobs, job_id, percent):
+    # $max keeps the stored progress monotonic, e.g. when the fallback engine starts over
+    _update(jobs, job_id, {"$set": {"state": STATE_CONVERTING}, "$max": {"progress": round(percent, 1)}})
+
+
+def mark_done(jobs, job_id, audio_file_id):
+    _update(
+        jobs, job_id,
+        {"$set": {"state": STATE_DONE, "progress": 100, "audio_file_id": str(audio_file_id), "error": None}},
+        final_ok=True,
+    )
+
+
+def mark_retrying(jobs, job_id, error):
+    _update(jobs, job_id, {"$set": {"state": STATE_QUEUED, "error": str(error)}, "$inc": {"attempts": 1}})
+
+
+def mark_failed(jobs, job_id, error):
+    _update(jobs, job_id, {"$set": {"state": STATE_FAILED, "error": str(error)}})
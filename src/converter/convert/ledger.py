@@ -0,0 +1,178 @@
+import datetime
+import os
+import socket
+import time
+import uuid
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from logger import get_logger
+
+# Initialize logger for the current module
+logger = get_logger(__name__)
+
+# One entry per video, so a redelivered message resumes where the last attempt stopped
+LEDGER_COLLECTION = "conversion_ledger"
+LEDGER_LEASE = int(os.environ.get("LEDGER_LEASE", 15 * 60))  # seconds a claim holds without progress
+LEDGER_TTL = int(os.environ.get("LEDGER_TTL", 14 * 24 * 60 * 60))  # seconds a published entry is kept
+
+STATE_CLAIMED = "claimed"
+STATE_STORED = "stored"
+STATE_PUBLISHED = "published"
+
+
+class LedgerBusy(Exception):
+    """
+    Raised when another worker holds a live claim on the video.
+
+    `retry_after` is the seconds left on that claim: the message is retried
+    once it can be taken over, without using up its retry attempts.
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _now():
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+
+def _lease_until(lease):
+    return _now() + datetime.timedelta(seconds=lease)
+
+
+def _seconds_left(lease_until):
+    # pymongo returns naive datetimes in UTC
+    if lease_until.tzinfo is None:
+        lease_until = lease_until.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (lease_until - _now()).total_seconds())
+
+
+def ensure_indexes(ledger):
+    # Only published entries expire; claimed and stored ones are still needed by a retry
+    ledger.create_index([("published_at", ASCENDING)], expireAfterSeconds=LEDGER_TTL)
+
+
+def new_owner():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def claim(ledger, video_fid, owner, fs_mp3s=None, lease=LEDGER_LEASE):
+    """
+    Claims the conversion of a video for `owner`, or returns how far an earlier attempt got.
+
+    Returns the ledger entry:
+    - claimed by `owner`: convert the video;
+    - stored: the MP3 exists, publish it again;
+    - published: nothing left to do.
+
+    An expired claim is taken over. Before converting again, `fs_mp3s` is
+    searched for an MP3 the previous owner stored but did not record, so a
+    crash between storing and recording does not leave a duplicate.
+    Raises LedgerBusy while another owner's claim is live.
+    """
+    now = _now()
+    try:
+        entry = {
+            "_id": video_fid,
+            "state": STATE_CLAIMED,
+            "owner": owner,
+            "lease_until": _lease_until(lease),
+            "attempts": 1,
+            "audio_file_id": None,
+            "created_at": now,
+            "updated_at": now,
+        }
+        ledger.insert_one(entry)
+        return entry
+    except DuplicateKeyError:
+        pass
+
+    entry = ledger.find_one_and_update(
+        {"_id": video_fid, "state": STATE_CLAIMED, "lease_until": {"$lt": now}},
+        {"$set": {"owner": owner, "lease_until": _lease_until(lease), "updated_at": now}, "$inc": {"attempts": 1}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if entry is None:
+        entry = ledger.find_one({"_id": video_fid})
+        if entry is None:
+            # Released between the insert and the lookup
+            return claim(ledger, video_fid, owner, fs_mp3s, lease)
+        if entry["state"] == STATE_CLAIMED and entry["owner"] != owner:
+            raise LedgerBusy(
+                f"Video {video_fid} is being converted by {entry['owner']} until {entry['lease_until']}",
+                _seconds_left(entry["lease_until"]),
+            )
+        return entry
+
+    logger.warning(f"Took over the expired claim on video {video_fid} (attempt {entry['attempts']})")
+    stored = fs_mp3s.find_one({"metadata.video_file_id": str(video_fid)}) if fs_mp3s is not None else None
+    if stored is not None and mark_stored(ledger, video_fid, owner, stored._id):
+        logger.info(f"Found MP3 {stored._id} stored by the previous attempt for video {video_fid}")
+        return ledger.find_one({"_id": video_fid})
+    return entry
+
+
+def keep_alive(ledger, video_fid, owner, progress=None, lease=LEDGER_LEASE):
+    """
+    Wraps a progress callback so that each report also extends the claim, at most every third of the lease.
+    """
+    last = {"at": time.monotonic()}
+
+    def report(percent):
+        if progress is not None:
+            progress(percent)
+        now = time.monotonic()
+        if now - last["at"] < lease / 3:
+            return
+        last["at"] = now
+        try:
+            ledger.update_one(
+                {"_id": video_fid, "owner": owner, "state": STATE_CLAIMED},
+                {"$set": {"lease_until": _lease_until(lease), "updated_at": _now()}},
+            )
+        except Exception as e:
+            logger.error(f"Failed to extend the claim on video {video_fid}: {e}")
+
+    return report
+
+
+def mark_stored(ledger, video_fid, owner, audio_file_id):
+    """
+    Records the stored MP3; returns False if `owner` lost the claim, in which case the MP3 is a duplicate.
+    """
+    result = ledger.update_one(
+        {"_id": video_fid, "owner": owner, "state": STATE_CLAIMED},
+        {"$set": {"state": STATE_STORED, "audio_file_id": audio_file_id, "updated_at": _now()}},
+    )
+    return result.modified_count == 1
+
+
+def mark_published(ledger, video_fid, audio_file_id):
+    if ledger is None:
+        return
+    now = _now()
+    try:
+        ledger.update_one(
+            {"_id": video_fid},
+            {
+                "$set": {"state": STATE_PUBLISHED, "audio_file_id": audio_file_id, "published_at": now, "updated_at": now},
+                "$unset": {"lease_until": ""},
+            },
+            upsert=True,
+        )
+    except Exception as e:
+        # The message is out; a redelivery would only notify the user twice
+        logger.error(f"Failed to record video {video_fid} as published: {e}")
+
+
+def release(ledger, video_fid, owner):
+    """
+    Drops a claim after a failed attempt, so the retry does not wait for the lease to expire.
+    """
+    if ledger is None:
+        return
+    try:
+        ledger.delete_one({"_id": video_fid, "owner": owner, "state": STATE_CLAIMED})
+    except Exception as e:
+        logger.error(f"Failed to release the claim on video {video_fid}: {e}")
@@ -0,0 +1,70 @@
+import datetime
+from logger import get_logger
+
+# Initialize logger for the current module
+logger = get_logger(__name__)
+
+# GridFS files collection of the MP3 database; the gateway indexes and lists it by metadata.owners
+MP3_FILES_COLLECTION = "fs.files"
+
+
+def for_message(message):
+    """
+    Returns the metadata known before converting: who owns the MP3 and which video it came from.
+    """
+    username = message.get("username")
+    return {
+        "owners": [username] if username else [],
+        "video_file_id": str(message["video_file_id"]),
+    }
+
+
+def complete(metadata, duration, bitrate, size):
+    """
+    Adds what is only known once the MP3 is written.
+
+    `duration` is in seconds and `bitrate` in bits per second; either may be None.
+    """
+    return {
+        **(metadata or {}),
+        "duration": round(duration, 3) if duration else None,
+        "bitrate": bitrate,
+        "size": size,
+        "created_at": datetime.datetime.now(tz=datetime.timezone.utc),
+    }
+
+
+def parse_bitrate(value):
+    """
+    Converts an ffmpeg bitrate such as '192k' or '128000' to bits per second, or None.
+    """
+    if not value:
+        return None
+    value = str(value).strip().lower()
+    scale = {"k": 1000, "m": 1000 * 1000}.get(value[-1], 1)
+    try:
+        return int(float(value[:-1] if scale > 1 else value) * scale)
+    except ValueError:
+        return None
+
+
+def add_owners(mp3_files, mp3_fid, usernames):
+    """
+    Lists an MP3 shared through upload deduplication under every user who uploaded the content.
+
+    Also stamps `metadata.shared_at`, from which the lifecycle sweeper counts
+    MP3_TTL_DAYS, so an MP3 just handed to another user does not expire under them.
+    """
+    usernames = [u for u in usernames if u]
+    if mp3_files is None or not usernames:
+        return
+    try:
+        mp3_files.update_one(
+            {"_id": mp3_fid},
+            {
+                "$addToSet": {"metadata.owners": {"$each": usernames}},
+                "$set": {"metadata.shared_at": datetime.datetime.now(tz=datetime.timezone.utc)},
+            },
+        )
+    except Exception as e:
+        logger.error(f"Failed to add owners {usernames} to MP3 {mp3_fid}: {e}")
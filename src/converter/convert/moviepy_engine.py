@@ -0,0 +1,79 @@
+import tempfile
+import os
+from bson.objectid import ObjectId
+import moviepy.editor
+import proglog
+from convert import metadata as mp3_metadata
+from logger import get_logger
+
+# Initialize logger for the current module
+logger = get_logger(__name__)
+
+MP3_BITRATE = os.environ.get("MP3_BITRATE", "192k")
+
+
+class _ProgressLogger(proglog.ProgressBarLogger):
+    """
+    Forwards MoviePy's audio encoding progress bar as a percentage.
+    """
+
+    def __init__(self, progress):
+        super().__init__()
+        self.progress = progress
+
+    def bars_callback(self, bar, attr, value, old_value=None):
+        total = self.bars[bar].get("total")
+        if attr == "index" and total:
+            self.progress(min(99.0, 100.0 * value / total))
+
+
+def convert(fs_videos, fs_mp3s, video_fid, progress=None, metadata=None):
+    """
+    Converts a video to MP3 with MoviePy through temporary files.
+
+    `progress`, if given, is called with the completed percentage. `metadata`
+    is stored on the MP3 file, completed with its duration, bitrate and size.
+
+    Returns:
+    - ObjectId: ID of the MP3 file stored in `fs_mp3s`.
+    """
+    temp_video_path = None
+    temp_audio_path = None
+
+    try:
+        # Fetch video file and save it to a temporary file
+        with tempfile.NamedTemporaryFile(delete=False) as temp_video:
+            video_file = fs_videos.get(ObjectId(video_fid))
+            temp_video.write(video_file.read())
+            temp_video_path = temp_video.name
+            logger.info(f"Video file saved temporarily at: {temp_video_path}")
+
+        # Convert video to audio (MP3 format)
+        temp_audio_path = os.path.join(tempfile.gettempdir(), f"{video_fid}.mp3")
+        logger.info(f"Starting video-to-audio conversion for video ID: {video_fid}")
+        video_clip = moviepy.editor.VideoFileClip(temp_video_path)
+        video_clip.audio.write_audiofile(
+            temp_audio_path, bitrate=MP3_BITRATE, logger=_ProgressLogger(progress) if progress else None
+        )
+        duration = video_clip.audio.duration
+        video_clip.close()
+        logger.info(f"Audio conversion successful. Temporary MP3 path: {temp_audio_path}")
+
+        # Store the MP3 file in GridFS
+        with open(temp_audio_path, "rb") as audio_file:
+            data = audio_file.read()
+        return fs_mp3s.put(
+            data,
+            filename=f"{video_fid}.mp3",
+            content_type="audio/mpeg",
+            metadata=mp3_metadata.complete(metadata, duration, mp3_metadata.parse_bitrate(MP3_BITRATE), len(data)),
+        )
+
+    finally:
+        # Cleanup temporary files
+        if temp_video_path and os.path.exists(temp_video_path):
+            os.remove(temp_video_path)
+            logger.info(f"Cleaned up temporary video file: {temp_video_path}")
+        if temp_audio_path and os.path.exists(temp_audio_path):
+            os.remove(temp_audio_path)
+            logger.info(f"Cleaned up temporary audio file: {temp_audio_path}")
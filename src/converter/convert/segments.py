@@ -0,0 +1,230 @@
+import datetime
+import json
+import math
+import os
+import time
+from pymongo import ASCENDING, ReturnDocument
+from convert import ffmpeg_engine, jobs as job_store, ledger as ledger_store, metadata as mp3_metadata
+from logger import get_logger
+
+# Initialize logger for the current module
+logger = get_logger(__name__)
+
+# Videos of at least SEGMENT_MIN_DURATION seconds are split into slices of about SEGMENT_SECONDS,
+# encoded in parallel from SEGMENT_QUEUE and merged by whichever worker finishes the last one
+SEGMENT_QUEUE = os.environ.get("SEGMENT_QUEUE", "video.segment")
+SEGMENT_MIN_DURATION = float(os.environ.get("SEGMENT_MIN_DURATION", 0))  # seconds; 0 disables splitting
+SEGMENT_SECONDS = float(os.environ.get("SEGMENT_SECONDS", 300))
+SEGMENT_MAX_COUNT = int(os.environ.get("SEGMENT_MAX_COUNT", 32))
+SEGMENT_MERGE_LEASE = int(os.environ.get("SEGMENT_MERGE_LEASE", 10 * 60))  # seconds without renewal before a merge is retaken
+SEGMENT_PLAN_TTL = int(os.environ.get("SEGMENT_PLAN_TTL", 2 * 24 * 60 * 60))  # seconds a plan is kept
+
+SEGMENT_PLANS_COLLECTION = "segment_plans"
+SEGMENT_KEY = "segment"  # present on segment messages
+
+STATE_SEGMENTING = "segmenting"
+STATE_MERGED = "merged"
+
+
+class SegmentError(Exception):
+    """
+    Raised when a segment cannot be completed yet; the message is retried.
+    """
+
+
+def _now():
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+
+def ensure_indexes(plans):
+    plans.create_index([("created_at", ASCENDING)], expireAfterSeconds=SEGMENT_PLAN_TTL)
+
+
+def plan(message, fs_videos, plans):
+    """
+    Splits a long video into segment messages, or returns None if it is converted in one pass.
+
+    The plan is keyed by the video, so a retried message reuses it and
+    segments that were already encoded are not encoded again.
+    """
+    if plans is None or SEGMENT_MIN_DURATION <= 0:
+        return None
+    video_fid = message["video_file_id"]
+    duration = ffmpeg_engine.probe_video(fs_videos, video_fid)
+    if not duration or duration < SEGMENT_MIN_DURATION:
+        return None
+    count = min(SEGMENT_MAX_COUNT, math.ceil(duration / SEGMENT_SECONDS))
+    if count < 2:
+        return None
+
+    total_frames = math.ceil(duration * ffmpeg_engine.SEGMENT_SAMPLE_RATE / ffmpeg_engine.MP3_FRAME_SAMPLES)
+    per_segment = math.ceil(total_frames / count)
+    # The last segment runs to the end, whatever the probed duration missed
+    segments = [
+        {"index": i, "count": count, "first_frame": i * per_segment, "frames": per_segment if i < count - 1 else None}
+        for i in range(count)
+    ]
+    entry = plans.find_one_and_update(
+        {"_id": video_fid},
+        {"$setOnInsert": {
+            "message": message,
+            "segments": segments,
+            "parts": {},
+            "completed": 0,
+            "state": STATE_SEGMENTING,
+            "created_at": _now(),
+        }},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    logger.info(f"Splitting video {video_fid} ({duration:.0f}s) into {len(entry['segments'])} segments")
+    return [{**message, SEGMENT_KEY: segment} for segment in entry["segments"]]
+
+
+def fan_out(segment_messages, publisher):
+    """
+    Publishes the segment messages; raises PublishError if the broker rejects one.
+    """
+    for segment_message in segment_messages:
+        publisher.publish_and_wait(SEGMENT_QUEUE, json.dumps(segment_message))
+    logger.info(f"Queued {len(segment_messages)} segments on '{SEGMENT_QUEUE}'")
+
+
+def _final_message(entry):
+    return {**entry["message"], "audio_file_id": str(entry["audio_file_id"]), "segmented": True}
+
+
+def run_segment(message, fs_videos, fs_mp3s, plans, jobs=None):
+    """
+    Encodes one segment and records it on the plan; the worker recording the last one merges them.
+
+    Returns the final message to publish once the merged MP3 is stored, or
+    None while other segments are outstanding.
+    """
+    segment = message[SEGMENT_KEY]
+    video_fid = message["video_file_id"]
+    key = f"parts.{segment['index']}"
+    entry = plans.find_one({"_id": video_fid}) if plans is not None else None
+    if entry is None:
+        raise SegmentError(f"No segment plan for video {video_fid}")
+    if entry["state"] == STATE_MERGED:
+        # Redelivered after the merge, e.g. because publishing the result failed
+        return _final_message(entry)
+
+    if str(segment["index"]) not in entry["parts"]:
+        file_id, frames = ffmpeg_engine.encode_segment(
+            fs_videos, fs_mp3s, video_fid, segment["first_frame"], segment["frames"],
+            metadata={"segment_of": video_fid, "index": segment["index"]},
+        )
+        recorded = plans.find_one_and_update(
+            {"_id": video_fid, key: {"$exists": False}},
+            {"$set": {key: {"file_id": file_id, "frames": frames}}, "$inc": {"completed": 1}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if recorded is None:
+            # A redelivered copy of this segment was recorded first
+            fs_mp3s.delete(file_id)
+            recorded = plans.find_one({"_id": video_fid})
+            if recorded is None:
+                raise SegmentError(f"Segment plan for video {video_fid} expired")
+        entry = recorded
+
+    job_store.report_progress(jobs, message.get("job_id"), 99.0 * entry["completed"] / len(entry["segments"]))
+    if entry["completed"] < len(entry["segments"]):
+        return None
+    return _final_message(merge(entry, fs_mp3s, plans))
+
+
+def _renew_merge(plans, video_fid, owner, lease=SEGMENT_MERGE_LEASE):
+    """
+    Returns a callback for the copy loop that extends the merge lease at most every third of the lease.
+
+    The callback raises SegmentError once `owner` no longer holds the merge.
+    """
+    last = {"at": time.monotonic()}
+
+    def renew():
+        now = time.monotonic()
+        if now - last["at"] < lease / 3:
+            return
+        last["at"] = now
+        renewed = plans.update_one(
+            {"_id": video_fid, "state": STATE_SEGMENTING, "merge_owner": owner},
+            {"$set": {"merge_renewed_at": _now()}},
+        )
+        if renewed.matched_count != 1:
+            raise SegmentError(f"Merge of video {video_fid} was taken over by another worker")
+
+    return renew
+
+
+def merge(entry, fs_mp3s, plans, lease=SEGMENT_MERGE_LEASE):
+    """
+    Concatenates the segments in order into the final MP3 and deletes them.
+
+    Only one worker merges at a time. The merging worker renews its lease while
+    copying; a merge not renewed within `lease` seconds may be taken over. The
+    merged MP3 is recorded and the segments are deleted only if the worker
+    still holds the merge, so a worker that lost it leaves them to the new
+    owner and deletes its own copy. Returns the updated plan.
+    """
+    video_fid = entry["_id"]
+    owner = ledger_store.new_owner()
+    now = _now()
+    claimed = plans.find_one_and_update(
+        {
+            "_id": video_fid,
+            "state": STATE_SEGMENTING,
+            "$or": [
+                {"merge_renewed_at": None},
+                {"merge_renewed_at": {"$lt": now - datetime.timedelta(seconds=lease)}},
+            ],
+        },
+        {"$set": {"merge_owner": owner, "merge_renewed_at": now}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if claimed is None:
+        raise SegmentError(f"Segments of video {video_fid} are being merged by another worker")
+
+    parts = [claimed["parts"][str(i)] for i in range(len(claimed["segments"]))]
+    frames = sum(part["frames"] for part in parts)
+    renew = _renew_merge(plans, video_fid, owner, lease)
+    grid_in = fs_mp3s.new_file(filename=f"{video_fid}.mp3", content_type="audio/mpeg")
+    size = 0
+    try:
+        for part in parts:
+            part_file = fs_mp3s.get(part["file_id"])
+            while True:
+                data = part_file.read(ffmpeg_engine.PIPE_CHUNK_SIZE)
+                if not data:
+                    break
+                grid_in.write(data)
+                size += len(data)
+                renew()
+        duration = frames * ffmpeg_engine.MP3_FRAME_SAMPLES / ffmpeg_engine.SEGMENT_SAMPLE_RATE
+        grid_in.metadata = mp3_metadata.complete(
+            mp3_metadata.for_message(claimed["message"]), duration, mp3_metadata.parse_bitrate(ffmpeg_engine.MP3_BITRATE), size
+        )
+        grid_in.close()
+    except BaseException:
+        grid_in.abort()
+        plans.update_one({"_id": video_fid, "merge_owner": owner}, {"$set": {"merge_owner": None, "merge_renewed_at": None}})
+        raise
+
+    merged = plans.find_one_and_update(
+        {"_id": video_fid, "state": STATE_SEGMENTING, "merge_owner": owner},
+        {"$set": {"state": STATE_MERGED, "audio_file_id": grid_in._id}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if merged is None:
+        # Taken over after the copy finished; the new owner records its own MP3
+        fs_mp3s.delete(grid_in._id)
+        raise SegmentError(f"Merge of video {video_fid} was taken over by another worker")
+
+    for part in parts:
+        try:
+            fs_mp3s.delete(part["file_id"])
+        except Exception as e:
+            logger.error(f"Failed to delete segment {part['file_id']} of video {video_fid}: {e}")
+    logger.info(f"Merged {len(parts)} segments of video {video_fid} into MP3 {grid_in._id} ({frames} frames)")
+    return merged
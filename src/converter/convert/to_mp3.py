@@ -1,31 +1,67 @@
 import json
-import tempfile
 import os
-import pika
 from bson.objectid import ObjectId
-import moviepy.editor
+import lifecycle
+from convert import dedup, ffmpeg_engine, jobs as job_store, ledger as ledger_store, metadata as mp3_metadata, moviepy_engine, segments
 from logger import get_logger
 
 # Initialize logger for the current module
 logger = get_logger(__name__)
 
-def start(message, fs_videos, fs_mp3s, channel):
+# Conversion engines: "ffmpeg" streams through an ffmpeg subprocess, "moviepy" uses temporary files
+ENGINES = {
+    "ffmpeg": ffmpeg_engine,
+    "moviepy": moviepy_engine,
+}
+CONVERTER_ENGINE = os.environ.get("CONVERTER_ENGINE", "ffmpeg")
+CONVERTER_FALLBACK_ENGINE = os.environ.get("CONVERTER_FALLBACK_ENGINE", "moviepy")  # empty disables the fallback
+
+
+def convert_video(fs_videos, fs_mp3s, video_fid, progress=None, metadata=None):
     """
-    Converts a video file to MP3 format, stores the audio in MongoDB, and publishes a message to RabbitMQ.
+    Runs the configured engine, retrying once with the fallback engine if it fails.
+
+    The fallback covers inputs ffmpeg cannot read from a pipe, such as MP4s
+    whose index (moov atom) is stored at the end of the file.
+    """
+    engine = ENGINES[CONVERTER_ENGINE]
+    try:
+        return engine.convert(fs_videos, fs_mp3s, video_fid, progress, metadata)
+    except Exception as err:
+        fallback = ENGINES.get(CONVERTER_FALLBACK_ENGINE)
+        if fallback is None or fallback is engine:
+            raise
+        logger.warning(f"{CONVERTER_ENGINE} engine failed for video {video_fid} ({err}); retrying with {CONVERTER_FALLBACK_ENGINE}")
+        return fallback.convert(fs_videos, fs_mp3s, video_fid, progress, metadata)
+
+
+def convert(message, fs_videos, fs_mp3s, content_index=None, jobs=None, segment_plans=None, ledger=None):
+    """
+    Converts the video referenced by a queue message and stores the MP3 in GridFS.
+
+    Content that was already converted (same 'content_sha256') is not converted again.
+    With a `ledger`, a redelivered message resumes from the last step that
+    completed: an MP3 that was stored is published again instead of being
+    converted again, and a published one is not touched (see convert.ledger).
+    Long videos are split into segment messages instead (see convert.segments),
+    returned under 'segments'; a segment message encodes its slice and, for the
+    last slice, the merged MP3 is returned like a one-pass conversion.
 
     Parameters:
     - message (bytes): JSON-encoded message from RabbitMQ.
     - fs_videos (gridfs.GridFS): GridFS instance for accessing video files.
     - fs_mp3s (gridfs.GridFS): GridFS instance for storing MP3 files.
-    - channel (pika.channel.Channel): RabbitMQ channel for publishing messages.
+    - content_index (pymongo.collection.Collection): Optional content-hash index shared with the gateway.
+    - jobs (pymongo.collection.Collection): Optional job collection shared with the gateway.
+    - segment_plans (pymongo.collection.Collection): Optional segment plans; None disables splitting.
+    - ledger (pymongo.collection.Collection): Optional conversion ledger.
 
     Returns:
-    - dict: Response containing status, message, and details.
+    - tuple: (message dict with 'audio_file_id' or 'segments' set, None) on success, (None, None) for a
+      segment that leaves the merge to another worker or a message with nothing left to do,
+      (None, error dict) on failure.
     """
-    temp_video_path = None
-    temp_audio_path = None
-    mp3_fid = None
-
+    video_fid, owner = None, None
     try:
         # Parse the message
         message = json.loads(message)
@@ -35,59 +71,176 @@ def start(message, fs_videos, fs_mp3s, channel):
         if not video_fid:
             error_msg = "Missing 'video_file_id' in the message."
             logger.error(error_msg)
-            return {"status": False, "message": error_msg}
-
-        # Fetch video file and save it to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False) as temp_video:
-            video_file = fs_videos.get(ObjectId(video_fid))
-            temp_video.write(video_file.read())
-            temp_video_path = temp_video.name
-            logger.info(f"Video file saved temporarily at: {temp_video_path}")
-
-        # Convert video to audio (MP3 format)
-        temp_audio_path = os.path.join(tempfile.gettempdir(), f"{video_fid}.mp3")
-        logger.info(f"Starting video-to-audio conversion for video ID: {video_fid}")
-        video_clip = moviepy.editor.VideoFileClip(temp_video_path)
-        video_clip.audio.write_audiofile(temp_audio_path, logger=None)
-        video_clip.close()
-        logger.info(f"Audio conversion successful. Temporary MP3 path: {temp_audio_path}")
-
-        # Store the MP3 file in GridFS
-        with open(temp_audio_path, "rb") as audio_file:
-            mp3_fid = fs_mp3s.put(audio_file.read())
+            return None, {"status": False, "message": error_msg}
+
+        sha256 = message.get("content_sha256")
+        if content_index is not None and sha256:
+            mp3_fid = dedup.find_converted(content_index, sha256)
+            if mp3_fid:
+                logger.info(f"Content {sha256} was already converted to MP3 {mp3_fid}; skipping conversion")
+                message["audio_file_id"] = str(mp3_fid)
+                message["deduplicated"] = True
+                return message, None
+
+        if ledger is not None:
+            if segments.SEGMENT_KEY in message:
+                # Segments run side by side and are made idempotent by their plan; only the outcome is checked
+                entry = ledger.find_one({"_id": video_fid})
+            else:
+                owner = ledger_store.new_owner()
+                entry = ledger_store.claim(ledger, video_fid, owner, fs_mp3s)
+            state = entry["state"] if entry else None
+            if state == ledger_store.STATE_PUBLISHED:
+                logger.info(f"Video {video_fid} was already converted and published; skipping redelivery")
+                return None, None
+            if state == ledger_store.STATE_STORED:
+                logger.info(f"Video {video_fid} was already converted to MP3 {entry['audio_file_id']}; publishing it again")
+                message["audio_file_id"] = str(entry["audio_file_id"])
+                return message, None
+
+        # Convert the video and store the MP3 file in GridFS
+        job_id = message.get("job_id")
+        job_store.mark_converting(jobs, job_id)
+        if segments.SEGMENT_KEY in message:
+            return segments.run_segment(message, fs_videos, fs_mp3s, segment_plans, jobs), None
+        if ENGINES[CONVERTER_ENGINE] is ffmpeg_engine:
+            segment_messages = segments.plan(message, fs_videos, segment_plans)
+            if segment_messages:
+                # The segment plan makes a redelivered message reuse finished segments, so the claim is not needed
+                ledger_store.release(ledger, video_fid, owner)
+                message["segments"] = segment_messages
+                return message, None
+        progress = job_store.progress_reporter(jobs, job_id) if job_id else None
+        if owner is not None:
+            progress = ledger_store.keep_alive(ledger, video_fid, owner, progress)
+        mp3_fid = convert_video(fs_videos, fs_mp3s, video_fid, progress, mp3_metadata.for_message(message))
         logger.info(f"MP3 file stored in MongoDB with ID: {mp3_fid}")
+        if owner is not None and not ledger_store.mark_stored(ledger, video_fid, owner, mp3_fid):
+            # The claim expired and another worker took the video over; its MP3 is the one published
+            logger.warning(f"Lost the claim on video {video_fid}; deleting duplicate MP3 {mp3_fid}")
+            fs_mp3s.delete(mp3_fid)
+            return None, None
 
         # Add MP3 file ID to the message
         message["audio_file_id"] = str(mp3_fid)
+        return message, None
 
-        # Publish the updated message to RabbitMQ
-        channel.basic_publish(
-            exchange="",
-            routing_key=os.environ.get("MP3_QUEUE", "mp3"),
-            body=json.dumps(message),
-            properties=pika.BasicProperties(
-                delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE
-            ),
-        )
+    except ledger_store.LedgerBusy as err:
+        # Expected while a redelivered copy overlaps the original; it waits out the claim instead of retrying
+        logger.warning(str(err))
+        return None, {"status": False, "message": str(err), "busy_for": err.retry_after}
+    except Exception as err:
+        logger.error(f"Error occurred: {str(err)}", exc_info=True)
+        if owner is not None:
+            ledger_store.release(ledger, video_fid, owner)
+        return None, {"status": False, "message": str(err)}
+
+
+def _publish_mp3(message, publisher):
+    # Raises PublishError if the broker rejects the message
+    return publisher.publish_and_wait(os.environ.get("MP3_QUEUE", "mp3"), json.dumps(message))
+
+
+def publish(message, publisher, content_index=None, jobs=None, mp3_files=None, video_files=None, ledger=None):
+    """
+    Publishes the converted message to the mp3 queue and waits for the broker's confirm.
+
+    Users who uploaded the same content while it was converting are notified
+    with their own copy of the message. Everyone who uploaded the content is
+    added to the MP3's owners in `mp3_files`, so it shows up in their listing.
+    The source video is scheduled for deletion in `video_files`. The
+    conversion is recorded as published in `ledger` once all of this is done.
+
+    A message split into segments publishes its segment messages instead.
+    """
+    if message.get("segments"):
+        segments.fan_out(message["segments"], publisher)
+        return
+
+    mp3_fid = ObjectId(message["audio_file_id"])
+    if message.get("deduplicated"):
+        # The MP3 belongs to an earlier conversion of the same content; sharing it restarts its expiry
+        mp3_metadata.add_owners(mp3_files, mp3_fid, [message.get("username")])
+
+    if _publish_mp3(message, publisher):
         logger.info("Message successfully published to RabbitMQ.")
+    else:
+        logger.warning("Message not confirmed in time; it will be delivered from the outbox.")
+    job_store.mark_done(jobs, message.get("job_id"), message["audio_file_id"])
 
-        # return {"status": True, "message": "Video processed successfully", "details": message}
+    lifecycle.mark_source_converted(video_files, ObjectId(message["video_file_id"]))
 
+    sha256 = message.get("content_sha256")
+    if content_index is not None and sha256 and not message.get("deduplicated"):
+        _notify_waiters(message, publisher, content_index, jobs, mp3_files, sha256, mp3_fid)
+    ledger_store.mark_published(ledger, message["video_file_id"], mp3_fid)
+
+
+def _notify_waiters(message, publisher, content_index, jobs, mp3_files, sha256, mp3_fid):
+    waiters = dedup.complete(content_index, sha256, mp3_fid)
+    mp3_metadata.add_owners(mp3_files, mp3_fid, [waiter.get("username") for waiter in waiters])
+    for waiter in waiters:
+        try:
+            _publish_mp3({**message, **waiter}, publisher)
+            job_store.mark_done(jobs, waiter.get("job_id"), message["audio_file_id"])
+            logger.info(f"Notified duplicate uploader {waiter.get('username')} of MP3 {message['audio_file_id']}")
+        except Exception as err:
+            logger.error(f"Failed to notify duplicate uploader {waiter.get('username')}: {err}", exc_info=True)
+
+
+def rollback(message, fs_mp3s, ledger=None):
+    """
+    Deletes the stored MP3 of a message whose publish failed.
+    """
+    if message.get("deduplicated"):
+        # The MP3 belongs to an earlier conversion of the same content
+        return
+    if message.get("segments") or message.get("segmented"):
+        # Nothing stored yet, or a merged MP3 that the segment plan hands out again on retry
+        return
+    if ledger is not None:
+        # The ledger records the MP3 as stored and hands it out again on retry
+        return
+    try:
+        fs_mp3s.delete(ObjectId(message["audio_file_id"]))
+        logger.warning(f"Rolled back MP3 file with ID: {message['audio_file_id']}")
     except Exception as err:
-        logger.error(f"Error occurred: {str(err)}", exc_info=True)
+        logger.error(f"Failed to roll back MP3 file {message['audio_file_id']}: {err}", exc_info=True)
 
-        # Rollback MP3 file if already stored
-        if mp3_fid:
-            fs_mp3s.delete(mp3_fid)
-            logger.warning(f"Rolled back MP3 file with ID: {mp3_fid}")
 
-        return {"status": False, "message": str(err)}
+def start(message, fs_videos, fs_mp3s, publisher, content_index=None, jobs=None, mp3_files=None, video_files=None,
+          segment_plans=None, ledger=None):
+    """
+    Converts a video file to MP3 format, stores the audio in MongoDB, and publishes a message to RabbitMQ.
+
+    Parameters:
+    - message (bytes): JSON-encoded message from RabbitMQ.
+    - fs_videos (gridfs.GridFS): GridFS instance for accessing video files.
+    - fs_mp3s (gridfs.GridFS): GridFS instance for storing MP3 files.
+    - publisher (publisher.Publisher): Confirming publisher for the mp3 queue.
+    - content_index (pymongo.collection.Collection): Optional content-hash index shared with the gateway.
+    - jobs (pymongo.collection.Collection): Optional job collection shared with the gateway.
+    - mp3_files (pymongo.collection.Collection): Optional GridFS files collection of the MP3 database.
+    - video_files (pymongo.collection.Collection): Optional GridFS files collection of the video database.
+    - segment_plans (pymongo.collection.Collection): Optional segment plans; None disables splitting.
+    - ledger (pymongo.collection.Collection): Optional conversion ledger.
+
+    Returns:
+    - dict: Error details on failure, None on success.
+    """
+    message, error = convert(message, fs_videos, fs_mp3s, content_index, jobs, segment_plans, ledger)
+    if error:
+        return error
+    if message is None:
+        # A segment whose merge is left to the worker finishing the last one, or a finished redelivery
+        return None
 
-    finally:
-        # Cleanup temporary files
-        if temp_video_path and os.path.exists(temp_video_path):
-            os.remove(temp_video_path)
-            logger.info(f"Cleaned up temporary video file: {temp_video_path}")
-        if temp_audio_path and os.path.exists(temp_audio_path):
-            os.remove(temp_audio_path)
-            logger.info(f"Cleaned up temporary audio file: {temp_audio_path}")
+    try:
+        # Publish the updated message to RabbitMQ
+        publish(message, publisher, content_index, jobs, mp3_files, video_files, ledger)
+    except Exception as err:
+        logger.error(f"Error occurred: {str(err)}", exc_info=True)
+
+        # Rollback MP3 file as nobody will be told about it
+        rollback(message, fs_mp3s, ledger)
+        return {"status": False, "message": str(err)}
@@ -0,0 +1,90 @@
+"""
+Inspects and replays dead-lettered messages.
+
+    python dlq.py list video.dlq --limit 20
+    python dlq.py replay mp3.dlq --limit 100
+
+Listing leaves the messages in place. Replaying publishes each message back
+onto the queue it originally failed on with a fresh attempt counter.
+"""
+import argparse
+import json
+import sys
+import pika
+import retry
+from consumer import connect_rabbitmq
+
+
+def describe(method, properties, body):
+    headers = properties.headers or {}
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        payload = body.decode(errors="replace")
+    return {
+        "origin": headers.get(retry.ORIGIN_HEADER),
+        "attempts": headers.get(retry.ATTEMPT_HEADER),
+        "last_error": headers.get(retry.ERROR_HEADER),
+        "body": payload,
+    }
+
+
+def list_messages(channel, queue, limit):
+    count = 0
+    while count < limit:
+        method, properties, body = channel.basic_get(queue=queue, auto_ack=False)
+        if method is None:
+            break
+        print(json.dumps(describe(method, properties, body), default=str))
+        count += 1
+    # Unacked messages return to the queue when the channel closes
+    channel.close()
+    return count
+
+
+def replay_messages(channel, queue, limit):
+    count = 0
+    while count < limit:
+        method, properties, body = channel.basic_get(queue=queue, auto_ack=False)
+        if method is None:
+            break
+        headers = dict(properties.headers or {})
+        origin = headers.get(retry.ORIGIN_HEADER) or queue.removesuffix(".dlq")
+        headers[retry.ATTEMPT_HEADER] = 0
+        channel.basic_publish(
+            exchange="",
+            routing_key=origin,
+            body=body,
+            properties=pika.BasicProperties(
+                delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE,
+                content_type=properties.content_type,
+                headers=headers,
+            ),
+        )
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("action", choices=["list", "replay"])
+    parser.add_argument("queue", help="dead-letter queue, e.g. video.dlq or mp3.dlq")
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+
+    connection, channel = connect_rabbitmq()
+    try:
+        if args.action == "list":
+            count = list_messages(channel, args.queue, args.limit)
+            print(f"Listed {count} messages from {args.queue}", file=sys.stderr)
+        else:
+            count = replay_messages(channel, args.queue, args.limit)
+            print(f"Replayed {count} messages from {args.queue}", file=sys.stderr)
+    finally:
+        if connection.is_open:
+            connection.close()
+
+
+if __name__ == "__main__":
+    main()
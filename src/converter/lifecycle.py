@@ -0,0 +1,257 @@
+"""
+Garbage-collects converted source videos, expired MP3s and orphaned GridFS chunks.
+
+    python lifecycle.py sweep
+    python lifecycle.py sweep --dry-run --only videos mp3s
+
+Source videos are marked for deletion when their MP3 is published and
+removed LIFECYCLE_SOURCE_GRACE seconds later. MP3s are removed MP3_TTL_DAYS
+after they were stored (0 keeps them forever). Chunks whose file document is
+gone are removed once they are older than LIFECYCLE_ORPHAN_GRACE seconds.
+Segments of split conversions that were never merged are removed once their
+plan has expired (SEGMENT_PLAN_TTL).
+
+Deletions run in batches of LIFECYCLE_BATCH_SIZE files with a pause of
+LIFECYCLE_BATCH_PAUSE seconds in between, so a sweep never competes with live
+traffic for long. The reclaimed files and bytes are printed as JSON.
+"""
+import argparse
+import datetime
+import json
+import os
+import time
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+LIFECYCLE_SOURCE_GRACE = int(os.getenv("LIFECYCLE_SOURCE_GRACE", 60 * 60))  # seconds a converted video is kept
+MP3_TTL_DAYS = float(os.getenv("MP3_TTL_DAYS", 0))  # 0 keeps MP3s forever
+LIFECYCLE_ORPHAN_GRACE = int(os.getenv("LIFECYCLE_ORPHAN_GRACE", 24 * 60 * 60))  # covers GridIns still being written
+LIFECYCLE_SEGMENT_GRACE = int(os.getenv("SEGMENT_PLAN_TTL", 2 * 24 * 60 * 60))  # unmerged segments outlive their plan
+LIFECYCLE_BATCH_SIZE = int(os.getenv("LIFECYCLE_BATCH_SIZE", 100))
+LIFECYCLE_BATCH_PAUSE = float(os.getenv("LIFECYCLE_BATCH_PAUSE", 0.5))  # seconds between batches
+
+# GridFS files collections; their chunks live in fs.chunks of the same database
+FILES_COLLECTION = "fs.files"
+CHUNKS_COLLECTION = "fs.chunks"
+
+# Shared with the gateway's upload deduplication
+CONTENT_INDEX_COLLECTION = "content_index"
+CONTENT_STATE_DONE = "done"
+
+PHASES = ("videos", "mp3s", "segments", "chunks")
+
+
+def _now():
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+
+def mark_source_converted(video_files, video_fid, grace=LIFECYCLE_SOURCE_GRACE):
+    """
+    Schedules a source video for deletion now that its MP3 has been published.
+
+    Failures are logged and never fail the conversion; an unmarked video is only kept longer.
+    """
+    if video_files is None:
+        return
+    try:
+        video_files.update_one(
+            {"_id": video_fid},
+            {"$set": {"metadata.delete_after": _now() + datetime.timedelta(seconds=grace)}},
+        )
+    except Exception as e:
+        logger.error(f"Failed to mark video {video_fid} for deletion: {e}")
+
+
+def ensure_indexes(db_videos, db_mp3s):
+    db_videos[FILES_COLLECTION].create_index([("metadata.delete_after", ASCENDING)], sparse=True)
+    db_mp3s[FILES_COLLECTION].create_index([("uploadDate", ASCENDING)])
+    for db in (db_videos, db_mp3s):
+        db[CHUNKS_COLLECTION].create_index([("files_id", ASCENDING), ("n", ASCENDING)], unique=True)
+
+
+class Sweeper:
+    """
+    Deletes GridFS files in throttled batches and counts what was reclaimed.
+    """
+
+    def __init__(self, db_videos, db_mp3s, batch_size=LIFECYCLE_BATCH_SIZE, pause=LIFECYCLE_BATCH_PAUSE, dry_run=False):
+        self.db_videos = db_videos
+        self.db_mp3s = db_mp3s
+        self.batch_size = max(1, batch_size)
+        self.pause = pause
+        self.dry_run = dry_run
+        self.report = {phase: {"files": 0, "bytes": 0} for phase in PHASES}
+
+    def _throttle(self):
+        if self.pause > 0:
+            time.sleep(self.pause)
+
+    def _delete_file(self, db, file_id):
+        # Same order as GridFS.delete: the file document first, so readers stop finding it
+        if not self.dry_run:
+            db[FILES_COLLECTION].delete_one({"_id": file_id})
+            db[CHUNKS_COLLECTION].delete_many({"files_id": file_id})
+
+    def _sweep_files(self, phase, db, query, keep=None):
+        """
+        Deletes the files matching `query` batch by batch; `keep(batch)` returns ids to leave alone.
+        """
+        last_id = None
+        while True:
+            batch_query = dict(query)
+            if last_id is not None:
+                batch_query["_id"] = {"$gt": last_id}
+            batch = list(db[FILES_COLLECTION].find(batch_query, {"length": 1}).sort("_id", ASCENDING).limit(self.batch_size))
+            if not batch:
+                return
+            last_id = batch[-1]["_id"]
+            kept = keep(batch) if keep else set()
+            for doc in batch:
+                if doc["_id"] in kept:
+                    continue
+                try:
+                    self._delete_file(db, doc["_id"])
+                except Exception as e:
+                    logger.error(f"Failed to delete {phase} file {doc['_id']}: {e}")
+                    continue
+                self.report[phase]["files"] += 1
+                self.report[phase]["bytes"] += doc.get("length", 0)
+            self._throttle()
+
+    def sweep_videos(self):
+        """
+        Deletes source videos whose deletion date has passed.
+
+        A video that the content index still lists for content that is not
+        converted yet is kept: a deduplicated upload may be waiting on it.
+        """
+        content_index = self.db_videos[CONTENT_INDEX_COLLECTION]
+
+        def in_use(batch):
+            ids = [doc["_id"] for doc in batch]
+            entries = content_index.find(
+                {"video_file_id": {"$in": ids}, "state": {"$ne": CONTENT_STATE_DONE}}, {"video_file_id": 1}
+            )
+            return {entry["video_file_id"] for entry in entries}
+
+        self._sweep_files("videos", self.db_videos, {"metadata.delete_after": {"$lte": _now()}}, keep=in_use)
+
+    def sweep_mp3s(self, ttl_days=MP3_TTL_DAYS):
+        """
+        Deletes MP3s stored, and last shared, more than `ttl_days` ago.
+
+        An MP3 shared through upload deduplication is kept for `ttl_days` after
+        the last upload deduplicated onto it (`metadata.shared_at`), so a user
+        is never handed an MP3 that is about to expire.
+
+        Their content index entries go first, so an upload of the same content
+        is converted again instead of being pointed at a deleted MP3.
+        """
+        if ttl_days <= 0:
+            return
+        content_index = self.db_videos[CONTENT_INDEX_COLLECTION]
+        mp3_files = self.db_mp3s[FILES_COLLECTION]
+        cutoff = _now() - datetime.timedelta(days=ttl_days)
+
+        def forget_content(batch):
+            ids = [doc["_id"] for doc in batch]
+            if not self.dry_run:
+                content_index.delete_many({"mp3_file_id": {"$in": ids}})
+            # Shared again after the batch was read: the new owner keeps the MP3
+            return {doc["_id"] for doc in mp3_files.find({"_id": {"$in": ids}, "metadata.shared_at": {"$gte": cutoff}}, {"_id": 1})}
+
+        query = {"uploadDate": {"$lt": cutoff}, "metadata.shared_at": {"$not": {"$gte": cutoff}}}
+        self._sweep_files("mp3s", self.db_mp3s, query, keep=forget_content)
+
+    def sweep_segments(self, grace=LIFECYCLE_SEGMENT_GRACE):
+        """
+        Deletes segment files of split conversions that were abandoned before the merge.
+        """
+        cutoff = _now() - datetime.timedelta(seconds=grace)
+        query = {"metadata.segment_of": {"$exists": True}, "uploadDate": {"$lt": cutoff}}
+        self._sweep_files("segments", self.db_mp3s, query)
+
+    def sweep_orphan_chunks(self, grace=LIFECYCLE_ORPHAN_GRACE):
+        """
+        Deletes chunks whose file document no longer exists, e.g. after a crash mid-delete.
+
+        GridFS writes a file's document only when the file is closed, so chunks
+        of files created within `grace` seconds may still be in progress and are kept.
+        """
+        # File ids are ObjectIds, which start with their creation time
+        cutoff = ObjectId.from_datetime(_now() - datetime.timedelta(seconds=grace))
+        for db in (self.db_videos, self.db_mp3s):
+            chunks = db[CHUNKS_COLLECTION]
+            last_id = None
+            while True:
+                # One index seek per file on (files_id, n) rather than a scan of every chunk
+                ids = []
+                while len(ids) < self.batch_size:
+                    query = {"files_id": {"$lt": cutoff}}
+                    if last_id is not None:
+                        query["files_id"]["$gt"] = last_id
+                    chunk = chunks.find_one(query, {"files_id": 1}, sort=[("files_id", ASCENDING), ("n", ASCENDING)])
+                    if chunk is None:
+                        break
+                    last_id = chunk["files_id"]
+                    ids.append(last_id)
+                if not ids:
+                    break
+
+                existing = {doc["_id"] for doc in db[FILES_COLLECTION].find({"_id": {"$in": ids}}, {"_id": 1})}
+                for files_id in ids:
+                    if files_id in existing:
+                        continue
+                    # $binarySize needs MongoDB 4.4; orphans are rare enough to read their chunks instead
+                    sizes = [len(chunk["data"]) for chunk in chunks.find({"files_id": files_id}, {"data": 1})]
+                    found, size = len(sizes), sum(sizes)
+                    if not self.dry_run:
+                        chunks.delete_many({"files_id": files_id})
+                    logger.info(f"Orphaned file {files_id} in {db.name}: {found} chunks, {size} bytes")
+                    self.report["chunks"]["files"] += 1
+                    self.report["chunks"]["bytes"] += size
+                self._throttle()
+
+    def run(self, phases=PHASES):
+        started = time.monotonic()
+        if "videos" in phases:
+            self.sweep_videos()
+        if "mp3s" in phases:
+            self.sweep_mp3s()
+        if "segments" in phases:
+            self.sweep_segments()
+        if "chunks" in phases:
+            self.sweep_orphan_chunks()
+        report = {
+            **self.report,
+            "reclaimed_bytes": sum(self.report[phase]["bytes"] for phase in PHASES),
+            "dry_run": self.dry_run,
+            "seconds": round(time.monotonic() - started, 1),
+        }
+        logger.info(f"Lifecycle sweep: {json.dumps(report)}")
+        return report
+
+
+def main():
+    from consumer import initialize_mongo_client
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("action", choices=["sweep"])
+    parser.add_argument("--only", nargs="+", choices=PHASES, default=list(PHASES))
+    parser.add_argument("--dry-run", action="store_true", help="report what would be deleted without deleting it")
+    args = parser.parse_args()
+
+    mongo_uri = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+    db_videos, _ = initialize_mongo_client(mongo_uri, os.getenv("UPLOAD_FOLDER", "videos-db"))
+    db_mp3s, _ = initialize_mongo_client(mongo_uri, os.getenv("DOWNLOAD_FOLDER", "mp3-db"))
+    ensure_indexes(db_videos, db_mp3s)
+
+    report = Sweeper(db_videos, db_mp3s, dry_run=args.dry_run).run(args.only)
+    print(json.dumps(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import collections
+import json
+import math
+import os
+import time
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Conversion lanes published by the gateway, highest priority first. 'video' keeps its
+# original declaration, so existing deployments need no queue migration.
+LANE_PRIORITY = os.getenv("LANE_PRIORITY_QUEUE", "video.priority")
+LANE_DEFAULT = os.getenv("VIDEO_QUEUE", "video")
+LANE_BULK = os.getenv("LANE_BULK_QUEUE", "video.bulk")
+LANES = (LANE_PRIORITY, LANE_DEFAULT, LANE_BULK)
+
+# Share of the workers each lane gets under contention (weighted deficit round robin);
+# the bulk lane is slowed down but never starved
+LANE_WEIGHTS = {
+    LANE_PRIORITY: int(os.getenv("LANE_PRIORITY_WEIGHT", 4)),
+    LANE_DEFAULT: int(os.getenv("LANE_DEFAULT_WEIGHT", 2)),
+    LANE_BULK: int(os.getenv("LANE_BULK_WEIGHT", 1)),
+}
+
+FAIR_USER_MAX_INFLIGHT = int(os.getenv("FAIR_USER_MAX_INFLIGHT", 2))  # conversions per user and consumer pod; 0 is unlimited
+FAIR_QUANTUM_BYTES = int(os.getenv("FAIR_QUANTUM_BYTES", 64 * 1024 * 1024))  # deficit a flow earns per round and weight
+
+Delivery = collections.namedtuple("Delivery", "queue method properties body user cost received")
+
+
+def delivery_for(queue, method, properties, body):
+    """
+    Wraps a RabbitMQ delivery with the user it belongs to and its scheduling cost.
+
+    The cost is the upload size in quanta (at least 1), split evenly across the
+    segments of a split video; messages without a size cost one quantum.
+    """
+    try:
+        message = json.loads(body)
+    except ValueError:
+        message = None
+    if not isinstance(message, dict):
+        message = {}
+    cost = 1
+    size = message.get("size")
+    if isinstance(size, (int, float)) and size > 0:
+        segment = message.get("segment")
+        if isinstance(segment, dict) and segment.get("count"):
+            size /= segment["count"]
+        cost = max(1, math.ceil(size / FAIR_QUANTUM_BYTES))
+    return Delivery(queue, method, properties, body, message.get("username") or "", cost, time.monotonic())
+
+
+class FairScheduler:
+    """
+    Orders buffered deliveries for the conversion pool with weighted deficit round robin.
+
+    Every (lane, user) pair is a flow. Flows take turns; each turn a flow earns
+    its lane's weight in quanta and is served while it can pay for its oldest
+    delivery, so a user's share of the workers does not grow with the number
+    or size of their uploads. A user with FAIR_USER_MAX_INFLIGHT conversions
+    running is skipped until one finishes.
+
+    Not thread-safe: the consumer only calls it from the connection thread.
+    """
+
+    def __init__(self, max_inflight=FAIR_USER_MAX_INFLIGHT, weights=None):
+        self.max_inflight = max_inflight
+        self.weights = weights or LANE_WEIGHTS
+        self._flows = {}
+        self._deficit = {}
+        self._turns = collections.deque()
+        self._granted = None  # the flow whose current turn has already earned its quantum
+        self.inflight = collections.Counter()
+        self.waiting = collections.Counter()
+
+    def __len__(self):
+        return sum(self.waiting.values())
+
+    def snapshot(self):
+        return {
+            "waiting": len(self),
+            "flows": len(self._flows),
+            "inflight_users": sum(1 for count in self.inflight.values() if count > 0),
+        }
+
+    def _quantum(self, key):
+        return max(1, self.weights.get(key[0], 1))
+
+    def _eligible(self, key):
+        return self.max_inflight <= 0 or self.inflight[key[1]] < self.max_inflight
+
+    def add(self, delivery):
+        key = (delivery.queue, delivery.user)
+        flow = self._flows.get(key)
+        if flow is None:
+            flow = self._flows[key] = collections.deque()
+            self._deficit[key] = 0
+            self._turns.append(key)
+        flow.append(delivery)
+        self.waiting[delivery.user] += 1
+
+    def next(self):
+        """
+        Returns the next delivery to convert, or None if nothing may start now.
+        """
+        eligible = [key for key in self._turns if self._eligible(key)]
+        if not eligible:
+            return None
+        # Skip the rounds in which no eligible flow could pay for its oldest delivery
+        rounds = min(math.ceil((self._flows[key][0].cost - self._deficit[key]) / self._quantum(key)) for key in eligible)
+        if rounds > 1:
+            for key in eligible:
+                self._deficit[key] += (rounds - 1) * self._quantum(key)
+
+        while True:
+            key = self._turns[0]
+            if self._eligible(key):
+                if self._granted != key:
+                    self._deficit[key] += self._quantum(key)
+                    self._granted = key
+                flow = self._flows[key]
+                if self._deficit[key] >= flow[0].cost:
+                    delivery = flow.popleft()
+                    self._deficit[key] -= delivery.cost
+                    if not flow:
+                        # An idle flow does not bank credit for later
+                        del self._flows[key], self._deficit[key]
+                        self._turns.popleft()
+                        self._granted = None
+                    self.waiting[delivery.user] -= 1
+                    if self.waiting[delivery.user] <= 0:
+                        del self.waiting[delivery.user]
+                    self.inflight[delivery.user] += 1
+                    return delivery
+            self._turns.rotate(-1)
+            self._granted = None
+
+    def done(self, delivery):
+        self.inflight[delivery.user] -= 1
+        if self.inflight[delivery.user] <= 0:
+            del self.inflight[delivery.user]
@@ -0,0 +1,15 @@
+import os
+import sys
+import mongomock
+import mongomock.gridfs
+import pytest
+
+# The converter's modules import each other from the service directory, as they do in the image
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+mongomock.gridfs.enable_gridfs_integration()
+
+
+@pytest.fixture
+def client():
+    return mongomock.MongoClient()
@@ -0,0 +1,76 @@
+import json
+import types
+import mongomock
+import pytest
+
+# consumer imports the MoviePy engine, which needs moviepy 1.x from requirements.txt
+pytest.importorskip("moviepy.editor")
+
+import consumer
+import retry
+from convert import dedup, jobs as job_store, ledger as ledger_store, to_mp3
+
+QUEUE = "video"
+
+
+class Channel:
+    """
+    Records what the consumer publishes, acks and nacks.
+    """
+
+    def __init__(self):
+        self.published = []
+        self.acked = []
+        self.nacked = []
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append((routing_key, body, properties))
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    def basic_nack(self, delivery_tag, requeue):
+        self.nacked.append(delivery_tag)
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient()["videos-db"]
+
+
+def test_busy_redelivery_waits_out_the_claim_without_an_attempt(db):
+    ledger = db[ledger_store.LEDGER_COLLECTION]
+    jobs = db[job_store.JOBS_COLLECTION]
+    content_index = db[dedup.CONTENT_INDEX_COLLECTION]
+    job_id = jobs.insert_one({"state": job_store.STATE_CONVERTING, "attempts": 0}).inserted_id
+    content_index.insert_one({"_id": "sha", "state": "queued", "waiters": [{"job_id": "waiter"}]})
+    # The pod converting the video died holding its claim, and RabbitMQ redelivered the message
+    ledger_store.claim(ledger, "video-id", "dead-pod")
+    body = json.dumps({"video_file_id": "video-id", "job_id": str(job_id), "content_sha256": "sha"})
+    properties = types.SimpleNamespace(headers={retry.ATTEMPT_HEADER: retry.RETRY_MAX_ATTEMPTS - 1}, content_type=None)
+
+    message, error = to_mp3.convert(body, None, None, content_index, jobs, ledger=ledger)
+    assert message is None
+    channel = Channel()
+    consumer.fail(channel, QUEUE, 7, properties, body, error, content_index, jobs)
+
+    [(target, _, sent)] = channel.published
+    assert target == retry.deferred_queue_name(QUEUE)
+    assert int(sent.expiration) >= ledger_store.LEDGER_LEASE * 1000 - 5000
+    assert sent.headers[retry.ATTEMPT_HEADER] == retry.RETRY_MAX_ATTEMPTS - 1
+    assert channel.acked == [7]
+    assert jobs.find_one({"_id": job_id})["state"] == job_store.STATE_CONVERTING
+    assert content_index.find_one({"_id": "sha"})["state"] == "queued"
+
+
+def test_failure_on_the_last_attempt_is_dead_lettered(db):
+    jobs = db[job_store.JOBS_COLLECTION]
+    job_id = jobs.insert_one({"state": job_store.STATE_CONVERTING}).inserted_id
+    body = json.dumps({"video_file_id": "video-id", "job_id": str(job_id)})
+    properties = types.SimpleNamespace(headers={retry.ATTEMPT_HEADER: retry.RETRY_MAX_ATTEMPTS - 1}, content_type=None)
+    channel = Channel()
+
+    consumer.fail(channel, QUEUE, 7, properties, body, {"status": False, "message": "ffmpeg failed"}, None, jobs)
+
+    assert channel.published[0][0] == retry.dead_letter_queue_name(QUEUE)
+    assert jobs.find_one({"_id": job_id})["state"] == job_store.STATE_FAILED
@@ -0,0 +1,161 @@
+import gridfs
+import pytest
+from convert import ffmpeg_engine
+from convert.ffmpeg_engine import ConversionError, FrameSlicer, mp3_frame_length
+
+# MPEG-1 Layer III, 192 kbit/s, 44.1 kHz, without and with the padding slot
+HEADER = bytes([0xFF, 0xFB, 0xB0, 0x00])
+PADDED_HEADER = bytes([0xFF, 0xFB, 0xB2, 0x00])
+FRAME_LENGTH = 626  # 144000 * 192 // 44100
+
+
+def frame(label, padded=False):
+    header = PADDED_HEADER if padded else HEADER
+    length = FRAME_LENGTH + (1 if padded else 0)
+    return header + bytes([label]) + b"\0" * (length - 5)
+
+
+@pytest.mark.parametrize("header, length", [
+    (HEADER, FRAME_LENGTH),
+    (PADDED_HEADER, FRAME_LENGTH + 1),
+    (bytes([0xFF, 0xFB, 0x90, 0x00]), 417),  # 128 kbit/s, 44.1 kHz
+    (bytes([0xFF, 0xFB, 0x94, 0x00]), 384),  # 128 kbit/s, 48 kHz
+    (bytes([0xFF, 0xFA, 0xE8, 0x00]), 1440),  # 320 kbit/s, 32 kHz, no CRC protection bit
+])
+def test_frame_length(header, length):
+    assert mp3_frame_length(header) == length
+
+
+@pytest.mark.parametrize("header", [
+    b"ID3\x04",  # tag, not a frame
+    bytes([0xFF, 0xF3, 0xB0, 0x00]),  # MPEG-2
+    bytes([0xFF, 0xFD, 0xB0, 0x00]),  # Layer II
+    bytes([0xFF, 0xFB, 0x00, 0x00]),  # free bitrate
+    bytes([0xFF, 0xFB, 0xF0, 0x00]),  # bad bitrate
+    bytes([0xFF, 0xFB, 0xBC, 0x00]),  # reserved sample rate
+])
+def test_frame_length_rejects_other_data(header):
+    assert mp3_frame_length(header) is None
+
+
+def test_slicer_keeps_the_requested_frames_across_chunk_boundaries():
+    stream = b"".join(frame(i, padded=i % 3 == 0) for i in range(10))
+    written = []
+    slicer = FrameSlicer(written.append, skip=2, count=5)
+
+    # Chunks that split headers and frames anywhere
+    for start in range(0, len(stream), 97):
+        slicer.feed(stream[start:start + 97])
+
+    kept = b"".join(written)
+    assert [kept_frame[4] for kept_frame in split_frames(kept)] == [2, 3, 4, 5, 6]
+    assert (slicer.frames, slicer.kept) == (10, 5)
+
+
+def test_slicer_without_count_keeps_the_rest():
+    written = []
+    slicer = FrameSlicer(written.append, skip=8)
+    slicer.feed(b"".join(frame(i) for i in range(10)))
+
+    assert [kept_frame[4] for kept_frame in split_frames(b"".join(written))] == [8, 9]
+
+
+def test_slicer_rejects_garbage():
+    slicer = FrameSlicer(lambda data: None)
+    with pytest.raises(ConversionError):
+        slicer.feed(frame(0) + b"garbage!")
+
+
+def split_frames(data):
+    frames = []
+    while data:
+        length = mp3_frame_length(data[:4])
+        frames.append(data[:length])
+        data = data[length:]
+    return frames
+
+
+MP4_HEAD = (16).to_bytes(4, "big") + b"ftypisom" + b"\0" * 4 + (8).to_bytes(4, "big") + b"moov"
+MKV_HEAD = b"\x1a\x45\xdf\xa3" + b"\0" * 60
+
+
+class Calls(list):
+    frames = 0
+
+
+@pytest.fixture
+def transcode(monkeypatch):
+    """
+    Replaces ffmpeg: records the command and emits `frames` frames of the segment.
+    """
+    calls = Calls()
+
+    def fake_transcode(command, video_file, head, write, *args):
+        calls.append(command)
+        for i in range(calls.frames):
+            write(frame(i % 256))
+
+    monkeypatch.setattr(ffmpeg_engine, "_transcode", fake_transcode)
+    monkeypatch.setattr(ffmpeg_engine, "probe_audio_start", lambda head: 0.478)
+    return calls
+
+
+@pytest.fixture
+def stores(client):
+    return gridfs.GridFS(client["videos-db"]), gridfs.GridFS(client["mp3-db"])
+
+
+def encode(stores, head, first_frame, frames):
+    fs_videos, fs_mp3s = stores
+    video_fid = fs_videos.put(head + b"\0" * 1000)
+    return ffmpeg_engine.encode_segment(fs_videos, fs_mp3s, str(video_fid), first_frame, frames)
+
+
+def filter_of(command):
+    return command[command.index("-af") + 1]
+
+
+def test_segment_of_an_mp4_seeks_to_its_span(stores, transcode):
+    transcode.frames = 102
+
+    # Frames 1002-1101, encoded from frame 1000 (sample 1152000, 26.1s) with two warm-up frames
+    _, kept = encode(stores, MP4_HEAD, 1002, 100)
+
+    [command] = transcode
+    seek_seconds = 26 - ffmpeg_engine.SEGMENT_SEEK_MARGIN
+    assert command[command.index("-ss") + 1] == f"{0.478 + seek_seconds:.6f}"
+    assert command.index("-ss") < command.index("-i")
+    start = 1152000 - seek_seconds * 44100
+    assert f"atrim=start_sample={start}:end_sample={start + 104 * 1152}" in filter_of(command)
+    assert kept == 100
+
+
+def test_segment_of_a_matroska_file_is_trimmed_without_seeking(stores, transcode):
+    transcode.frames = 102
+
+    encode(stores, MKV_HEAD, 1002, 100)
+
+    [command] = transcode
+    assert "-ss" not in command
+    assert f"atrim=start_sample={1000 * 1152}:end_sample={1104 * 1152}" in filter_of(command)
+
+
+def test_early_segment_is_not_seeked(stores, transcode):
+    transcode.frames = 10
+
+    encode(stores, MP4_HEAD, 0, 10)
+
+    [command] = transcode
+    assert "-ss" not in command
+    assert "atrim=start_sample=0:" in filter_of(command)
+
+
+def test_segment_without_known_audio_start_is_not_seeked(stores, transcode, monkeypatch):
+    monkeypatch.setattr(ffmpeg_engine, "probe_audio_start", lambda head: None)
+    transcode.frames = 10
+
+    encode(stores, MP4_HEAD, 100000, None)
+
+    [command] = transcode
+    assert "-ss" not in command
+    assert filter_of(command).endswith(f"atrim=start_sample={99998 * 1152},asetpts=PTS-STARTPTS")
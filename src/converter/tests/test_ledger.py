@@ -0,0 +1,104 @@
+import datetime
+import types
+import gridfs
+import pytest
+from convert import ledger as ledger_store
+
+LEASE = 60
+
+
+@pytest.fixture
+def ledger(client):
+    return client.test[ledger_store.LEDGER_COLLECTION]
+
+
+@pytest.fixture
+def fs_mp3s(client):
+    return gridfs.GridFS(client.test, collection="mp3s")
+
+
+def expire(ledger, video_fid):
+    past = ledger_store._now() - datetime.timedelta(seconds=1)
+    ledger.update_one({"_id": video_fid}, {"$set": {"lease_until": past}})
+
+
+def test_first_claim_converts(ledger):
+    entry = ledger_store.claim(ledger, "video", "worker-a", lease=LEASE)
+
+    assert entry["state"] == ledger_store.STATE_CLAIMED
+    assert entry["owner"] == "worker-a"
+    assert entry["attempts"] == 1
+
+
+def test_live_claim_is_busy_for_others(ledger):
+    ledger_store.claim(ledger, "video", "worker-a", lease=LEASE)
+
+    with pytest.raises(ledger_store.LedgerBusy) as busy:
+        ledger_store.claim(ledger, "video", "worker-b", lease=LEASE)
+    assert LEASE - 5 < busy.value.retry_after <= LEASE
+    # The owner's own redelivery carries on
+    assert ledger_store.claim(ledger, "video", "worker-a", lease=LEASE)["owner"] == "worker-a"
+
+
+def test_expired_claim_is_taken_over(ledger):
+    ledger_store.claim(ledger, "video", "worker-a", lease=LEASE)
+    expire(ledger, "video")
+
+    entry = ledger_store.claim(ledger, "video", "worker-b", lease=LEASE)
+
+    assert entry["owner"] == "worker-b"
+    assert entry["attempts"] == 2
+    assert not ledger_store.mark_stored(ledger, "video", "worker-a", "mp3")
+
+
+def test_take_over_finds_an_unrecorded_mp3(ledger, fs_mp3s):
+    ledger_store.claim(ledger, "video", "worker-a", lease=LEASE)
+    mp3_fid = fs_mp3s.put(b"mp3", metadata={"video_file_id": "video"})
+    expire(ledger, "video")
+
+    entry = ledger_store.claim(ledger, "video", "worker-b", fs_mp3s, lease=LEASE)
+
+    assert entry["state"] == ledger_store.STATE_STORED
+    assert entry["audio_file_id"] == mp3_fid
+
+
+def test_stored_and_published_entries_are_returned(ledger):
+    ledger_store.claim(ledger, "video", "worker-a", lease=LEASE)
+    assert ledger_store.mark_stored(ledger, "video", "worker-a", "mp3")
+
+    assert ledger_store.claim(ledger, "video", "worker-b", lease=LEASE)["state"] == ledger_store.STATE_STORED
+
+    ledger_store.mark_published(ledger, "video", "mp3")
+    entry = ledger_store.claim(ledger, "video", "worker-b", lease=LEASE)
+    assert entry["state"] == ledger_store.STATE_PUBLISHED
+    assert "lease_until" not in entry
+
+
+def test_keep_alive_extends_the_lease(ledger, monkeypatch):
+    clock = types.SimpleNamespace(now=0.0)
+    monkeypatch.setattr(ledger_store, "time", types.SimpleNamespace(monotonic=lambda: clock.now))
+    ledger_store.claim(ledger, "video", "worker-a", lease=LEASE)
+    expire(ledger, "video")
+    reported = []
+    report = ledger_store.keep_alive(ledger, "video", "worker-a", reported.append, lease=LEASE)
+
+    expired = ledger.find_one({"_id": "video"})["lease_until"]
+
+    report(10.0)
+    assert ledger.find_one({"_id": "video"})["lease_until"] == expired
+
+    clock.now += LEASE / 3
+    report(20.0)
+    assert reported == [10.0, 20.0]
+    with pytest.raises(ledger_store.LedgerBusy):
+        ledger_store.claim(ledger, "video", "worker-b", lease=LEASE)
+
+
+def test_release_lets_the_retry_claim_at_once(ledger):
+    ledger_store.claim(ledger, "video", "worker-a", lease=LEASE)
+    ledger_store.release(ledger, "video", "worker-b")
+    assert ledger.find_one({"_id": "video"}) is not None
+
+    ledger_store.release(ledger, "video", "worker-a")
+
+    assert ledger_store.claim(ledger, "video", "worker-b", lease=LEASE)["owner"] == "worker-b"
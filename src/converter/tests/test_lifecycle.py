@@ -0,0 +1,136 @@
+import datetime
+import gridfs
+import pytest
+from bson.objectid import ObjectId
+import lifecycle
+
+OLD = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+@pytest.fixture
+def db_videos(client):
+    return client["videos-db"]
+
+
+@pytest.fixture
+def db_mp3s(client):
+    return client["mp3-db"]
+
+
+@pytest.fixture
+def sweeper(db_videos, db_mp3s):
+    return lifecycle.Sweeper(db_videos, db_mp3s, batch_size=2, pause=0)
+
+
+def stored(db, data=b"data", **fields):
+    file_id = gridfs.GridFS(db).put(data)
+    if fields:
+        db[lifecycle.FILES_COLLECTION].update_one({"_id": file_id}, {"$set": fields})
+    return file_id
+
+
+def exists(db, file_id):
+    return gridfs.GridFS(db).exists(file_id)
+
+
+def test_converted_videos_are_deleted_after_their_grace(sweeper, db_videos):
+    due = [stored(db_videos, **{"metadata.delete_after": OLD}) for _ in range(3)]
+    later = stored(db_videos, **{"metadata.delete_after": lifecycle._now() + datetime.timedelta(hours=1)})
+    unmarked = stored(db_videos)
+
+    sweeper.sweep_videos()
+
+    assert not any(exists(db_videos, file_id) for file_id in due)
+    assert db_videos[lifecycle.CHUNKS_COLLECTION].count_documents({"files_id": {"$in": due}}) == 0
+    assert exists(db_videos, later) and exists(db_videos, unmarked)
+    assert sweeper.report["videos"] == {"files": 3, "bytes": 12}
+
+
+def test_video_of_content_still_converting_is_kept(sweeper, db_videos):
+    waiting = stored(db_videos, **{"metadata.delete_after": OLD})
+    converted = stored(db_videos, **{"metadata.delete_after": OLD})
+    content_index = db_videos[lifecycle.CONTENT_INDEX_COLLECTION]
+    content_index.insert_many([
+        {"_id": "a", "video_file_id": waiting, "state": "queued"},
+        {"_id": "b", "video_file_id": converted, "state": lifecycle.CONTENT_STATE_DONE},
+    ])
+
+    sweeper.sweep_videos()
+
+    assert exists(db_videos, waiting)
+    assert not exists(db_videos, converted)
+
+
+def test_expired_mp3s_and_their_content_entries_are_deleted(sweeper, db_videos, db_mp3s):
+    expired = stored(db_mp3s, uploadDate=OLD)
+    fresh = stored(db_mp3s)
+    content_index = db_videos[lifecycle.CONTENT_INDEX_COLLECTION]
+    content_index.insert_many([{"_id": "a", "mp3_file_id": expired}, {"_id": "b", "mp3_file_id": fresh}])
+
+    sweeper.sweep_mp3s(ttl_days=30)
+
+    assert not exists(db_mp3s, expired)
+    assert exists(db_mp3s, fresh)
+    assert [entry["_id"] for entry in content_index.find()] == ["b"]
+
+
+def test_mp3s_are_kept_for_the_ttl_after_they_were_last_shared(sweeper, db_videos, db_mp3s):
+    shared = stored(db_mp3s, uploadDate=OLD, **{"metadata.shared_at": lifecycle._now()})
+    shared_long_ago = stored(db_mp3s, uploadDate=OLD, **{"metadata.shared_at": OLD})
+    content_index = db_videos[lifecycle.CONTENT_INDEX_COLLECTION]
+    content_index.insert_many([{"_id": "a", "mp3_file_id": shared}, {"_id": "b", "mp3_file_id": shared_long_ago}])
+
+    sweeper.sweep_mp3s(ttl_days=30)
+
+    assert exists(db_mp3s, shared)
+    assert not exists(db_mp3s, shared_long_ago)
+    assert [entry["_id"] for entry in content_index.find()] == ["a"]
+
+
+def test_mp3s_are_kept_forever_by_default(sweeper, db_mp3s):
+    expired = stored(db_mp3s, uploadDate=OLD)
+
+    sweeper.sweep_mp3s(ttl_days=0)
+
+    assert exists(db_mp3s, expired)
+
+
+def test_abandoned_segments_are_deleted(sweeper, db_mp3s):
+    abandoned = stored(db_mp3s, uploadDate=OLD, **{"metadata.segment_of": "video"})
+    recent = stored(db_mp3s, **{"metadata.segment_of": "video"})
+    merged = stored(db_mp3s, uploadDate=OLD)
+
+    sweeper.sweep_segments()
+
+    assert not exists(db_mp3s, abandoned)
+    assert exists(db_mp3s, recent) and exists(db_mp3s, merged)
+
+
+def test_orphaned_chunks_past_the_grace_are_deleted(sweeper, db_mp3s):
+    chunks = db_mp3s[lifecycle.CHUNKS_COLLECTION]
+    orphan = ObjectId.from_datetime(OLD)
+    in_progress = ObjectId()
+    chunks.insert_many([
+        {"files_id": orphan, "n": 0, "data": b"abc"},
+        {"files_id": orphan, "n": 1, "data": b"de"},
+        {"files_id": in_progress, "n": 0, "data": b"f"},
+    ])
+    complete = gridfs.GridFS(db_mp3s).put(b"ghi", _id=ObjectId.from_datetime(OLD - datetime.timedelta(days=1)))
+
+    sweeper.sweep_orphan_chunks()
+
+    assert chunks.count_documents({"files_id": orphan}) == 0
+    assert chunks.count_documents({"files_id": in_progress}) == 1
+    assert exists(db_mp3s, complete)
+    assert sweeper.report["chunks"] == {"files": 1, "bytes": 5}
+
+
+def test_dry_run_reports_without_deleting(db_videos, db_mp3s):
+    video = stored(db_videos, **{"metadata.delete_after": OLD})
+    sweeper = lifecycle.Sweeper(db_videos, db_mp3s, pause=0, dry_run=True)
+
+    report = sweeper.run(["videos"])
+
+    assert exists(db_videos, video)
+    assert report["videos"] == {"files": 1, "bytes": 4}
+    assert report["dry_run"]
@@ -0,0 +1,107 @@
+import collections
+import json
+import pytest
+import scheduler
+from scheduler import FairScheduler
+
+PRIORITY, DEFAULT, BULK = scheduler.LANES
+WEIGHTS = {PRIORITY: 4, DEFAULT: 2, BULK: 1}
+
+
+def delivery(user, queue=DEFAULT, size=None, **fields):
+    body = json.dumps({"username": user, "size": size, **fields})
+    return scheduler.delivery_for(queue, None, None, body)
+
+
+def drain(fair, finish=True):
+    order = []
+    while True:
+        item = fair.next()
+        if item is None:
+            return order
+        order.append(item)
+        if finish:
+            fair.done(item)
+
+
+def test_cost_is_size_in_quanta(monkeypatch):
+    monkeypatch.setattr(scheduler, "FAIR_QUANTUM_BYTES", 100)
+
+    assert delivery("a").cost == 1
+    assert delivery("a", size=250).cost == 3
+    assert delivery("a", size=1000, segment={"index": 0, "count": 4}).cost == 3
+    assert scheduler.delivery_for(DEFAULT, None, None, b"not json").user == ""
+
+
+def test_users_take_turns_regardless_of_arrival():
+    fair = FairScheduler(max_inflight=0, weights={DEFAULT: 1})
+    for _ in range(3):
+        fair.add(delivery("alice"))
+    fair.add(delivery("bob"))
+
+    assert [item.user for item in drain(fair)] == ["alice", "bob", "alice", "alice"]
+
+
+def test_large_uploads_do_not_buy_a_larger_share():
+    fair = FairScheduler(max_inflight=0, weights=WEIGHTS)
+    big = [delivery("alice")._replace(cost=4) for _ in range(2)]
+    small = [delivery("bob") for _ in range(8)]
+    for item in big + small:
+        fair.add(item)
+
+    order = [item.user for item in drain(fair)]
+
+    # Each turn earns 2 quanta, so alice waits two turns per large file while bob converts two small ones a turn
+    assert order == ["bob", "bob", "alice", "bob", "bob", "bob", "bob", "alice", "bob", "bob"]
+
+
+def test_lane_weights_share_the_workers():
+    fair = FairScheduler(max_inflight=0, weights=WEIGHTS)
+    for _ in range(40):
+        fair.add(delivery("p", PRIORITY))
+        fair.add(delivery("b", BULK))
+
+    first = collections.Counter(item.queue for item in drain(fair)[:20])
+
+    assert first[PRIORITY] == 16
+    assert first[BULK] == 4
+
+
+def test_user_at_max_inflight_is_skipped_until_done():
+    fair = FairScheduler(max_inflight=1, weights=WEIGHTS)
+    fair.add(delivery("alice"))
+    fair.add(delivery("alice"))
+    fair.add(delivery("bob"))
+
+    started = drain(fair, finish=False)
+    assert sorted(item.user for item in started) == ["alice", "bob"]
+    assert fair.next() is None
+    assert fair.waiting["alice"] == 1
+
+    fair.done(started[0] if started[0].user == "alice" else started[1])
+    assert fair.next().user == "alice"
+    assert len(fair) == 0
+
+
+def test_idle_flow_does_not_bank_credit():
+    fair = FairScheduler(max_inflight=0, weights=WEIGHTS)
+    fair.add(delivery("alice"))
+    drain(fair)
+
+    fair.add(delivery("alice")._replace(cost=4))
+    fair.add(delivery("bob")._replace(cost=4))
+    first = fair.next()
+
+    assert fair._deficit.get((DEFAULT, first.user), 0) == 0
+    assert fair.snapshot()["flows"] == 1
+
+
+@pytest.mark.parametrize("count", [1, 5])
+def test_everything_added_comes_out(count):
+    fair = FairScheduler(max_inflight=2, weights=WEIGHTS)
+    added = [delivery(user, queue) for user in "abc" for queue in scheduler.LANES for _ in range(count)]
+    for item in added:
+        fair.add(item)
+
+    assert sorted(map(id, drain(fair))) == sorted(map(id, added))
+    assert not fair.inflight and not fair.waiting
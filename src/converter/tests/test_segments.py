@@ -0,0 +1,135 @@
+import datetime
+import types
+import gridfs
+import pytest
+from convert import ffmpeg_engine, segments
+
+LEASE = 30
+MESSAGE = {"video_file_id": "video", "username": "alice", "mp3_filename": "clip.mp3"}
+
+
+@pytest.fixture
+def fs(client):
+    return gridfs.GridFS(client.test, collection="mp3s")
+
+
+@pytest.fixture
+def plans(client):
+    return client.test.segment_plans
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Each reading of the clock is a third of the lease after the last, so every chunk renews
+    clock = types.SimpleNamespace(now=0.0)
+
+    def monotonic():
+        clock.now += LEASE / 3
+        return clock.now
+
+    monkeypatch.setattr(segments, "time", types.SimpleNamespace(monotonic=monotonic))
+    monkeypatch.setattr(ffmpeg_engine, "PIPE_CHUNK_SIZE", 4)
+    return clock
+
+
+def stored_plan(fs, plans, parts):
+    part_ids = [fs.put(data, filename=f"part{i}.mp3") for i, data in enumerate(parts)]
+    entry = {
+        "_id": "video",
+        "message": MESSAGE,
+        "segments": [{"index": i} for i in range(len(parts))],
+        "parts": {str(i): {"file_id": file_id, "frames": 10} for i, file_id in enumerate(part_ids)},
+        "completed": len(parts),
+        "state": segments.STATE_SEGMENTING,
+    }
+    plans.insert_one(entry)
+    return entry, part_ids
+
+
+def take_over_after(fs, plans, reads):
+    # Another worker claims the merge once this one has read `reads` chunks
+    read_count = {"n": 0}
+    get = fs.get
+
+    def get_part(file_id):
+        part = get(file_id)
+        read = part.read
+
+        def read_chunk(size=-1):
+            read_count["n"] += 1
+            if read_count["n"] == reads:
+                plans.update_one({"_id": "video"}, {"$set": {"merge_owner": "other"}})
+            return read(size)
+
+        part.read = read_chunk
+        return part
+
+    fs.get = get_part
+
+
+def test_merge_concatenates_parts_and_deletes_them(fs, plans, clock):
+    entry, part_ids = stored_plan(fs, plans, [b"first-part", b"second-part"])
+
+    merged = segments.merge(entry, fs, plans, lease=LEASE)
+
+    assert merged["state"] == segments.STATE_MERGED
+    assert fs.get(merged["audio_file_id"]).read() == b"first-partsecond-part"
+    assert not any(fs.exists(file_id) for file_id in part_ids)
+
+
+def test_merge_renews_its_lease_while_copying(fs, plans, clock):
+    entry, _ = stored_plan(fs, plans, [b"a" * 40])
+    renewals = []
+    update_one = plans.update_one
+
+    def recording_update(query, update):
+        renewals.append(update["$set"].get("merge_renewed_at"))
+        return update_one(query, update)
+
+    plans.update_one = recording_update
+    segments.merge(entry, fs, plans, lease=LEASE)
+
+    assert len(renewals) >= 10
+
+
+def test_merge_is_not_taken_over_while_renewed(fs, plans, clock):
+    entry, _ = stored_plan(fs, plans, [b"part"])
+    plans.update_one({"_id": "video"}, {"$set": {"merge_owner": "other", "merge_renewed_at": segments._now()}})
+
+    with pytest.raises(segments.SegmentError):
+        segments.merge(entry, fs, plans, lease=LEASE)
+
+
+def test_stale_merge_is_taken_over(fs, plans, clock):
+    entry, _ = stored_plan(fs, plans, [b"part"])
+    stale = segments._now() - datetime.timedelta(seconds=LEASE + 1)
+    plans.update_one({"_id": "video"}, {"$set": {"merge_owner": "other", "merge_renewed_at": stale}})
+
+    merged = segments.merge(entry, fs, plans, lease=LEASE)
+
+    assert merged["state"] == segments.STATE_MERGED
+
+
+def test_lost_lease_stops_the_copy_and_keeps_the_parts(fs, plans, clock):
+    entry, part_ids = stored_plan(fs, plans, [b"a" * 40])
+    take_over_after(fs, plans, reads=2)
+
+    with pytest.raises(segments.SegmentError):
+        segments.merge(entry, fs, plans, lease=LEASE)
+
+    assert all(fs.exists(file_id) for file_id in part_ids)
+    assert fs.find_one({"filename": "video.mp3"}) is None
+    assert plans.find_one({"_id": "video"})["merge_owner"] == "other"
+
+
+def test_lease_lost_after_the_copy_discards_the_output(fs, plans, clock):
+    entry, part_ids = stored_plan(fs, plans, [b"part"])
+    # The last read returns nothing, after which the lease is not renewed again
+    take_over_after(fs, plans, reads=2)
+
+    with pytest.raises(segments.SegmentError):
+        segments.merge(entry, fs, plans, lease=LEASE * 100)
+
+    assert plans.find_one({"_id": "video"})["state"] == segments.STATE_SEGMENTING
+    assert all(fs.exists(file_id) for file_id in part_ids)
+    assert fs.find_one({"filename": "video.mp3"}) is None
@@ -0,0 +1,87 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from convert import dedup, jobs as job_store, ledger as ledger_store, segments, to_mp3
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# GridFS handles of the current worker process, opened by init_worker
+_fs_videos = None
+_fs_mp3s = None
+_content_index = None
+_jobs = None
+_segment_plans = None
+_ledger = None
+
+
+def init_worker(mongo_uri, upload_folder, download_folder):
+    """
+    Process pool initializer: every worker opens its own MongoDB client after fork.
+    """
+    global _fs_videos, _fs_mp3s, _content_index, _jobs, _segment_plans, _ledger
+    from consumer import initialize_mongo_client
+
+    db_videos, _fs_videos = initialize_mongo_client(mongo_uri, upload_folder)
+    _content_index = db_videos[dedup.CONTENT_INDEX_COLLECTION]
+    _jobs = db_videos[job_store.JOBS_COLLECTION]
+    _segment_plans = db_videos[segments.SEGMENT_PLANS_COLLECTION]
+    _ledger = db_videos[ledger_store.LEDGER_COLLECTION]
+    _, _fs_mp3s = initialize_mongo_client(mongo_uri, download_folder)
+
+
+def run_conversion(body):
+    """
+    Converts one queue message inside a worker process.
+
+    Returns to_mp3.convert's (message, error) tuple; publishing is left to the
+    consumer process, which owns the RabbitMQ connections.
+    """
+    return to_mp3.convert(body, _fs_videos, _fs_mp3s, _content_index, _jobs, _segment_plans, _ledger)
+
+
+class ConversionPool:
+    """
+    Process pool that is rebuilt if a worker dies (e.g. killed by the OOM killer).
+    """
+
+    def __init__(self, workers, initargs):
+        self.workers = workers
+        self.initargs = initargs
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Workers are spawned rather than forked: the consumer already runs publisher threads
+                # whose locks a forked child could inherit in a held state
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_worker,
+                    initargs=self.initargs,
+                )
+                logger.info(f"Conversion pool started with {self.workers} workers")
+            return self._executor
+
+    def submit(self, body):
+        try:
+            return self._get_executor().submit(run_conversion, body)
+        except BrokenProcessPool:
+            self.reset()
+            return self._get_executor().submit(run_conversion, body)
+
+    def reset(self):
+        with self._lock:
+            if self._executor is not None:
+                logger.warning("Conversion pool is broken; restarting it")
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
@@ -0,0 +1,139 @@
+import collections
+import math
+import os
+import threading
+import time
+import pika
+import metrics
+from channel_pool import ChannelUnavailable, queue_stats
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Uploads are refused once the conversion backlog reaches the high watermark and admitted
+# again once it is back under the low one, so admission does not flap around a single limit
+ADMISSION_HIGH_WATERMARK = int(os.getenv("ADMISSION_HIGH_WATERMARK", 5000))  # messages waiting; 0 disables
+ADMISSION_LOW_WATERMARK = int(os.getenv("ADMISSION_LOW_WATERMARK", 4000))
+ADMISSION_PER_CONSUMER_WATERMARK = int(os.getenv("ADMISSION_PER_CONSUMER_WATERMARK", 500))  # 0 disables
+ADMISSION_CACHE_SECONDS = float(os.getenv("ADMISSION_CACHE_SECONDS", 2.0))  # how long a depth reading is reused
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", 30))  # seconds, at the high watermark
+ADMISSION_MAX_RETRY_AFTER = int(os.getenv("ADMISSION_MAX_RETRY_AFTER", 300))
+
+
+# retry_after is in seconds; both it and reason are only set when the request is refused
+Decision = collections.namedtuple("Decision", "admitted retry_after reason")
+
+ADMIT = Decision(True, 0, None)
+
+
+class AdmissionGate:
+    """
+    Decides whether a new upload is accepted, from the depth of the conversion queues.
+
+    The depth (messages ready) and consumer count are read with a passive
+    queue_declare through the channel pool, at most once every `cache_seconds`
+    per gateway process, so a burst of uploads costs one broker round trip.
+    Uploads are refused while the backlog is over the high watermark, or over
+    `per_consumer` messages per converter consumer, until it drains below the
+    low watermark. If the broker cannot be asked, uploads are admitted: the
+    publish itself then fails and rolls the upload back as before.
+    """
+
+    def __init__(
+        self,
+        pool,
+        queues,
+        high=ADMISSION_HIGH_WATERMARK,
+        low=ADMISSION_LOW_WATERMARK,
+        per_consumer=ADMISSION_PER_CONSUMER_WATERMARK,
+        cache_seconds=ADMISSION_CACHE_SECONDS,
+    ):
+        self.pool = pool
+        self.queues = tuple(queues)
+        self.high = high
+        self.per_consumer = per_consumer
+        # Share of the limit the backlog must drain to before uploads are admitted again;
+        # without a low watermark, uploads resume as soon as the backlog is under the limit
+        if high <= 0:
+            self.resume_ratio = 0.8
+        elif low <= 0:
+            self.resume_ratio = 1.0
+        else:
+            self.resume_ratio = min(low, high) / high
+        self.cache_seconds = cache_seconds
+        self._lock = threading.Lock()
+        self._read_at = None
+        self._depth = 0
+        self._consumers = 0
+        self._shedding = False
+        self._rejected = metrics.counter("admission_rejected_total")
+
+    def snapshot(self):
+        return {
+            "depth": self._depth,
+            "consumers": self._consumers,
+            "shedding": self._shedding,
+        }
+
+    def _read(self):
+        depth, consumers = 0, 0
+        with self.pool.channel() as ch:
+            for name in self.queues:
+                messages, queue_consumers = queue_stats(ch, name)
+                depth += messages
+                # Every converter consumes every lane, so the busiest lane counts the converters
+                consumers = max(consumers, queue_consumers)
+        return depth, consumers
+
+    def _limit(self):
+        limit = self.high
+        if self.per_consumer > 0:
+            per_consumer_limit = self.per_consumer * max(1, self._consumers)
+            limit = min(limit, per_consumer_limit) if limit > 0 else per_consumer_limit
+        return limit
+
+    def _update(self, depth, consumers):
+        self._depth, self._consumers = depth, consumers
+        limit = self._limit()
+        if self._depth >= limit:
+            if not self._shedding:
+                logger.warning(f"Refusing uploads: {self._depth} messages waiting for {self._consumers} consumers")
+            self._shedding = True
+        elif self._shedding and self._depth < limit * self.resume_ratio:
+            logger.info(f"Admitting uploads again: {self._depth} messages waiting")
+            self._shedding = False
+
+    def refresh(self):
+        """
+        Reads the queues unless the last reading is recent; only one request thread reads at a time.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._read_at is not None and now - self._read_at < self.cache_seconds:
+                return
+            # Stamped before reading, so other threads keep using the previous reading meanwhile
+            self._read_at = now
+        try:
+            depth, consumers = self._read()
+        except (ChannelUnavailable, pika.exceptions.AMQPError) as e:
+            logger.warning(f"Could not read conversion queue depth, admitting uploads: {e}")
+            with self._lock:
+                self._depth, self._consumers, self._shedding = 0, 0, False
+            return
+        with self._lock:
+            self._update(depth, consumers)
+
+    def check(self):
+        """
+        Returns a Decision; refused uploads carry a Retry-After in seconds that grows with the backlog.
+        """
+        if self.high <= 0 and self.per_consumer <= 0:
+            return ADMIT
+        self.refresh()
+        with self._lock:
+            if not self._shedding:
+                return ADMIT
+            self._rejected.inc()
+            overload = self._depth / max(1, self._limit())
+            retry_after = min(ADMISSION_MAX_RETRY_AFTER, math.ceil(ADMISSION_RETRY_AFTER * max(1.0, overload)))
+            return Decision(False, retry_after, "Conversion backlog is full, please retry later")
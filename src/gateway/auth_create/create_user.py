@@ -1,5 +1,5 @@
-import os
 import requests
+from auth_svc.client import auth_client, CircuitOpenError
 from logger import get_logger
 
 # Get logger instance
@@ -18,16 +18,9 @@ def create(request):
     if not credentials or not all(k in credentials for k in ["username", "password", "email"]):
         return None, ("Missing required fields: 'username', 'password', or 'email'", 400)
 
-    # Prepare the authentication service endpoint
-    auth_service_address = os.environ.get("AUTH_SVC_ADDRESS","127.0.0.1:5000")
-    if not auth_service_address:
-        return None, ("Authentication service address not configured", 500)
-
-    url = f"{auth_service_address}/create"
-    
     try:
         # Send a POST request to the authentication service with the JSON payload
-        response = requests.post(url, json=credentials)
+        response = auth_client.post("/create", json=credentials)
 
         # Check for successful creation
         if response.status_code == 200:
@@ -36,6 +29,8 @@ def create(request):
         # Handle authentication failure
         return None, (response.json().get("error", "Creation failed"), response.status_code)
 
+    except CircuitOpenError:
+        return None, ("Authentication service unavailable", 503)
     except requests.exceptions.ConnectionError:
         return None, ("Failed to connect to the authentication service", 500)
     except requests.exceptions.Timeout:
@@ -0,0 +1,150 @@
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Auth service client settings
+AUTH_POOL_SIZE = int(os.environ.get("AUTH_POOL_SIZE", 20))
+AUTH_CONNECT_TIMEOUT = float(os.environ.get("AUTH_CONNECT_TIMEOUT", 1.0))  # seconds
+AUTH_READ_TIMEOUT = float(os.environ.get("AUTH_READ_TIMEOUT", 5.0))  # seconds
+AUTH_MAX_RETRIES = int(os.environ.get("AUTH_MAX_RETRIES", 2))
+AUTH_RETRY_BACKOFF = float(os.environ.get("AUTH_RETRY_BACKOFF", 0.05))  # seconds, doubled per attempt
+AUTH_RETRY_BACKOFF_MAX = float(os.environ.get("AUTH_RETRY_BACKOFF_MAX", 1.0))  # seconds
+AUTH_BREAKER_FAILURES = int(os.environ.get("AUTH_BREAKER_FAILURES", 5))  # consecutive failures before opening
+AUTH_BREAKER_RESET = float(os.environ.get("AUTH_BREAKER_RESET", 30.0))  # seconds before a trial call
+
+RETRYABLE_STATUSES = {502, 503, 504}
+
+
+def is_load_shed(response):
+    # The auth service answers 503 with Retry-After when it sheds load (see overloaded_response in src/auth)
+    return response.status_code == 503 and "Retry-After" in response.headers
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """
+    Raised without touching the network while the auth service is considered unhealthy.
+    """
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker with a single half-open trial call.
+    """
+
+    def __init__(self, failure_threshold=AUTH_BREAKER_FAILURES, reset_timeout=AUTH_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(f"Auth service circuit opened after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+
+    def snapshot(self):
+        return {"state": self.state, "consecutive_failures": self.failures}
+
+
+class AuthServiceClient:
+    """
+    Shared, connection-pooled HTTP client for gateway-to-auth calls.
+
+    Connection failures and 502/503/504 answers are retried with full-jitter
+    exponential backoff; repeated failures open the circuit so callers fail
+    fast instead of piling up on a slow auth service. A 503 with Retry-After
+    is the service shedding load: it is returned as is, neither retried nor
+    counted as a failure, so retries do not add to the load being shed.
+    """
+
+    def __init__(self, base_url=None):
+        self.base_url = base_url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=AUTH_POOL_SIZE, pool_block=False)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.breaker = CircuitBreaker()
+        metrics.register("auth_client_circuit", self.breaker)
+
+    def url(self, path):
+        base_url = self.base_url or os.environ.get("AUTH_SVC_ADDRESS", "127.0.0.1:5000")
+        return f"{base_url}{path}"
+
+    def post(self, path, **kwargs):
+        kwargs.setdefault("timeout", (AUTH_CONNECT_TIMEOUT, AUTH_READ_TIMEOUT))
+        latency = metrics.histogram(f"auth_client_latency_seconds{path.replace('/', '_')}")
+
+        for attempt in range(AUTH_MAX_RETRIES + 1):
+            if not self.breaker.allow():
+                metrics.counter("auth_client_rejected_total").inc()
+                raise CircuitOpenError("Authentication service circuit is open")
+
+            started = time.monotonic()
+            try:
+                response = self.session.post(self.url(path), **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                latency.observe(time.monotonic() - started)
+                self.breaker.record_failure()
+                # Read timeouts may have reached the service, so only connection-level failures are retried
+                if isinstance(e, requests.exceptions.ReadTimeout) or attempt == AUTH_MAX_RETRIES:
+                    raise
+                logger.warning(f"Auth service call to {path} failed ({e}); retrying")
+            except requests.exceptions.RequestException:
+                # E.g. a response cut off mid-body; it may have been processed, so it is not retried,
+                # but it still settles a half-open trial
+                latency.observe(time.monotonic() - started)
+                self.breaker.record_failure()
+                raise
+            else:
+                latency.observe(time.monotonic() - started)
+                if response.status_code not in RETRYABLE_STATUSES or is_load_shed(response):
+                    self.breaker.record_success()
+                    return response
+                self.breaker.record_failure()
+                if attempt == AUTH_MAX_RETRIES:
+                    return response
+                logger.warning(f"Auth service call to {path} answered {response.status_code}; retrying")
+
+            metrics.counter("auth_client_retries_total").inc()
+            time.sleep(random.uniform(0, min(AUTH_RETRY_BACKOFF_MAX, AUTH_RETRY_BACKOFF * 2 ** attempt)))
+
+
+# One client (and connection pool) per gateway process
+auth_client = AuthServiceClient()
@@ -1,23 +1,77 @@
 import os
+import json
+import jwt
 import requests
+from auth_validate.cache import TokenCache
+from auth_svc.client import auth_client, CircuitOpenError
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Local verification uses the same secret and rules as the auth service's /validate
+JWT_SECRET = os.environ.get("JWT_SECRET")
+LOCAL_JWT_VALIDATION = os.environ.get("LOCAL_JWT_VALIDATION", "true" if JWT_SECRET else "false").lower() == "true"
+JWT_CACHE_SIZE = int(os.environ.get("JWT_CACHE_SIZE", 10000))
+JWT_CACHE_TTL = int(os.environ.get("JWT_CACHE_TTL", 300))  # seconds
+
+token_cache = TokenCache(max_size=JWT_CACHE_SIZE, ttl=JWT_CACHE_TTL)
+
+
+def verify_locally(token):
+    """
+    Verifies an HS256 token in-process, mirroring auth/main.py:validate.
+    """
+    parts = token.split(" ")
+    if len(parts) < 2:
+        return None, (json.dumps({"msg": "Invalid token"}), 403)
+
+    try:
+        decoded = jwt.decode(parts[1], JWT_SECRET, algorithms=["HS256"])
+    except jwt.ExpiredSignatureError:
+        return None, (json.dumps({"msg": "Token has expired"}), 403)
+    except jwt.InvalidTokenError:
+        return None, (json.dumps({"msg": "Invalid token"}), 403)
+
+    return json.dumps(decoded), None
+
+
+def verify_remotely(token):
+    try:
+        response = auth_client.post("/validate", headers={"Authorization": token})
+    except CircuitOpenError:
+        return None, ("Authentication service unavailable", 503)
+    except requests.exceptions.Timeout:
+        return None, ("Authentication service request timed out", 504)
+    except requests.exceptions.RequestException:
+        return None, ("Failed to connect to the authentication service", 500)
+
+    if response.status_code == 200:
+        return response.text, None
+    else:
+        return None, (response.text, response.status_code)
+
 
 def token(request):
     if not "Authorization" in request.headers:
         return None, ("Missing Credentials", 401)
-    
+
     token = request.headers["Authorization"]
 
     if not token:
         return None, ("Missing Credentials", 401)
-    
-    url = f"{os.environ.get('AUTH_SVC_ADDRESS','127.0.0.1:5000')}/validate"
-    
-    response = requests.post(
-        url,
-        headers={"Authorization": token}
-    )
 
-    if response.status_code == 200:
-        return response.text, None
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached, None
+
+    if LOCAL_JWT_VALIDATION:
+        claims, err = verify_locally(token)
     else:
-        return None, (response.text, response.status_code)
\ No newline at end of file
+        claims, err = verify_remotely(token)
+
+    if not err:
+        try:
+            token_cache.put(token, claims, exp=json.loads(claims).get("exp"))
+        except ValueError:
+            logger.warning("Validated token claims are not JSON; not caching")
+    return claims, err
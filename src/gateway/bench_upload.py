@@ -0,0 +1,84 @@
+"""
+Peak RSS benchmark for the buffered vs. streaming upload paths.
+
+Each (mode, size) pair runs in a fresh subprocess so ru_maxrss reflects only
+that upload. Requires a reachable MongoDB at MONGO_URI.
+
+    python bench_upload.py --sizes 64 256 1024
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import gridfs
+from pymongo import MongoClient
+from storage import util
+
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+BENCH_DB = os.getenv("BENCH_DB", "bench-upload-db")
+MIB = 1024 * 1024
+
+
+class SyntheticStream:
+    """
+    File-like object yielding `size` bytes without ever holding them all.
+    """
+
+    def __init__(self, size):
+        self.remaining = size
+        self.block = os.urandom(MIB)
+
+    def read(self, n=-1):
+        if self.remaining <= 0:
+            return b""
+        if n is None or n < 0:
+            n = self.remaining
+        n = min(n, self.remaining, len(self.block))
+        self.remaining -= n
+        return self.block[:n]
+
+
+def peak_rss_mib():
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(mode, size_mib, results):
+    fs = gridfs.GridFS(MongoClient(MONGO_URI)[BENCH_DB])
+    baseline = peak_rss_mib()
+    started = time.monotonic()
+    if mode == "buffered":
+        # Mirrors Werkzeug holding the whole body before fs.put copies it
+        stream = SyntheticStream(size_mib * MIB)
+        file_id = fs.put(io.BytesIO(stream.read()))
+    else:
+        file_id, _, _ = util.stream_to_storage(
+            SyntheticStream(size_mib * MIB), fs, max_bytes=sys.maxsize
+        )
+    elapsed = time.monotonic() - started
+    fs.delete(file_id)
+    results.put((mode, size_mib, peak_rss_mib() - baseline, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[16, 64, 256], help="file sizes in MiB")
+    parser.add_argument("--modes", nargs="+", default=["buffered", "stream"], choices=["buffered", "stream"])
+    args = parser.parse_args()
+
+    results = multiprocessing.Queue()
+    print(f"{'mode':<10}{'size MiB':>10}{'peak RSS MiB':>15}{'MiB/s':>10}")
+    for size in args.sizes:
+        for mode in args.modes:
+            proc = multiprocessing.Process(target=run, args=(mode, size, results))
+            proc.start()
+            proc.join()
+            mode, size_mib, rss, elapsed = results.get()
+            print(f"{mode:<10}{size_mib:>10}{rss:>15.1f}{size_mib / elapsed:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Requests/sec of gateway token validation: remote /validate call vs. local HS256
+verification, with and without the token cache.
+
+The remote mode needs the auth service at AUTH_SVC_ADDRESS sharing JWT_SECRET.
+
+    JWT_SECRET=mysecret python bench_validate.py --seconds 5 --threads 8
+"""
+import argparse
+import datetime
+import os
+import threading
+import time
+import jwt
+from auth_validate import validate
+
+
+class FakeRequest:
+    def __init__(self, token):
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+
+def make_token(secret):
+    # Same claim shape as auth/utils.createJWT
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    return jwt.encode(
+        {
+            "user": {"username": "bench", "email": "bench@example.com"},
+            "exp": now + datetime.timedelta(days=1),
+            "iat": now,
+            "authz": True
+        },
+        secret,
+        algorithm="HS256"
+    )
+
+
+def run(mode, request, seconds, threads):
+    validate.LOCAL_JWT_VALIDATION = mode != "remote"
+    use_cache = mode == "local+cache"
+    counts = [0] * threads
+    deadline = time.monotonic() + seconds
+
+    def worker(i):
+        while time.monotonic() < deadline:
+            if not use_cache:
+                validate.token_cache.clear()
+            _, err = validate.token(request)
+            if err:
+                raise RuntimeError(f"validation failed: {err}")
+            counts[i] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return sum(counts) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--modes", nargs="+", default=["remote", "local", "local+cache"],
+                        choices=["remote", "local", "local+cache"])
+    args = parser.parse_args()
+
+    secret = os.environ.get("JWT_SECRET", "mysecret")
+    validate.JWT_SECRET = secret
+    request = FakeRequest(make_token(secret))
+
+    print(f"{'mode':<14}{'req/s':>12}")
+    for mode in args.modes:
+        print(f"{mode:<14}{run(mode, request, args.seconds, args.threads):>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
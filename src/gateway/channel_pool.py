@@ -0,0 +1,181 @@
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+import pika
+from pika.exceptions import AMQPError
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Channel pool settings
+RABBITMQ_POOL_SIZE = int(os.getenv("RABBITMQ_POOL_SIZE", 8))  # connections (one channel each) per gateway process
+RABBITMQ_POOL_TIMEOUT = float(os.getenv("RABBITMQ_POOL_TIMEOUT", 5.0))  # seconds to wait for a free channel
+RABBITMQ_HEARTBEAT = int(os.getenv("RABBITMQ_HEARTBEAT", 60))  # seconds
+RABBITMQ_RECONNECT_DELAY = 0.5  # seconds, doubled per failed attempt
+RABBITMQ_RECONNECT_MAX_DELAY = 30  # seconds
+
+
+class ChannelUnavailable(Exception):
+    """
+    Raised when no channel can be handed out: the pool is exhausted or RabbitMQ is unreachable.
+    """
+
+
+class ChannelPool:
+    """
+    Thread-safe pool of RabbitMQ channels for request threads.
+
+    pika's BlockingConnection must only be used by one thread at a time, so
+    every pooled channel has its own connection and is checked out exclusively.
+    At most `max_size` connections are open. They are opened lazily. After a
+    failed attempt, new attempts are refused until a capped exponential
+    backoff has passed, so requests fail fast while the broker is down instead
+    of each waiting out a connect timeout. A keeper thread processes heartbeats
+    on idle connections so the broker does not drop them between requests.
+    """
+
+    def __init__(self, parameters, max_size=RABBITMQ_POOL_SIZE, timeout=RABBITMQ_POOL_TIMEOUT, on_open=None):
+        self.parameters = parameters
+        self.max_size = max_size
+        self.timeout = timeout
+        self.on_open = on_open  # called with each new channel, e.g. to declare queues
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._size = 0
+        self._retry_at = 0.0
+        self._reconnect_delay = RABBITMQ_RECONNECT_DELAY
+        self._keeper = None
+        self._closed = threading.Event()
+
+    def snapshot(self):
+        return {"size": self._size, "idle": self._idle.qsize(), "max_size": self.max_size}
+
+    def _open(self):
+        with self._lock:
+            wait = self._retry_at - time.monotonic()
+        if wait > 0:
+            raise ChannelUnavailable(f"RabbitMQ unavailable; next connection attempt in {wait:.1f}s")
+
+        try:
+            connection = pika.BlockingConnection(self.parameters)
+            channel = connection.channel()
+            if self.on_open:
+                self.on_open(channel)
+        except (AMQPError, OSError) as e:
+            with self._lock:
+                self._retry_at = time.monotonic() + self._reconnect_delay
+                self._reconnect_delay = min(self._reconnect_delay * 2, RABBITMQ_RECONNECT_MAX_DELAY)
+            logger.error(f"Failed to connect to RabbitMQ: {e!r}")
+            raise ChannelUnavailable(f"RabbitMQ unavailable: {e!r}") from e
+
+        with self._lock:
+            self._size += 1
+            self._reconnect_delay = RABBITMQ_RECONNECT_DELAY
+        self._start_keeper()
+        logger.info(f"Opened pooled RabbitMQ channel ({self._size}/{self.max_size})")
+        return connection, channel
+
+    def _discard(self, connection):
+        with self._lock:
+            self._size -= 1
+        try:
+            if connection.is_open:
+                connection.close()
+        except Exception:
+            pass
+
+    def _take(self):
+        if self._closed.is_set():
+            raise ChannelUnavailable("Channel pool is closed")
+        if not self._slots.acquire(timeout=self.timeout):
+            raise ChannelUnavailable(f"No RabbitMQ channel available within {self.timeout}s")
+        try:
+            while True:
+                try:
+                    connection, channel = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._open()
+                if connection.is_open and channel.is_open:
+                    return connection, channel
+                logger.info("Replacing closed RabbitMQ channel.")
+                self._discard(connection)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _give_back(self, entry, discard=False):
+        connection, channel = entry
+        try:
+            if discard or self._closed.is_set() or not (connection.is_open and channel.is_open):
+                self._discard(connection)
+            else:
+                self._idle.put(entry)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def channel(self):
+        """
+        Borrows a channel for the duration of the block.
+
+        A channel whose connection failed while in use is closed instead of
+        being returned to the pool.
+        """
+        entry = self._take()
+        broken = False
+        try:
+            yield entry[1]
+        except AMQPError:
+            broken = True
+            raise
+        finally:
+            self._give_back(entry, discard=broken)
+
+    def _start_keeper(self):
+        with self._lock:
+            if self._keeper is not None:
+                return
+            self._keeper = threading.Thread(target=self._keep_alive, name="rabbitmq-heartbeats", daemon=True)
+        self._keeper.start()
+
+    def _keep_alive(self):
+        interval = max(1.0, RABBITMQ_HEARTBEAT / 2 if RABBITMQ_HEARTBEAT else 30.0)
+        while not self._closed.wait(interval):
+            # Only idle connections are touched, each under a slot so no request can take it meanwhile
+            entries = []
+            while self._slots.acquire(blocking=False):
+                try:
+                    entries.append(self._idle.get_nowait())
+                except queue.Empty:
+                    self._slots.release()
+                    break
+            for entry in entries:
+                try:
+                    entry[0].process_data_events(time_limit=0)
+                    self._give_back(entry)
+                except Exception as e:
+                    logger.warning(f"Dropping idle RabbitMQ connection: {e!r}")
+                    self._give_back(entry, discard=True)
+
+    def close(self):
+        """
+        Closes every idle connection and refuses further checkouts.
+        """
+        self._closed.set()
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(connection)
+
+
+def queue_stats(channel, queue_name):
+    """
+    Returns (messages ready, consumers) of a queue via a passive declare, which never creates it.
+    """
+    result = channel.queue_declare(queue=queue_name, passive=True)
+    return result.method.message_count, result.method.consumer_count
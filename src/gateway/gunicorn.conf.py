@@ -0,0 +1,23 @@
+import multiprocessing
+import os
+
+# Served with: gunicorn --config gunicorn.conf.py main:app
+bind = f"0.0.0.0:{os.getenv('PORT', 8086)}"
+
+# Uploads and downloads are I/O bound, so each worker serves several requests on threads
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("GUNICORN_WORKERS", 2 * multiprocessing.cpu_count() + 1))
+threads = int(os.getenv("GUNICORN_THREADS", 8))  # keep RABBITMQ_POOL_SIZE at or above this
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+
+# Import the app once in the master; connections are opened per worker in post_fork
+preload_app = True
+
+accesslog = "-"
+errorlog = "-"
+
+
+def post_fork(server, worker):
+    from main import init_worker
+    init_worker()
@@ -0,0 +1,142 @@
+"""
+HTTP load test for the served gateway and auth service: p50/p90/p99 latency
+and throughput of /login, /validate and /upload.
+
+/login and /upload go through the gateway; /validate is called on the auth
+service directly (the gateway validates tokens itself, see auth_validate).
+Each worker thread logs in as its own test user, created through the gateway first.
+
+Responses refused with 429 by the gateway's rate limits or admission control
+are counted apart from errors and left out of the latencies. To measure the
+endpoints themselves, run the gateway with RATE_LIMIT_UPLOAD=0,
+RATE_LIMIT_LOGIN=0 and RATE_LIMIT_DOWNLOAD=0.
+
+    python loadtest.py --gateway http://localhost:8086 --auth http://localhost:5000 \\
+        --seconds 30 --concurrency 32 --upload-kib 512
+"""
+import argparse
+import json
+import os
+import threading
+import time
+import requests
+
+LOADTEST_PASSWORD = "loadtest-password"
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float("nan")
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def extract_token(response):
+    try:
+        return response.json()["token"]
+    except (ValueError, KeyError, TypeError):
+        return response.text.strip()
+
+
+def loadtest_user(i):
+    return {"username": f"loadtest-user-{i}", "password": LOADTEST_PASSWORD, "email": f"loadtest-user-{i}@example.com"}
+
+
+def log_in_users(gateway, count):
+    """
+    Creates `count` test users and returns each one's credentials with its Authorization header.
+    """
+    users = []
+    for i in range(count):
+        credentials = loadtest_user(i)
+        requests.post(f"{gateway}/create", json=credentials, timeout=30)
+        response = requests.post(f"{gateway}/login", json=credentials, timeout=30)
+        response.raise_for_status()
+        users.append({"credentials": credentials, "auth_header": {"Authorization": f"Bearer {extract_token(response)}"}})
+    return users
+
+
+def run(name, send, users, seconds):
+    concurrency = len(users)
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    limited = [0] * concurrency
+    deadline = time.monotonic() + seconds
+
+    def worker(i):
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                status = send(session, users[i]).status_code
+            except requests.RequestException:
+                status = None
+            if status == 429:
+                limited[i] += 1
+            elif status is not None and status < 400:
+                latencies[i].append(time.perf_counter() - started)
+            else:
+                errors[i] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    values = sorted(v for per_worker in latencies for v in per_worker)
+    return {
+        "endpoint": name,
+        "requests": len(values),
+        "errors": sum(errors),
+        "limited": sum(limited),
+        "req_per_s": len(values) / seconds,
+        "p50_ms": percentile(values, 0.50) * 1000,
+        "p90_ms": percentile(values, 0.90) * 1000,
+        "p99_ms": percentile(values, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--gateway", default=os.getenv("GATEWAY_URL", "http://localhost:8086"))
+    parser.add_argument("--auth", default=os.getenv("AUTH_URL", "http://localhost:5000"))
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--upload-kib", type=int, default=256, help="size of each uploaded body")
+    parser.add_argument("--endpoints", nargs="+", default=["login", "validate", "upload"],
+                        choices=["login", "validate", "upload"])
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args()
+
+    # One user per worker, so per-user rate limits do not serialise the whole run on a single bucket
+    users = log_in_users(args.gateway, args.concurrency)
+    body = os.urandom(args.upload_kib * 1024)
+
+    scenarios = {
+        "login": lambda s, user: s.post(f"{args.gateway}/login", json=user["credentials"], timeout=30),
+        "validate": lambda s, user: s.post(f"{args.auth}/validate", headers=user["auth_header"], timeout=30),
+        # Raw bodies take the streaming upload path; a random prefix keeps uploads from being deduplicated
+        "upload": lambda s, user: s.post(
+            f"{args.gateway}/upload",
+            data=os.urandom(16) + body,
+            headers={**user["auth_header"], "Content-Type": "application/octet-stream", "X-Filename": "loadtest.mp4"},
+            timeout=120,
+        ),
+    }
+
+    if not args.json:
+        print(f"{'endpoint':<10}{'req/s':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'errors':>8}{'429s':>8}")
+    for name in args.endpoints:
+        result = run(name, scenarios[name], users, args.seconds)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(
+                f"{name:<10}{result['req_per_s']:>10.1f}{result['p50_ms']:>10.1f}"
+                f"{result['p90_ms']:>10.1f}{result['p99_ms']:>10.1f}{result['errors']:>8}{result['limited']:>8}"
+            )
+
+
+if __name__ == "__main__":
+    main()
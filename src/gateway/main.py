@@ -1,15 +1,24 @@
 import json
+import math
 import os
+import threading
 import time
 import gridfs  # For handling large files in MongoDB
 import pika  # For RabbitMQ communication
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from werkzeug.http import parse_content_range_header
 from pymongo import MongoClient
 from bson.objectid import ObjectId
 from auth_validate import validate
 from auth_create.create_user import create
 from auth_svc import access
-from storage import util
+from storage import util, sessions, dedup, lanes, files as file_store, jobs as job_store
+from storage import download as download_util, download_cache as download_cache_util
+import metrics
+import ratelimit
+from admission import AdmissionGate
+from publisher import Publisher, OUTBOX_COLLECTION
+from channel_pool import ChannelPool, ChannelUnavailable, RABBITMQ_HEARTBEAT, queue_stats
 from logger import get_logger
 
 # Initialize Flask app
@@ -29,30 +38,48 @@ RABBITMQ_PORT = os.getenv("RABBITMQ_PORT", 5672)
 RABBITMQ_RETRY_COUNT = 5
 RABBITMQ_RETRY_DELAY = 5  # seconds
 
-# Initialize MongoDB client
-logger.info("Initializing MongoDB client")
-client = MongoClient(MONGO_URI)
+# Job progress stream settings
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 1.0))  # seconds between job reads while streaming
+JOB_STREAM_KEEPALIVE = float(os.getenv("JOB_STREAM_KEEPALIVE", 15))  # seconds between SSE comments when nothing changes
+JOB_STREAM_MAX_SECONDS = int(os.getenv("JOB_STREAM_MAX_SECONDS", 60))  # clients reconnect after this
+JOB_STREAM_RETRY = float(os.getenv("JOB_STREAM_RETRY", 2))  # seconds a client waits before reconnecting
+# Each open stream holds a request thread; past this, /jobs/<id>/events answers 503 and clients poll /jobs/<id>
+JOB_STREAM_MAX_PER_WORKER = int(os.getenv("JOB_STREAM_MAX_PER_WORKER", max(1, int(os.getenv("GUNICORN_THREADS", 8)) // 2)))
 
-db_videos = client[UPLOAD_FOLDER]
-db_mp3s = client[DOWNLOAD_FOLDER]
+# Per-process clients, opened by init_worker(); pymongo clients and pika connections do not survive a fork
+client = None
+db_videos = None
+db_mp3s = None
+fs_videos = None
+fs_mp3s = None
+content_index = None
+jobs = None
+mp3_files = None
+rabbitmq_pool = None
+publisher = None
+admission_gate = None
+rate_limiter = None
+download_cache = None
+job_streams = threading.BoundedSemaphore(JOB_STREAM_MAX_PER_WORKER)
 
-# Initialize GridFS instances
-logger.info("Setting up GridFS for videos and mp3s")
-fs_videos = gridfs.GridFS(db_videos)
-fs_mp3s = gridfs.GridFS(db_mp3s)
+def rabbitmq_parameters():
+    credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASSWORD)
+    return pika.ConnectionParameters(
+        host=RABBITMQ_HOST, port=RABBITMQ_PORT, credentials=credentials, heartbeat=RABBITMQ_HEARTBEAT
+    )
+
+def declare_queues(channel):
+    lanes.declare(channel)
+    channel.queue_declare(queue='mp3', durable=True)
 
 # RabbitMQ connection setup with retries
 def connect_rabbitmq():
     for attempt in range(1, RABBITMQ_RETRY_COUNT + 1):
         try:
             logger.info(f"Attempting to connect to RabbitMQ (Attempt {attempt}/{RABBITMQ_RETRY_COUNT})")
-            credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASSWORD)
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters(host=RABBITMQ_HOST, port=RABBITMQ_PORT, credentials=credentials)
-            )
+            connection = pika.BlockingConnection(rabbitmq_parameters())
             channel = connection.channel()
-            channel.queue_declare(queue='video', durable=True)
-            channel.queue_declare(queue='mp3', durable=True)
+            declare_queues(channel)
             logger.info("RabbitMQ connection established successfully")
             return connection, channel
         except Exception as e:
@@ -62,7 +89,78 @@ def connect_rabbitmq():
             else:
                 raise Exception("Max retries reached. Could not connect to RabbitMQ.")
 
-connection, channel = connect_rabbitmq()
+def init_worker():
+    """
+    Opens this process's MongoDB client and RabbitMQ connections.
+
+    Under gunicorn the app is preloaded in the master and this runs in every
+    worker after fork (see gunicorn.conf.py); the development server calls it
+    before app.run().
+    """
+    global client, db_videos, db_mp3s, fs_videos, fs_mp3s, content_index, jobs, mp3_files, rabbitmq_pool, publisher
+    global admission_gate, rate_limiter, download_cache
+
+    # Initialize MongoDB client
+    logger.info("Initializing MongoDB client")
+    client = MongoClient(MONGO_URI)
+
+    db_videos = client[UPLOAD_FOLDER]
+    db_mp3s = client[DOWNLOAD_FOLDER]
+
+    # Initialize GridFS instances
+    logger.info("Setting up GridFS for videos and mp3s")
+    fs_videos = gridfs.GridFS(db_videos)
+    fs_mp3s = gridfs.GridFS(db_mp3s)
+    sessions.ensure_indexes(db_videos)
+    content_index = db_videos[dedup.CONTENT_INDEX_COLLECTION]
+    dedup.ensure_indexes(content_index)
+    jobs = db_videos[job_store.JOBS_COLLECTION]
+    job_store.ensure_indexes(jobs)
+    mp3_files = db_mp3s[file_store.MP3_FILES_COLLECTION]
+    file_store.ensure_indexes(mp3_files)
+
+    # Declare the queues once at startup, waiting for RabbitMQ to come up
+    connection, _ = connect_rabbitmq()
+    connection.close()
+
+    # pika connections are not thread-safe, so each request borrows its own channel from the pool
+    rabbitmq_pool = ChannelPool(rabbitmq_parameters(), on_open=declare_queues)
+    metrics.register("rabbitmq_channel_pool", rabbitmq_pool)
+
+    # Queue messages are published with confirms from the publisher's own I/O thread
+    publisher = Publisher(rabbitmq_parameters(), outbox=db_videos[OUTBOX_COLLECTION]).start()
+
+    # New uploads are refused while the converters are too far behind, and each user is rate limited
+    admission_gate = AdmissionGate(rabbitmq_pool, lanes.LANES)
+    metrics.register("admission", admission_gate)
+    rate_limiter = ratelimit.build_limiter(db_videos)
+
+    # Popular MP3s are served from memory or local disk instead of GridFS
+    download_cache = download_cache_util.build_cache()
+    if download_cache is not None:
+        metrics.register("download_cache", download_cache)
+
+def too_many_requests(error, retry_after):
+    return jsonify({"status": False, "error": error}), 429, {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+def rate_limited(scope, key):
+    """
+    Returns a 429 response if `key` has used up its `scope` limit, else None.
+    """
+    retry_after = rate_limiter.check(scope, key)
+    if retry_after:
+        return too_many_requests("Too many requests", retry_after)
+    return None
+
+def admission_refused():
+    """
+    Returns a 429 response if the conversion backlog is full, else None; checked before any upload bytes are read.
+    """
+    decision = admission_gate.check()
+    if decision.admitted:
+        return None
+    logger.warning(f"Upload refused: {decision.reason}")
+    return too_many_requests(decision.reason, decision.retry_after)
 
 # Routes
 @app.route('/readiness', methods=["GET"])
@@ -73,6 +171,18 @@ def readiness():
 def health():
     return jsonify({"status": "ok"})
 
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    snapshot = metrics.snapshot()
+    try:
+        with rabbitmq_pool.channel() as ch:
+            snapshot["queues"] = {
+                name: dict(zip(("messages", "consumers"), queue_stats(ch, name))) for name in (*lanes.LANES, "mp3")
+            }
+    except (ChannelUnavailable, pika.exceptions.AMQPError) as e:
+        snapshot["queues"] = {"error": str(e)}
+    return jsonify(snapshot)
+
 @app.route("/create", methods=["POST"])
 def create():
     logger.info("Processing user create request")
@@ -86,6 +196,12 @@ def create():
 @app.route("/login", methods=["POST"])
 def login():
     logger.info("Processing login request")
+    # Keyed by the account being logged into, so guessing one user's password is slowed down
+    credentials = request.get_json(silent=True)
+    username = credentials.get("username") if isinstance(credentials, dict) else None
+    limited = rate_limited("login", username or request.remote_addr)
+    if limited:
+        return limited
     token, err = access.login(request)
 
     if err:
@@ -105,6 +221,14 @@ def upload():
 
     data = json.loads(token)
     if data["user"].get('username') and data["user"].get("email"):
+        refused = rate_limited("upload", data["user"]["username"]) or admission_refused()
+        if refused:
+            return refused
+
+        # Raw (non-multipart) bodies are streamed straight into GridFS
+        if request.mimetype != "multipart/form-data":
+            return stream_upload(data["user"])
+
         if len(request.files) != 1:
             logger.warning("Upload failed: Exactly one file required")
             return "Exactly one file required", 400
@@ -112,8 +236,11 @@ def upload():
         try:
             file = next(iter(request.files.values()))
             logger.info(f"Uploading file: {file.filename}")
-            response = util.upload_file_to_storage_and_queue(file, fs_videos, channel, data["user"])
+            response = util.upload_file_to_storage_and_queue(file, fs_videos, publisher, data["user"], content_index=content_index, jobs=jobs, mp3_files=mp3_files)
             return jsonify(response)
+        except util.UploadTooLarge as e:
+            logger.warning(f"Upload rejected: {e}")
+            return jsonify({"status": False, "error": str(e)}), 413
         except Exception as e:
             logger.exception("Error during file upload")
             return jsonify({"status": False, "error": str(e)}), 500
@@ -121,7 +248,230 @@ def upload():
         logger.warning("Unauthorized upload attempt")
         return jsonify({"status": False, "error": "Unauthorized"}), 401
 
-@app.route("/download", methods=["POST"])
+def stream_upload(user):
+    """
+    Streams a raw request body (e.g. application/octet-stream) into GridFS
+    without spooling it to memory or disk first.
+    """
+    if request.content_length and request.content_length > util.MAX_UPLOAD_BYTES:
+        logger.warning(f"Upload rejected: Content-Length {request.content_length} exceeds limit")
+        return jsonify({"status": False, "error": "File too large"}), 413
+
+    filename = request.headers.get("X-Filename") or request.args.get("filename")
+    try:
+        logger.info(f"Streaming upload: {filename}")
+        response = util.stream_file_to_storage_and_queue(
+            request.stream, fs_videos, publisher, user, filename=filename, content_index=content_index, jobs=jobs,
+            mp3_files=mp3_files,
+        )
+        return jsonify(response)
+    except util.UploadTooLarge as e:
+        logger.warning(f"Upload aborted: {e}")
+        return jsonify({"status": False, "error": str(e)}), 413
+    except Exception as e:
+        logger.exception("Error during streaming upload")
+        return jsonify({"status": False, "error": str(e)}), 500
+
+def authorized_user():
+    """
+    Validates the request token and returns (user, None) or (None, error response).
+    """
+    token, err = validate.token(request)
+    if err:
+        logger.warning(f"Token validation failed: {err}")
+        return None, (err, 400)
+
+    user = json.loads(token)["user"]
+    if not (user.get("username") and user.get("email")):
+        logger.warning("Unauthorized request")
+        return None, (jsonify({"status": False, "error": "Unauthorized"}), 401)
+    return user, None
+
+def session_error(e):
+    body = {"status": False, "error": str(e)}
+    headers = {}
+    if e.offset is not None:
+        body["offset"] = e.offset
+        headers["Upload-Offset"] = str(e.offset)
+    return jsonify(body), e.status, headers
+
+@app.route("/uploads", methods=["POST"])
+def create_upload_session():
+    logger.info("Processing upload session create request")
+    user, err = authorized_user()
+    if err:
+        return err
+    # Sessions already open may finish; only new ones are limited
+    refused = rate_limited("upload", user["username"]) or admission_refused()
+    if refused:
+        return refused
+
+    payload = request.get_json(silent=True) or {}
+    try:
+        session = sessions.create_session(db_videos, fs_videos, user, payload.get("length"), payload.get("filename"))
+    except sessions.SessionError as e:
+        return session_error(e)
+    return jsonify({
+        "session_id": session["_id"],
+        "offset": session["offset"],
+        "length": session["length"],
+        "chunk_size": session["chunk_size"],
+        "expires_at": session["expires_at"].isoformat()
+    }), 201, {"Location": f"/uploads/{session['_id']}"}
+
+@app.route("/uploads/<session_id>", methods=["GET"])
+def upload_session_offset(session_id):
+    user, err = authorized_user()
+    if err:
+        return err
+
+    try:
+        session = sessions.get_session(db_videos, session_id, user)
+    except sessions.SessionError as e:
+        return session_error(e)
+    return jsonify({"offset": session["offset"], "length": session["length"]}), 200, {
+        "Upload-Offset": str(session["offset"]),
+        "Upload-Length": str(session["length"])
+    }
+
+@app.route("/uploads/<session_id>", methods=["PUT", "PATCH"])
+def upload_session_range(session_id):
+    """
+    Accepts a byte range either as `Content-Range: bytes start-end/total` or tus-style `Upload-Offset: start`.
+    """
+    user, err = authorized_user()
+    if err:
+        return err
+
+    content_range = parse_content_range_header(request.headers.get("Content-Range"))
+    if content_range is not None:
+        start = content_range.start
+    elif request.headers.get("Upload-Offset", "").isdigit():
+        start = int(request.headers["Upload-Offset"])
+    else:
+        return jsonify({"status": False, "error": "Content-Range or Upload-Offset header required"}), 400
+
+    try:
+        session = sessions.write_range(db_videos, session_id, user, start, request.stream)
+    except sessions.SessionError as e:
+        return session_error(e)
+    except Exception as e:
+        logger.exception(f"Error writing range to upload session {session_id}")
+        return jsonify({"status": False, "error": str(e)}), 500
+    return jsonify({"offset": session["offset"], "length": session["length"]}), 200, {
+        "Upload-Offset": str(session["offset"])
+    }
+
+@app.route("/uploads/<session_id>/finalize", methods=["POST"])
+def finalize_upload_session(session_id):
+    logger.info(f"Finalizing upload session {session_id}")
+    user, err = authorized_user()
+    if err:
+        return err
+
+    try:
+        response = sessions.finalize(
+            db_videos, session_id, user, fs_videos, publisher, jobs=jobs, content_index=content_index, mp3_files=mp3_files
+        )
+    except sessions.SessionError as e:
+        return session_error(e)
+    except Exception as e:
+        logger.exception(f"Error finalizing upload session {session_id}")
+        return jsonify({"status": False, "error": str(e)}), 500
+    return jsonify(response)
+
+@app.route("/jobs", methods=["GET"])
+def list_jobs():
+    user, err = authorized_user()
+    if err:
+        return err
+    found = job_store.list_jobs(jobs, user["username"], state=request.args.get("state"))
+    return jsonify({"jobs": [job_store.to_json(job) for job in found]})
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    user, err = authorized_user()
+    if err:
+        return err
+    job = job_store.get_job(jobs, job_id, user["username"])
+    if job is None:
+        return jsonify({"status": False, "error": "Job not found"}), 404
+    return jsonify(job_store.to_json(job))
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """
+    Server-sent events with the job's state and progress, ending once it is done or failed.
+
+    The job document is polled every JOB_POLL_INTERVAL seconds and an event is
+    sent whenever it changes. A stream holds a request thread, so it is closed
+    after JOB_STREAM_MAX_SECONDS and the client reconnects after the `retry:`
+    it was given; each event's `id:` is the job's version, and a reconnect whose
+    Last-Event-ID matches it is not sent the same event again; once that event
+    was the final one, the reconnect gets 204, which stops the client. Past
+    JOB_STREAM_MAX_PER_WORKER open streams, new ones are refused with 503.
+    """
+    user, err = authorized_user()
+    if err:
+        return err
+    job = job_store.get_job(jobs, job_id, user["username"])
+    if job is None:
+        return jsonify({"status": False, "error": "Job not found"}), 404
+    # The update time is the job's version; ISO format round-trips through Last-Event-ID unchanged
+    last_event_id = request.headers.get("Last-Event-ID")
+    if job["state"] in job_store.FINAL_STATES and job["updated_at"].isoformat() == last_event_id:
+        return "", 204
+    if not job_streams.acquire(blocking=False):
+        retry_after = str(max(1, math.ceil(JOB_STREAM_RETRY)))
+        return jsonify({"status": False, "error": "Too many open job streams, poll /jobs/<job_id>"}), 503, {"Retry-After": retry_after}
+
+    def events(job, last_version):
+        started = last_sent = time.monotonic()
+        yield f"retry: {int(JOB_STREAM_RETRY * 1000)}\n\n"
+        while True:
+            if job["updated_at"].isoformat() != last_version:
+                last_version = job["updated_at"].isoformat()
+                last_sent = time.monotonic()
+                yield f"id: {last_version}\nevent: {job['state']}\ndata: {json.dumps(job_store.to_json(job))}\n\n"
+            elif time.monotonic() - last_sent >= JOB_STREAM_KEEPALIVE:
+                last_sent = time.monotonic()
+                yield ": keepalive\n\n"
+            if job["state"] in job_store.FINAL_STATES or time.monotonic() - started >= JOB_STREAM_MAX_SECONDS:
+                return
+            time.sleep(JOB_POLL_INTERVAL)
+            job = jobs.find_one({"_id": job["_id"]}) or job
+
+    response = Response(
+        stream_with_context(events(job, last_event_id)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # Runs when the server closes the response, whether the stream ended or the client went away
+    response.call_on_close(job_streams.release)
+    return response
+
+@app.route("/files", methods=["GET"])
+def list_files():
+    """
+    Lists the user's converted MP3s, newest first, one page at a time.
+
+    `?cursor=` continues after the previous page's `next_cursor`, `?limit=`
+    sets the page size and `?fields=size,duration` limits the returned fields.
+    """
+    user, err = authorized_user()
+    if err:
+        return err
+    try:
+        fields = file_store.parse_fields(request.args.get("fields"))
+        limit = int(request.args.get("limit", file_store.FILE_LIST_LIMIT))
+        found, next_cursor = file_store.list_files(
+            mp3_files, user["username"], cursor=request.args.get("cursor"), limit=limit, fields=fields
+        )
+    except ValueError as e:
+        return jsonify({"status": False, "error": str(e)}), 400
+    return jsonify({"files": [file_store.to_json(doc, fields) for doc in found], "next_cursor": next_cursor})
+
+@app.route("/download", methods=["GET", "POST"])
 def download():
     logger.info("Processing download request")
     token, err = validate.token(request)
@@ -133,6 +483,10 @@ def download():
     data = json.loads(token)
     logger.info(f"user is {data['user']}")
     if data["user"].get("username"):
+        limited = rate_limited("download", data["user"]["username"])
+        if limited:
+            return limited
+
         fid = request.args.get("fid")
         if not fid:
             logger.warning("Download failed: No fid provided")
@@ -140,8 +494,11 @@ def download():
 
         try:
             logger.info(f"Fetching file with id: {fid}")
-            file = fs_mp3s.get(ObjectId(fid))
-            return send_file(file, download_name=f"{fid}_converted.mp3")
+            if download_cache is not None:
+                file = download_cache.open(fs_mp3s, ObjectId(fid))
+            else:
+                file = fs_mp3s.get(ObjectId(fid))
+            return download_util.build_download_response(file, request.environ, f"{fid}_converted.mp3")
         except Exception as e:
             logger.exception(f"Error during file download for id {fid}")
             return str(e), 400
@@ -150,4 +507,6 @@ def download():
         return "You are not allowed to download", 401
 
 if __name__ == "__main__":
+    # Development server; production serves through gunicorn (see gunicorn.conf.py)
+    init_worker()
     app.run(host="0.0.0.0", port=8086)
@@ -0,0 +1,80 @@
+import bisect
+import threading
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+    Thread-safe cumulative histogram, reported in the Prometheus bucket layout.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        with self._lock:
+            cumulative, buckets = 0, {}
+            for bound, count in zip(self.buckets + (float("inf"),), self._counts):
+                cumulative += count
+                buckets["+Inf" if bound == float("inf") else str(bound)] = cumulative
+            return {"count": self._count, "sum": self._sum, "buckets": buckets}
+
+
+class Counter:
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def snapshot(self):
+        return self._value
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _get_or_create(name, factory):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = factory()
+        return metric
+
+
+def histogram(name, buckets=DEFAULT_BUCKETS):
+    return _get_or_create(name, lambda: Histogram(buckets))
+
+
+def counter(name):
+    return _get_or_create(name, Counter)
+
+
+def register(name, metric):
+    """
+    Registers any object exposing snapshot(), e.g. a gauge backed by live state.
+    """
+    with _registry_lock:
+        _registry[name] = metric
+
+
+def snapshot():
+    with _registry_lock:
+        metrics = dict(_registry)
+    return {name: metric.snapshot() for name, metric in sorted(metrics.items())}
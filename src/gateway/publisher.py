@@ -0,0 +1,364 @@
+import collections
+import datetime
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+import pika
+from pika.adapters.select_connection import IOLoop
+from pymongo import ReturnDocument
+import metrics
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Publisher confirm settings
+PUBLISH_CONFIRM_TIMEOUT = float(os.getenv("PUBLISH_CONFIRM_TIMEOUT", 5))  # seconds before a message falls back to the outbox
+PUBLISH_BATCH_SIZE = int(os.getenv("PUBLISH_BATCH_SIZE", 500))  # messages written per I/O loop turn
+PUBLISH_RECONNECT_DELAY = 1  # seconds, doubled per failed attempt
+PUBLISH_RECONNECT_MAX_DELAY = 30  # seconds
+
+# Outbox settings
+OUTBOX_COLLECTION = "outbox"
+OUTBOX_RELAY_INTERVAL = float(os.getenv("OUTBOX_RELAY_INTERVAL", 10))  # seconds between outbox scans
+OUTBOX_RELAY_BATCH = 100
+OUTBOX_LEASE = 6 * OUTBOX_RELAY_INTERVAL  # seconds a relayed message has to be confirmed before it is relayed again
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 10))  # relays before a message is dead-lettered in place
+
+
+class PublishError(Exception):
+    """
+    Raised when the broker rejects a message, or it is not confirmed in time and there is no outbox.
+    """
+
+
+def _now():
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+
+class _Pending:
+    __slots__ = ("exchange", "routing_key", "body", "properties", "future", "enqueued", "published")
+
+    def __init__(self, exchange, routing_key, body, properties):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.body = body
+        self.properties = properties
+        self.future = Future()
+        self.enqueued = time.monotonic()
+        self.published = None
+
+
+class Publisher:
+    """
+    Publishes persistent messages with RabbitMQ publisher confirms from a dedicated I/O thread.
+
+    Any thread may call publish(); it queues the message and returns a Future.
+    The I/O thread owns a SelectConnection in confirm mode, writes queued
+    messages in batches and resolves the futures as acks and nacks arrive, so
+    concurrent callers share broker round trips instead of each waiting for its
+    own confirm. Messages are published as mandatory, so an unroutable message
+    fails its future instead of disappearing. Messages still unconfirmed when
+    the connection drops are republished after reconnecting.
+
+    With an `outbox` collection, publish_and_wait() stores messages that are
+    not confirmed within PUBLISH_CONFIRM_TIMEOUT, and a relay thread republishes
+    them until the broker confirms them. Each entry records its relay attempts
+    and the last nack or return; after OUTBOX_MAX_ATTEMPTS relays it is marked
+    dead with `dead_at` and no longer relayed.
+    """
+
+    def __init__(self, parameters, outbox=None):
+        self.parameters = parameters
+        self.outbox = outbox
+        self._ioloop = IOLoop()
+        self._connection = None
+        self._channel = None
+        self._ready = False
+        self._queue = collections.deque()
+        self._unconfirmed = {}  # delivery tag -> _Pending; only touched on the I/O thread
+        self._returned = set()  # message ids bounced as unroutable, failed when their confirm arrives
+        self._delivered = collections.deque()  # outboxed message ids confirmed since the last relay pass
+        self._rejected = collections.deque()  # (message id, error) of outboxed messages nacked or returned since then
+        self._next_tag = 0
+        self._reconnect_delay = PUBLISH_RECONNECT_DELAY
+        self._flush_lock = threading.Lock()
+        self._flush_scheduled = False
+        self._stopping = threading.Event()
+        self._threads = []
+
+        self._latency = metrics.histogram("rabbitmq_publish_latency_seconds")
+        self._confirm_lag = metrics.histogram("rabbitmq_confirm_lag_seconds")
+        self._nacks = metrics.counter("rabbitmq_publish_nacks_total")
+        self._outboxed = metrics.counter("rabbitmq_publish_outboxed_total")
+        self._dead = metrics.counter("rabbitmq_outbox_dead_total")
+        metrics.register("rabbitmq_publisher", self)
+
+    def snapshot(self):
+        return {"queued": len(self._queue), "unconfirmed": len(self._unconfirmed), "connected": self._ready}
+
+    def start(self):
+        if self.outbox is not None:
+            self.outbox.create_index("next_attempt_at")
+        self._threads.append(threading.Thread(target=self._run, name="publisher-io", daemon=True))
+        if self.outbox is not None:
+            self._threads.append(threading.Thread(target=self._relay, name="publisher-outbox", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def close(self, timeout=5):
+        self._stopping.set()
+        self._ioloop.add_callback_threadsafe(self._shutdown)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def publish(self, routing_key, body, properties=None, exchange=""):
+        """
+        Queues a message and returns a Future resolved when the broker confirms it.
+        """
+        return self._enqueue(exchange, routing_key, body, properties).future
+
+    def publish_and_wait(self, routing_key, body, properties=None, exchange="", timeout=PUBLISH_CONFIRM_TIMEOUT):
+        """
+        Publishes a message and waits for its confirm.
+
+        Returns True once confirmed, or False if it was not confirmed in time
+        and has been stored in the outbox for redelivery. Raises PublishError
+        if the broker rejects the message, or if it is not confirmed in time
+        and there is no outbox.
+        """
+        pending = self._enqueue(exchange, routing_key, body, properties)
+        try:
+            pending.future.result(timeout)
+            return True
+        except FutureTimeout:
+            if self.outbox is None:
+                raise PublishError(f"Message not confirmed within {timeout} seconds")
+
+        self._store_in_outbox(pending)
+        logger.warning(f"Message {pending.properties.message_id} to '{routing_key}' not confirmed within {timeout}s; kept in outbox")
+        return False
+
+    def _enqueue(self, exchange, routing_key, body, properties):
+        properties = properties or pika.BasicProperties(delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE)
+        if properties.message_id is None:
+            properties.message_id = uuid.uuid4().hex
+        pending = _Pending(exchange, routing_key, body, properties)
+        self._queue.append(pending)
+        self._schedule_flush()
+        return pending
+
+    def _schedule_flush(self):
+        with self._flush_lock:
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self._ioloop.add_callback_threadsafe(self._flush)
+
+    # Everything below runs on the I/O thread
+
+    def _run(self):
+        self._connect()
+        self._ioloop.start()
+        logger.info("Publisher stopped")
+
+    def _connect(self):
+        if self._stopping.is_set():
+            return
+        logger.info(f"Publisher connecting to RabbitMQ at {self.parameters.host}:{self.parameters.port}")
+        self._connection = pika.SelectConnection(
+            self.parameters,
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_lost,
+            on_close_callback=self._on_connection_lost,
+            custom_ioloop=self._ioloop,
+        )
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.add_on_return_callback(self._on_return)
+        channel.confirm_delivery(ack_nack_callback=self._on_confirm, callback=self._on_confirm_selected)
+
+    def _on_confirm_selected(self, _frame):
+        self._next_tag = 0
+        self._ready = True
+        self._reconnect_delay = PUBLISH_RECONNECT_DELAY
+        logger.info("Publisher connected with confirms enabled")
+        self._flush()
+
+    def _on_channel_closed(self, channel, reason):
+        logger.error(f"Publisher channel closed: {reason}")
+        self._ready = False
+        self._channel = None
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+
+    def _on_connection_lost(self, connection, reason):
+        self._ready = False
+        self._channel = None
+        self._connection = None
+        self._requeue_unconfirmed()
+        if self._stopping.is_set():
+            self._ioloop.stop()
+            return
+        logger.error(f"Publisher connection lost ({reason!r}); reconnecting in {self._reconnect_delay}s")
+        self._ioloop.call_later(self._reconnect_delay, self._connect)
+        self._reconnect_delay = min(self._reconnect_delay * 2, PUBLISH_RECONNECT_MAX_DELAY)
+
+    def _requeue_unconfirmed(self):
+        # Without a confirm the broker may or may not have the message, so it is sent again (at-least-once)
+        for tag in sorted(self._unconfirmed, reverse=True):
+            self._queue.appendleft(self._unconfirmed[tag])
+        self._unconfirmed.clear()
+        self._returned.clear()
+
+    def _shutdown(self):
+        if self._connection is not None and not (self._connection.is_closing or self._connection.is_closed):
+            self._connection.close()
+        else:
+            self._ioloop.stop()
+
+    def _flush(self):
+        with self._flush_lock:
+            self._flush_scheduled = False
+        if not self._ready:
+            return  # flushed again once confirms are enabled on a new channel
+
+        for _ in range(PUBLISH_BATCH_SIZE):
+            try:
+                pending = self._queue.popleft()
+            except IndexError:
+                return
+            try:
+                self._channel.basic_publish(
+                    pending.exchange, pending.routing_key, pending.body, pending.properties, mandatory=True
+                )
+            except Exception as e:
+                logger.error(f"Publisher failed to write message: {e}")
+                self._queue.appendleft(pending)
+                return
+            self._next_tag += 1
+            pending.published = time.monotonic()
+            self._unconfirmed[self._next_tag] = pending
+        self._schedule_flush()
+
+    def _on_return(self, channel, method, properties, body):
+        logger.error(f"Message {properties.message_id} returned by broker: {method.reply_text} ({method.routing_key})")
+        self._returned.add(properties.message_id)
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        if method.multiple:
+            tags = [tag for tag in self._unconfirmed if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+
+        now = time.monotonic()
+        for tag in tags:
+            pending = self._unconfirmed.pop(tag, None)
+            if pending is None:
+                continue
+            self._confirm_lag.observe(now - pending.published)
+            self._latency.observe(now - pending.enqueued)
+            message_id = pending.properties.message_id
+            if message_id in self._returned:
+                self._returned.discard(message_id)
+                pending.future.set_exception(PublishError(f"Message could not be routed to '{pending.routing_key}'"))
+            elif acked:
+                pending.future.set_result(None)
+            else:
+                self._nacks.inc()
+                pending.future.set_exception(PublishError("Message was rejected by the broker"))
+
+    # Outbox
+
+    def _store_in_outbox(self, pending):
+        properties = pending.properties
+        now = _now()
+        self.outbox.insert_one({
+            "_id": properties.message_id,
+            "exchange": pending.exchange,
+            "routing_key": pending.routing_key,
+            "body": pending.body.encode() if isinstance(pending.body, str) else pending.body,
+            "content_type": properties.content_type,
+            "headers": properties.headers,
+            "created_at": now,
+            "next_attempt_at": now + datetime.timedelta(seconds=OUTBOX_LEASE),
+            "attempts": 0,
+        })
+        self._outboxed.inc()
+        # A late confirm of the original publish makes the outbox entry redundant
+        self._track_outboxed(pending.future, properties.message_id)
+
+    def _track_outboxed(self, future, message_id):
+        def settled(f):
+            error = f.exception()
+            if error is None:
+                self._delivered.append(message_id)
+            else:
+                self._rejected.append((message_id, str(error)))
+
+        future.add_done_callback(settled)
+
+    def _relay(self):
+        while not self._stopping.wait(OUTBOX_RELAY_INTERVAL):
+            try:
+                self._relay_once()
+            except Exception as e:
+                logger.error(f"Outbox relay failed: {e}", exc_info=True)
+
+    def _relay_once(self):
+        delivered = []
+        while self._delivered:
+            delivered.append(self._delivered.popleft())
+        if delivered:
+            self.outbox.delete_many({"_id": {"$in": delivered}})
+            logger.info(f"Removed {len(delivered)} confirmed messages from the outbox")
+        while self._rejected:
+            message_id, error = self._rejected.popleft()
+            self.outbox.update_one({"_id": message_id}, {"$set": {"last_error": error, "last_error_at": _now()}})
+
+        relayed = 0
+        for _ in range(OUTBOX_RELAY_BATCH):
+            now = _now()
+            # Leasing the entry keeps other replicas from relaying it at the same time
+            doc = self.outbox.find_one_and_update(
+                {"next_attempt_at": {"$lte": now}},
+                {"$set": {"next_attempt_at": now + datetime.timedelta(seconds=OUTBOX_LEASE)}, "$inc": {"attempts": 1}},
+                return_document=ReturnDocument.AFTER,
+            )
+            if doc is None:
+                break
+            if doc["attempts"] > OUTBOX_MAX_ATTEMPTS:
+                self._dead_letter(doc, now)
+                continue
+            properties = pika.BasicProperties(
+                delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE,
+                message_id=doc["_id"],
+                content_type=doc.get("content_type"),
+                headers=doc.get("headers"),
+            )
+            future = self.publish(doc["routing_key"], doc["body"], properties, exchange=doc["exchange"])
+            self._track_outboxed(future, doc["_id"])
+            relayed += 1
+        if relayed:
+            logger.warning(f"Relayed {relayed} messages from the outbox")
+
+    def _dead_letter(self, doc, now):
+        # Kept for inspection; setting next_attempt_at again puts it back in the relay
+        self.outbox.update_one(
+            {"_id": doc["_id"]},
+            {"$set": {"dead_at": now}, "$unset": {"next_attempt_at": ""}},
+        )
+        self._dead.inc()
+        logger.error(
+            f"Gave up on outboxed message {doc['_id']} to '{doc['routing_key']}' after {OUTBOX_MAX_ATTEMPTS} relays: "
+            f"{doc.get('last_error') or 'never confirmed'}"
+        )
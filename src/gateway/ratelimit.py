@@ -0,0 +1,173 @@
+import collections
+import datetime
+import os
+import threading
+import time
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError, PyMongoError
+import metrics
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Per-user limits as "<requests>/<seconds>": bursts of up to <requests>, refilled evenly over <seconds>.
+# An empty value or "0" disables the limit.
+RATE_LIMITS = {
+    "upload": os.getenv("RATE_LIMIT_UPLOAD", "10/60"),
+    "login": os.getenv("RATE_LIMIT_LOGIN", "5/60"),
+    "download": os.getenv("RATE_LIMIT_DOWNLOAD", "120/60"),
+}
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # memory (per process) or mongo (shared by replicas)
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 100000))  # memory backend; least recently used buckets are dropped past this
+RATE_LIMIT_CAS_ATTEMPTS = 5  # mongo backend; concurrent updates of one bucket retry this often
+
+RATE_LIMITS_COLLECTION = "rate_limits"
+
+
+def parse_limit(value):
+    """
+    Parses "<requests>/<seconds>" into (capacity, tokens per second), or None if disabled.
+    """
+    if not value or value.strip() == "0":
+        return None
+    try:
+        requests, seconds = value.split("/")
+        capacity, seconds = float(requests), float(seconds)
+    except ValueError:
+        raise ValueError(f"Invalid rate limit {value!r}; expected '<requests>/<seconds>'")
+    if capacity <= 0 or seconds <= 0:
+        return None
+    return capacity, capacity / seconds
+
+
+def take(tokens, updated, now, capacity, rate):
+    """
+    Refills a bucket last updated at `updated` and takes one token from it.
+
+    Returns (tokens left, seconds until a token is available); the second is 0
+    when the token was taken.
+    """
+    if tokens is None:
+        tokens = capacity
+    else:
+        tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBackend:
+    """
+    Buckets in this process's memory; with several gateway processes each one enforces the limit separately.
+
+    Buckets are kept in least recently used order, so trimming the table to
+    `max_keys` drops the oldest buckets, which have mostly refilled anyway.
+    """
+
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, scope, key, capacity, rate):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get((scope, key), (None, now))
+            tokens, retry_after = take(tokens, updated, now, capacity, rate)
+            if not retry_after:
+                self._buckets[(scope, key)] = (tokens, now)
+                self._buckets.move_to_end((scope, key))
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            return retry_after
+
+
+class MongoBackend:
+    """
+    Buckets in a MongoDB collection shared by every gateway replica.
+
+    Each bucket is one document updated with compare-and-swap on its `updated`
+    stamp, which works on MongoDB 4.0 (no pipeline updates). Documents expire
+    through a TTL index once their bucket would be full again.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def ensure_indexes(self):
+        self.collection.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+
+    def acquire(self, scope, key, capacity, rate):
+        bucket_id = f"{scope}:{key}"
+        for _ in range(RATE_LIMIT_CAS_ATTEMPTS):
+            doc = self.collection.find_one({"_id": bucket_id})
+            now = time.time()
+            tokens, retry_after = take(
+                doc["tokens"] if doc else None, doc["updated"] if doc else now, now, capacity, rate
+            )
+            if retry_after:
+                # A refused request does not change the bucket
+                return retry_after
+            state = {
+                "tokens": tokens,
+                "updated": now,
+                "expires_at": datetime.datetime.now(tz=datetime.timezone.utc)
+                + datetime.timedelta(seconds=(capacity - tokens) / rate),
+            }
+            if doc is None:
+                try:
+                    self.collection.insert_one({"_id": bucket_id, **state})
+                    return 0.0
+                except DuplicateKeyError:
+                    continue
+            if self.collection.update_one({"_id": bucket_id, "updated": doc["updated"]}, {"$set": state}).modified_count:
+                return 0.0
+        logger.warning(f"Rate limit bucket {bucket_id} is contended; letting the request through")
+        return 0.0
+
+
+class RateLimiter:
+    """
+    Per-user token buckets for the gateway's routes, keyed by scope ('upload', 'login', ...) and user.
+
+    Errors of the backend let the request through: the limiter protects the
+    service and should not take it down with the database.
+    """
+
+    def __init__(self, backend, limits=None):
+        self.backend = backend
+        self.limits = {}
+        for scope, value in (limits or RATE_LIMITS).items():
+            limit = parse_limit(value)
+            if limit:
+                self.limits[scope] = limit
+
+    def check(self, scope, key):
+        """
+        Takes a token for `key` in `scope`; returns 0 if the request may proceed, else the seconds to wait.
+        """
+        limit = self.limits.get(scope)
+        if limit is None or not key:
+            return 0.0
+        try:
+            retry_after = self.backend.acquire(scope, key, *limit)
+        except PyMongoError as e:
+            logger.error(f"Rate limiter backend failed, letting the request through: {e}")
+            return 0.0
+        if retry_after:
+            metrics.counter(f"rate_limited_{scope}_total").inc()
+            logger.warning(f"Rate limited {scope} for {key}; retry in {retry_after:.1f}s")
+        return retry_after
+
+
+def build_limiter(db=None, backend=RATE_LIMIT_BACKEND):
+    """
+    Returns a RateLimiter on the configured backend; the mongo backend needs `db`.
+    """
+    if backend == "mongo":
+        mongo_backend = MongoBackend(db[RATE_LIMITS_COLLECTION])
+        mongo_backend.ensure_indexes()
+        return RateLimiter(mongo_backend)
+    if backend != "memory":
+        raise ValueError(f"Unknown RATE_LIMIT_BACKEND {backend!r}; expected 'memory' or 'mongo'")
+    return RateLimiter(MemoryBackend())
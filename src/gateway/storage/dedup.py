@@ -0,0 +1,98 @@
+import datetime
+from pymongo import ASCENDING, ReturnDocument
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Maps the SHA-256 of uploaded content to its stored video and converted mp3
+CONTENT_INDEX_COLLECTION = "content_index"
+
+STATE_QUEUED = "queued"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+
+def _now():
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+
+def ensure_indexes(content_index):
+    content_index.create_index([("video_file_id", ASCENDING)])
+    content_index.create_index([("mp3_file_id", ASCENDING)], sparse=True)
+
+
+def claim(content_index, sha256, file_id):
+    """
+    Records an upload of `sha256`, registering `file_id` as its video if the content is new.
+
+    Returns (entry, is_new). A failed entry is taken over by the new upload so
+    the content gets converted again.
+
+    Entries are not reference counted: the stored files are only removed by
+    the lifecycle sweeper, which drops an MP3's entry before the MP3 itself.
+    Every upload deduplicated onto a finished MP3 restarts its expiry, so the
+    sweeper never deletes an MP3 within MP3_TTL_DAYS of handing it to a user.
+    """
+    entry = content_index.find_one_and_update(
+        {"_id": sha256},
+        {
+            "$set": {"updated_at": _now()},
+            "$setOnInsert": {
+                "video_file_id": file_id,
+                "mp3_file_id": None,
+                "state": STATE_QUEUED,
+                "waiters": [],
+                "created_at": _now(),
+            },
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    if entry["video_file_id"] == file_id:
+        return entry, True
+
+    if entry["state"] == STATE_FAILED:
+        retried = content_index.find_one_and_update(
+            {"_id": sha256, "state": STATE_FAILED},
+            {"$set": {"video_file_id": file_id, "state": STATE_QUEUED, "waiters": []}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if retried:
+            return retried, True
+        entry = content_index.find_one({"_id": sha256})
+
+    return entry, False
+
+
+def unclaim(content_index, sha256, file_id):
+    """
+    Undoes claim() for new content whose queue message could not be published.
+
+    The entry is removed unless duplicate uploads attached to it meanwhile; it
+    is then marked failed, so the next upload of the content converts it again.
+    Does nothing for a duplicate upload, which never owned the entry.
+    """
+    removed = content_index.delete_one({"_id": sha256, "video_file_id": file_id, "waiters": {"$size": 0}})
+    if removed.deleted_count == 0:
+        content_index.update_one(
+            {"_id": sha256, "video_file_id": file_id, "state": STATE_QUEUED},
+            {"$set": {"state": STATE_FAILED, "updated_at": _now()}},
+        )
+
+
+def add_waiter(content_index, sha256, user_access, job_id=None):
+    """
+    Asks the converter to notify `user_access` when the in-flight conversion finishes.
+
+    Returns False if the conversion completed meanwhile, in which case the
+    caller notifies the user itself.
+    """
+    result = content_index.update_one(
+        {"_id": sha256, "state": {"$ne": STATE_DONE}},
+        {"$push": {"waiters": {
+            "username": user_access.get("username"),
+            "email": user_access.get("email"),
+            "job_id": str(job_id) if job_id else None,
+        }}},
+    )
+    return result.modified_count == 1
@@ -0,0 +1,52 @@
+from flask import Response
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.wsgi import FileWrapper
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+DOWNLOAD_MAX_AGE = 24 * 60 * 60  # GridFS files are immutable, so caches may keep them for a day
+
+
+def file_etag(grid_out):
+    """
+    Strong ETag for a GridFS file, taken from its stored checksum when present.
+    """
+    checksum = getattr(grid_out, "md5", None) or getattr(grid_out, "sha256", None)
+    if checksum:
+        return checksum
+    return f"{grid_out._id}-{grid_out.length}-{int(grid_out.upload_date.timestamp())}"
+
+
+def build_download_response(grid_out, environ, download_name, mimetype="audio/mpeg"):
+    """
+    Serves a GridFS file with Range and conditional GET (If-None-Match / If-Modified-Since) support.
+
+    The body is read one GridFS chunk at a time and a Range request seeks
+    straight to the first chunk it needs, so only the requested bytes are
+    fetched from MongoDB. werkzeug's FileWrapper is used rather than the
+    server's wsgi.file_wrapper: gunicorn's has no seekable(), which makes
+    werkzeug read and discard everything before the range.
+    """
+    response = Response(
+        FileWrapper(grid_out, buffer_size=grid_out.chunk_size),
+        mimetype=mimetype,
+        direct_passthrough=True,
+    )
+    response.content_length = grid_out.length
+    response.set_etag(file_etag(grid_out))
+    response.last_modified = grid_out.upload_date
+    response.cache_control.max_age = DOWNLOAD_MAX_AGE
+    response.headers.set("Content-Disposition", "attachment", filename=download_name)
+    # Advertised on full responses too, so players know they can seek
+    response.headers["Accept-Ranges"] = "bytes"
+
+    # Answers 304 or 206 as appropriate and seeks the GridOut for ranges
+    try:
+        response.make_conditional(environ, accept_ranges=True, complete_length=grid_out.length)
+    except RequestedRangeNotSatisfiable as e:
+        logger.info(f"Download of {grid_out._id} answered with 416 for {environ.get('HTTP_RANGE')}")
+        return e.get_response(environ)
+    if response.status_code != 200:
+        logger.info(f"Download of {grid_out._id} answered with {response.status_code}")
+    return response
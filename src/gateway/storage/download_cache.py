@@ -0,0 +1,453 @@
+import collections
+import datetime
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Tiered cache for /download: hot files in memory, warm ones on local disk, everything else from GridFS
+DOWNLOAD_CACHE_ENABLED = os.getenv("DOWNLOAD_CACHE_ENABLED", "true").lower() == "true"
+DOWNLOAD_CACHE_MEMORY_BYTES = int(os.getenv("DOWNLOAD_CACHE_MEMORY_BYTES", 64 * 1024 * 1024))  # per process
+DOWNLOAD_CACHE_MEMORY_MAX_FILE = int(os.getenv("DOWNLOAD_CACHE_MEMORY_MAX_FILE", 16 * 1024 * 1024))
+DOWNLOAD_CACHE_DIR = os.getenv("DOWNLOAD_CACHE_DIR", os.path.join(tempfile.gettempdir(), "gateway-download-cache"))
+DOWNLOAD_CACHE_DISK_BYTES = int(os.getenv("DOWNLOAD_CACHE_DISK_BYTES", 1024 * 1024 * 1024))  # shared by the pod's processes
+DOWNLOAD_CACHE_DISK_MAX_FILE = int(os.getenv("DOWNLOAD_CACHE_DISK_MAX_FILE", 256 * 1024 * 1024))
+DOWNLOAD_CACHE_DISK_MAX_AGE = int(os.getenv("DOWNLOAD_CACHE_DISK_MAX_AGE", 24 * 60 * 60))  # seconds since last use
+# Seconds a file's GridFS document is trusted before it is read again; GridFS files are immutable,
+# so this only bounds how long a deleted file can still be served
+DOWNLOAD_CACHE_REVALIDATE = float(os.getenv("DOWNLOAD_CACHE_REVALIDATE", 60))
+# Misses of a file before it is copied into the cache; the copy is made in the background
+DOWNLOAD_CACHE_FILL_AFTER = int(os.getenv("DOWNLOAD_CACHE_FILL_AFTER", 2))
+DOWNLOAD_CACHE_FILL_WORKERS = int(os.getenv("DOWNLOAD_CACHE_FILL_WORKERS", 2))  # background copies per process
+# Seconds between rescans of the disk tier, which pick up copies made or removed by the pod's other processes
+DOWNLOAD_CACHE_DISK_RESCAN = float(os.getenv("DOWNLOAD_CACHE_DISK_RESCAN", 10 * 60))
+
+COPY_BUFFER_SIZE = 255 * 1024  # one GridFS chunk
+MAX_KNOWN_FILES = 100000  # validated GridFS documents remembered per process
+PARTIAL_PREFIX = ".partial-"
+
+
+class FileInfo(collections.namedtuple("FileInfo", "file_id length upload_date md5 sha256 chunk_size validated_at")):
+    """
+    The GridFS attributes a download response needs, and when they were last read from MongoDB.
+    """
+
+    @classmethod
+    def from_grid_out(cls, grid_out):
+        return cls(
+            grid_out._id,
+            grid_out.length,
+            grid_out.upload_date,
+            getattr(grid_out, "md5", None),
+            getattr(grid_out, "sha256", None),
+            grid_out.chunk_size,
+            time.monotonic(),
+        )
+
+    @property
+    def validator(self):
+        # Changes if the file behind the id is ever replaced
+        upload_date = self.upload_date
+        if upload_date.tzinfo is None:
+            upload_date = upload_date.replace(tzinfo=datetime.timezone.utc)
+        raw = f"{self.file_id}:{self.length}:{upload_date.timestamp():.3f}:{self.md5 or ''}"
+        return hashlib.sha1(raw.encode()).hexdigest()[:16]
+
+
+class CachedFile:
+    """
+    A cached copy that reads like the GridOut it was made from, so build_download_response serves it unchanged.
+    """
+
+    def __init__(self, info, fileobj):
+        self._id = info.file_id
+        self.length = info.length
+        self.upload_date = info.upload_date
+        self.md5 = info.md5
+        self.sha256 = info.sha256
+        self.chunk_size = info.chunk_size
+        self._fileobj = fileobj
+
+    def read(self, size=-1):
+        return self._fileobj.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._fileobj.seek(offset, whence)
+
+    def tell(self):
+        return self._fileobj.tell()
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self._fileobj.close()
+
+
+class MemoryTier:
+    """
+    LRU of whole files bounded by total bytes.
+    """
+
+    def __init__(self, max_bytes, max_file):
+        self.max_bytes = max_bytes
+        self.max_file = min(max_file, max_bytes)
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._evictions = metrics.counter("download_cache_memory_evictions_total")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, info):
+        entry = self._entries.get(info.file_id)
+        if entry is None:
+            return None
+        validator, data = entry
+        if validator != info.validator:
+            self.discard(info.file_id)
+            return None
+        self._entries.move_to_end(info.file_id)
+        return data
+
+    def put(self, info, data):
+        if len(data) > self.max_file:
+            return
+        self.discard(info.file_id)
+        self._entries[info.file_id] = (info.validator, data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+            self._evictions.inc()
+
+    def discard(self, file_id):
+        entry = self._entries.pop(file_id, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+
+class DiskTier:
+    """
+    Files in a local directory, bounded by total bytes and by time since last use.
+
+    A copy is named after the file id and its validator, so every gateway
+    process of the pod can use it and a replaced file never matches an old
+    copy. Copies are written to a temporary name and renamed into place.
+
+    Each process keeps an index of the copies in least recently used order
+    with their sizes, so eviction pops from its front instead of listing the
+    directory. The index is rebuilt from the directory every `rescan` seconds
+    to account for the other processes' copies; a copy another process removed
+    in between is dropped from the index when it is not found.
+    """
+
+    def __init__(self, directory, max_bytes, max_file, max_age, rescan=DOWNLOAD_CACHE_DISK_RESCAN):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_file = min(max_file, max_bytes)
+        self.max_age = max_age
+        self.rescan = rescan
+        self.size = 0
+        self._index = collections.OrderedDict()  # path -> (size, last used), least recently used first
+        self._lock = threading.Lock()
+        self._scanned_at = None
+        self._evictions = metrics.counter("download_cache_disk_evictions_total")
+        os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._index)
+
+    def path(self, info):
+        return os.path.join(self.directory, f"{info.file_id}.{info.validator}.mp3")
+
+    def _track(self, path, size, used):
+        # Caller holds the lock
+        previous = self._index.pop(path, None)
+        if previous is not None:
+            self.size -= previous[0]
+        self._index[path] = (size, used)
+        self.size += size
+
+    def _forget(self, path):
+        # Caller holds the lock
+        entry = self._index.pop(path, None)
+        if entry is not None:
+            self.size -= entry[0]
+
+    def _scan(self, now):
+        """
+        Rebuilds the index from the directory; removes partial copies left behind by a process that died mid-copy.
+        """
+        copies = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.startswith(PARTIAL_PREFIX):
+                    if now - stat.st_mtime > self.max_age:
+                        self._remove(entry.path)
+                    continue
+                copies.append((stat.st_mtime, stat.st_size, entry.path))
+        copies.sort()
+        with self._lock:
+            self._index.clear()
+            self.size = 0
+            for mtime, size, path in copies:
+                self._track(path, size, mtime)
+            self._scanned_at = time.monotonic()
+
+    def _rescan_due(self):
+        return self._scanned_at is None or time.monotonic() - self._scanned_at >= self.rescan
+
+    def open(self, info):
+        path = self.path(info)
+        now = time.time()
+        try:
+            with self._lock:
+                entry = self._index.get(path)
+            if entry is None:
+                # Possibly copied by another process since the last scan
+                stat = os.stat(path)
+                entry = (stat.st_size, stat.st_mtime)
+            size, used = entry
+            if now - used > self.max_age:
+                self._remove(path)
+                return None
+            fileobj = open(path, "rb")
+        except FileNotFoundError:
+            # Never cached, or evicted by another process
+            with self._lock:
+                self._forget(path)
+            return None
+        with self._lock:
+            self._track(path, size, now)
+        try:
+            # The mtime tells the other processes' scans that the copy is in use
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return fileobj
+
+    def put(self, info, grid_out):
+        """
+        Copies a GridOut to disk chunk by chunk and returns the path of the copy, or None if it is not cached.
+        """
+        if info.length > self.max_file:
+            return None
+        self.evict(reserve=info.length)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=PARTIAL_PREFIX)
+        try:
+            with os.fdopen(fd, "wb") as temp_file:
+                while True:
+                    data = grid_out.read(COPY_BUFFER_SIZE)
+                    if not data:
+                        break
+                    temp_file.write(data)
+                size = temp_file.tell()
+            path = self.path(info)
+            os.replace(temp_path, path)
+        except BaseException:
+            self._remove(temp_path)
+            raise
+        with self._lock:
+            self._track(path, size, time.time())
+        return path
+
+    def _remove(self, path):
+        with self._lock:
+            self._forget(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self, reserve=0):
+        """
+        Deletes copies unused for max_age, then the least recently used ones until `reserve` more bytes fit.
+
+        Returns the bytes the index still holds.
+        """
+        if self._rescan_due():
+            self._scan(time.time())
+        now = time.time()
+        while True:
+            with self._lock:
+                if not self._index:
+                    return self.size
+                path, (size, used) = next(iter(self._index.items()))
+                if now - used <= self.max_age and self.size + reserve <= self.max_bytes:
+                    return self.size
+            self._remove(path)
+            self._evictions.inc()
+
+
+class DownloadCache:
+    """
+    Serves MP3s from memory or local disk, falling back to GridFS.
+
+    A miss is served straight from GridFS. Once a file has missed `fill_after`
+    times, a background thread copies it into the cache, one copy per file at
+    a time, so a request never waits for a copy and a burst of requests for a
+    new file reads it from GridFS once more rather than once per request.
+
+    A file's GridFS document is read again at most every `revalidate` seconds;
+    in between, a hit does not touch MongoDB at all. When the document's
+    upload date, length or md5 no longer match, the cached copies are not used.
+    """
+
+    def __init__(
+        self,
+        memory,
+        disk=None,
+        revalidate=DOWNLOAD_CACHE_REVALIDATE,
+        fill_after=DOWNLOAD_CACHE_FILL_AFTER,
+        fill_workers=DOWNLOAD_CACHE_FILL_WORKERS,
+    ):
+        self.memory = memory
+        self.disk = disk
+        self.revalidate = revalidate
+        self.fill_after = max(1, fill_after)
+        self._infos = collections.OrderedDict()
+        self._missed = collections.OrderedDict()  # file id -> misses not yet followed by a fill
+        self._filling = set()
+        self._lock = threading.Lock()
+        # Threads start on the first fill, so building the cache before gunicorn forks is safe
+        self._fills = ThreadPoolExecutor(max_workers=max(1, fill_workers), thread_name_prefix="download-cache-fill")
+        self._memory_hits = metrics.counter("download_cache_memory_hits_total")
+        self._disk_hits = metrics.counter("download_cache_disk_hits_total")
+        self._misses = metrics.counter("download_cache_misses_total")
+        self._fill_count = metrics.counter("download_cache_fills_total")
+        self._revalidations = metrics.counter("download_cache_revalidations_total")
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                "memory_files": len(self.memory),
+                "memory_bytes": self.memory.size,
+                "known_files": len(self._infos),
+                "filling": len(self._filling),
+            }
+        if self.disk is not None:
+            snapshot.update({"disk_files": len(self.disk), "disk_bytes": self.disk.size})
+        return snapshot
+
+    def _info(self, fs, file_id):
+        """
+        Returns (FileInfo, GridOut or None); the GridOut is only fetched when the info is stale.
+        """
+        with self._lock:
+            info = self._infos.get(file_id)
+        if info is not None and time.monotonic() - info.validated_at < self.revalidate:
+            return info, None
+
+        # Reads only the files document; chunks are fetched when the GridOut is read
+        grid_out = fs.get(file_id)
+        self._revalidations.inc()
+        info = FileInfo.from_grid_out(grid_out)
+        with self._lock:
+            self._infos[file_id] = info
+            self._infos.move_to_end(file_id)
+            if len(self._infos) > MAX_KNOWN_FILES:
+                self._infos.popitem(last=False)
+        return info, grid_out
+
+    def _promote(self, info, fileobj):
+        # Small files read from disk are kept in memory for the next request
+        if info.length <= self.memory.max_file:
+            data = fileobj.read()
+            fileobj.seek(0)
+            with self._lock:
+                self.memory.put(info, data)
+        return CachedFile(info, fileobj)
+
+    def _cacheable(self, info):
+        return info.length <= self.memory.max_file or (self.disk is not None and info.length <= self.disk.max_file)
+
+    def open(self, fs, file_id):
+        """
+        Returns a readable, seekable file for a GridFS file id; raises gridfs.NoFile like fs.get.
+        """
+        info, grid_out = self._info(fs, file_id)
+        with self._lock:
+            data = self.memory.get(info)
+        if data is not None:
+            self._memory_hits.inc()
+            return CachedFile(info, io.BytesIO(data))
+
+        if self.disk is not None:
+            fileobj = self.disk.open(info)
+            if fileobj is not None:
+                self._disk_hits.inc()
+                return self._promote(info, fileobj)
+
+        self._misses.inc()
+        if self._cacheable(info):
+            self._schedule_fill(fs, info)
+        return grid_out if grid_out is not None else fs.get(file_id)
+
+    def _schedule_fill(self, fs, info):
+        file_id = info.file_id
+        with self._lock:
+            if file_id in self._filling:
+                return
+            misses = self._missed.pop(file_id, 0) + 1
+            if misses < self.fill_after:
+                self._missed[file_id] = misses
+                if len(self._missed) > MAX_KNOWN_FILES:
+                    self._missed.popitem(last=False)
+                return
+            self._filling.add(file_id)
+        try:
+            self._fills.submit(self._fill, fs, info)
+        except RuntimeError:
+            # Shutting down
+            with self._lock:
+                self._filling.discard(file_id)
+
+    def _fill(self, fs, info):
+        """
+        Copies a file into the cache on a fill thread; the request that missed is already served from GridFS.
+        """
+        try:
+            # A GridOut of its own: the one that missed is being read by the response
+            grid_out = fs.get(info.file_id)
+            path = self.disk.put(info, grid_out) if self.disk is not None else None
+            if path is not None:
+                if info.length <= self.memory.max_file:
+                    with open(path, "rb") as fileobj:
+                        self._promote(info, fileobj)
+            elif info.length <= self.memory.max_file:
+                grid_out.seek(0)
+                data = grid_out.read()
+                with self._lock:
+                    self.memory.put(info, data)
+            self._fill_count.inc()
+        except Exception as e:
+            # A full or unwritable disk, or a file deleted meanwhile, only costs the cache
+            logger.error(f"Failed to cache download {info.file_id}: {e}")
+        finally:
+            with self._lock:
+                self._filling.discard(info.file_id)
+
+
+def build_cache():
+    """
+    Returns the configured DownloadCache, or None when caching is disabled.
+    """
+    if not DOWNLOAD_CACHE_ENABLED:
+        return None
+    memory = MemoryTier(DOWNLOAD_CACHE_MEMORY_BYTES, DOWNLOAD_CACHE_MEMORY_MAX_FILE)
+    disk = None
+    if DOWNLOAD_CACHE_DISK_BYTES > 0:
+        disk = DiskTier(DOWNLOAD_CACHE_DIR, DOWNLOAD_CACHE_DISK_BYTES, DOWNLOAD_CACHE_DISK_MAX_FILE, DOWNLOAD_CACHE_DISK_MAX_AGE)
+    return DownloadCache(memory, disk)
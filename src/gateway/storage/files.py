@@ -0,0 +1,131 @@
+import base64
+import datetime
+import json
+import os
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo import ASCENDING, DESCENDING
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# GridFS files collection of the MP3 database; the converter stores each MP3's metadata on it
+MP3_FILES_COLLECTION = "fs.files"
+
+FILE_LIST_LIMIT = int(os.getenv("FILE_LIST_LIMIT", 50))
+FILE_LIST_MAX_LIMIT = int(os.getenv("FILE_LIST_MAX_LIMIT", 200))
+
+# Fields a listing may ask for, mapped to their path in fs.files
+FIELDS = {
+    "filename": "filename",
+    "size": "length",
+    "duration": "metadata.duration",
+    "bitrate": "metadata.bitrate",
+    "video_file_id": "metadata.video_file_id",
+    "created_at": "metadata.created_at",
+}
+
+# Listing order; the cursor holds the last row's values of these keys
+SORT = [("metadata.created_at", DESCENDING), ("_id", DESCENDING)]
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class CursorError(ValueError):
+    """
+    Raised for a listing cursor that was not produced by encode_cursor.
+    """
+
+
+def ensure_indexes(mp3_files):
+    # A user's MP3s newest first, matching SORT so a page is a bounded index scan
+    mp3_files.create_index([("metadata.owners", ASCENDING), *SORT])
+    # MP3s by source video
+    mp3_files.create_index([("metadata.video_file_id", ASCENDING)])
+
+
+def add_owner(mp3_files, mp3_fid, username):
+    """
+    Lists an existing MP3 under another user, for uploads deduplicated onto it.
+
+    Also stamps `metadata.shared_at`, from which the lifecycle sweeper counts
+    MP3_TTL_DAYS, so the MP3 does not expire right after it was handed out.
+    """
+    if mp3_files is None or not username:
+        return
+    try:
+        mp3_files.update_one(
+            {"_id": ObjectId(mp3_fid)},
+            {"$addToSet": {"metadata.owners": username}, "$set": {"metadata.shared_at": datetime.datetime.now(tz=datetime.timezone.utc)}},
+        )
+    except Exception as e:
+        logger.error(f"Failed to add owner {username} to MP3 {mp3_fid}: {e}")
+
+
+def _as_utc(value):
+    # pymongo returns naive UTC datetimes unless the client is tz_aware
+    return value if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)
+
+
+def encode_cursor(doc):
+    created_at = _as_utc(doc["metadata"]["created_at"])
+    position = {"t": (created_at - _EPOCH) // datetime.timedelta(milliseconds=1), "id": str(doc["_id"])}
+    return base64.urlsafe_b64encode(json.dumps(position, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        created_at = _EPOCH + datetime.timedelta(milliseconds=int(position["t"]))
+        return created_at, ObjectId(position["id"])
+    except (ValueError, TypeError, KeyError, InvalidId) as e:
+        raise CursorError("Invalid cursor") from e
+
+
+def parse_fields(value):
+    """
+    Returns the requested field names from a comma-separated list, or all fields.
+    """
+    if not value:
+        return list(FIELDS)
+    fields = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = [name for name in fields if name not in FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def list_files(mp3_files, username, cursor=None, limit=FILE_LIST_LIMIT, fields=None):
+    """
+    Returns one page of a user's MP3s, newest first, and the cursor of the next page (None on the last).
+
+    Pages continue after the cursor's (created_at, _id) rather than skipping
+    rows, so every page costs the same however long the user's history is.
+    """
+    fields = fields or list(FIELDS)
+    query = {"metadata.owners": username}
+    if cursor:
+        created_at, last_id = decode_cursor(cursor)
+        query["$or"] = [
+            {"metadata.created_at": {"$lt": created_at}},
+            {"metadata.created_at": created_at, "_id": {"$lt": last_id}},
+        ]
+    projection = {FIELDS[name]: 1 for name in fields}
+    projection["metadata.created_at"] = 1
+
+    limit = max(1, min(limit, FILE_LIST_MAX_LIMIT))
+    docs = list(mp3_files.find(query, projection).sort(SORT).limit(limit + 1))
+    next_cursor = encode_cursor(docs[limit - 1]) if len(docs) > limit else None
+    return docs[:limit], next_cursor
+
+
+def to_json(doc, fields=None):
+    body = {"file_id": str(doc["_id"])}
+    for name in fields or FIELDS:
+        value = doc
+        for key in FIELDS[name].split("."):
+            value = value.get(key) if isinstance(value, dict) else None
+        if isinstance(value, datetime.datetime):
+            value = _as_utc(value).isoformat()
+        body[name] = value
+    return body
@@ -0,0 +1,100 @@
+import datetime
+import os
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo import ASCENDING, DESCENDING
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Shared with the converter, which reports progress and completion on the same documents
+JOBS_COLLECTION = "jobs"
+
+STATE_QUEUED = "queued"
+STATE_CONVERTING = "converting"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+FINAL_STATES = (STATE_DONE, STATE_FAILED)
+
+JOB_LIST_LIMIT = int(os.getenv("JOB_LIST_LIMIT", 50))
+
+
+def _now():
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+
+def ensure_indexes(jobs):
+    # A user's jobs by state, and all jobs by state for dashboards, newest first
+    jobs.create_index([("username", ASCENDING), ("state", ASCENDING), ("updated_at", DESCENDING)])
+    jobs.create_index([("state", ASCENDING), ("updated_at", DESCENDING)])
+
+
+def parse_id(job_id):
+    try:
+        return ObjectId(job_id)
+    except (InvalidId, TypeError):
+        return None
+
+
+def create_job(jobs, video_file_id, user_access):
+    now = _now()
+    job_id = jobs.insert_one({
+        "video_file_id": str(video_file_id),
+        "audio_file_id": None,
+        "username": user_access.get("username"),
+        "state": STATE_QUEUED,
+        "progress": 0,
+        "error": None,
+        "created_at": now,
+        "updated_at": now,
+    }).inserted_id
+    logger.info(f"Created job {job_id} for video {video_file_id}")
+    return job_id
+
+
+def record_queue_response(jobs, job_id, response):
+    """
+    Brings a freshly created job in line with how its upload was queued.
+
+    Failed uploads fail the job, and a duplicate of already converted content
+    finishes it straight away.
+    """
+    if not response["status"]:
+        update = {"state": STATE_FAILED, "error": str(response["message"])}
+    else:
+        details = response["details"]
+        update = {"video_file_id": details["file_id"]}
+        if details.get("audio_file_id"):
+            update.update({"state": STATE_DONE, "progress": 100, "audio_file_id": details["audio_file_id"]})
+    update["updated_at"] = _now()
+    jobs.update_one({"_id": job_id}, {"$set": update})
+
+
+def get_job(jobs, job_id, username):
+    """
+    Returns the job if it exists and belongs to `username`, else None.
+    """
+    job_id = parse_id(job_id)
+    if job_id is None:
+        return None
+    return jobs.find_one({"_id": job_id, "username": username})
+
+
+def list_jobs(jobs, username, state=None, limit=JOB_LIST_LIMIT):
+    query = {"username": username}
+    if state:
+        query["state"] = state
+    return list(jobs.find(query).sort("updated_at", DESCENDING).limit(limit))
+
+
+def to_json(job):
+    return {
+        "job_id": str(job["_id"]),
+        "state": job["state"],
+        "progress": job.get("progress", 0),
+        "video_file_id": job.get("video_file_id"),
+        "audio_file_id": job.get("audio_file_id"),
+        "error": job.get("error"),
+        "created_at": job["created_at"].isoformat(),
+        "updated_at": job["updated_at"].isoformat(),
+    }
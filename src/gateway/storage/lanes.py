@@ -0,0 +1,53 @@
+import os
+from storage import jobs as job_store
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Conversion lanes, highest priority first; the converter consumes all of them.
+# 'video' keeps its original declaration, so existing deployments need no queue migration.
+LANE_PRIORITY = "video.priority"
+LANE_DEFAULT = "video"
+LANE_BULK = "video.bulk"
+LANES = (LANE_PRIORITY, LANE_DEFAULT, LANE_BULK)
+
+# Uploads of a user with no other unfinished job jump ahead; a user with at least
+# LANE_BULK_THRESHOLD unfinished jobs (this one included) is demoted to the bulk lane
+LANE_PRIORITY_ENABLED = os.getenv("LANE_PRIORITY_ENABLED", "true").lower() == "true"
+LANE_BULK_THRESHOLD = int(os.getenv("LANE_BULK_THRESHOLD", 10))  # 0 disables demotion
+
+ACTIVE_STATES = (job_store.STATE_QUEUED, job_store.STATE_CONVERTING)
+
+
+def declare(channel):
+    for lane in LANES:
+        channel.queue_declare(queue=lane, durable=True)
+
+
+def count_active(jobs, username):
+    """
+    Counts a user's jobs that are queued or converting, stopping at LANE_BULK_THRESHOLD.
+    """
+    limit = max(LANE_BULK_THRESHOLD, 2)
+    # Served by the (username, state, updated_at) index; the limit bounds the cost for heavy users
+    return jobs.count_documents({"username": username, "state": {"$in": list(ACTIVE_STATES)}}, limit=limit)
+
+
+def pick_lane(jobs, username):
+    """
+    Returns the queue for a user's next upload, based on how much of their work is still unfinished.
+
+    Without a jobs collection or a username every upload goes to the default lane.
+    """
+    if jobs is None or not username:
+        return LANE_DEFAULT
+    try:
+        active = count_active(jobs, username)
+    except Exception as e:
+        logger.error(f"Failed to count active jobs of {username}: {e}")
+        return LANE_DEFAULT
+    if LANE_BULK_THRESHOLD > 0 and active >= LANE_BULK_THRESHOLD:
+        return LANE_BULK
+    if LANE_PRIORITY_ENABLED and active <= 1:
+        return LANE_PRIORITY
+    return LANE_DEFAULT
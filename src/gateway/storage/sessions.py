@@ -0,0 +1,229 @@
+import hashlib
+import os
+import time
+import uuid
+import datetime
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, ReturnDocument
+from storage import util
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Resumable upload session settings
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", 24 * 60 * 60))  # seconds of inactivity before a session expires
+UPLOAD_SESSION_GC_INTERVAL = int(os.getenv("UPLOAD_SESSION_GC_INTERVAL", 5 * 60))  # seconds between expiry sweeps
+SESSIONS_COLLECTION = "upload_sessions"
+
+_last_gc = 0.0
+
+
+class SessionError(Exception):
+    """
+    Raised for invalid session operations; carries the HTTP status to answer with.
+    """
+
+    def __init__(self, message, status, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def _now():
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+
+def ensure_indexes(db):
+    db[SESSIONS_COLLECTION].create_index([("expires_at", ASCENDING)])
+    db.fs.chunks.create_index([("files_id", ASCENDING), ("n", ASCENDING)], unique=True)
+
+
+def create_session(db, storage_system, user, length, filename=None, chunk_size=util.UPLOAD_CHUNK_SIZE):
+    """
+    Opens an upload session backed by a pending GridFS file document.
+    """
+    if not isinstance(length, int) or length <= 0:
+        raise SessionError("'length' must be a positive integer", 400)
+    if length > util.MAX_UPLOAD_BYTES:
+        raise SessionError(f"Upload exceeds the maximum size of {util.MAX_UPLOAD_BYTES} bytes", 413)
+
+    collect_expired(db, storage_system)
+
+    file_id = ObjectId()
+    now = _now()
+    db.fs.files.insert_one({
+        "_id": file_id,
+        "filename": filename,
+        "length": 0,
+        "chunkSize": chunk_size,
+        "uploadDate": now,
+        "metadata": {"pending": True, "owner": user.get("username")},
+    })
+    session = {
+        "_id": uuid.uuid4().hex,
+        "file_id": file_id,
+        "username": user.get("username"),
+        "filename": filename,
+        "length": length,
+        "offset": 0,
+        "chunk_size": chunk_size,
+        "created_at": now,
+        "expires_at": now + datetime.timedelta(seconds=UPLOAD_SESSION_TTL),
+    }
+    db[SESSIONS_COLLECTION].insert_one(session)
+    logger.info(f"Upload session {session['_id']} opened for file {file_id} ({length} bytes)")
+    return session
+
+
+def get_session(db, session_id, user):
+    session = db[SESSIONS_COLLECTION].find_one({"_id": session_id, "username": user.get("username")})
+    if not session or session["expires_at"].replace(tzinfo=datetime.timezone.utc) < _now():
+        raise SessionError("Upload session not found", 404)
+    return session
+
+
+def _persist(db, session, offset, data):
+    """
+    Writes bytes that start at `offset` into the session's GridFS chunks and advances the offset.
+    """
+    n = offset // session["chunk_size"]
+    db.fs.chunks.replace_one(
+        {"files_id": session["file_id"], "n": n},
+        {"files_id": session["file_id"], "n": n, "data": Binary(data)},
+        upsert=True,
+    )
+    new_offset = offset + len(data)
+    updated = db[SESSIONS_COLLECTION].find_one_and_update(
+        {"_id": session["_id"], "offset": session["offset"]},
+        {"$set": {
+            "offset": new_offset,
+            "expires_at": _now() + datetime.timedelta(seconds=UPLOAD_SESSION_TTL),
+        }},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not updated:
+        raise SessionError("Upload session was modified concurrently", 409)
+    return updated
+
+
+def write_range(db, session_id, user, start, stream):
+    """
+    Appends the body of a PUT to the session, starting at byte `start`.
+
+    `start` must equal the current offset; a client that lost track of it asks
+    for the offset and resumes from there. Progress is persisted chunk by chunk,
+    so a connection dropped mid-request keeps everything already received.
+    """
+    session = get_session(db, session_id, user)
+    if start != session["offset"]:
+        raise SessionError("Range does not start at the current offset", 409, offset=session["offset"])
+
+    chunk_size = session["chunk_size"]
+    n, position = divmod(start, chunk_size)
+    buffer = b""
+    if position:
+        # Resume filling the trailing partial chunk
+        partial = db.fs.chunks.find_one({"files_id": session["file_id"], "n": n})
+        buffer = bytes(partial["data"]) if partial else b""
+    chunk_start = n * chunk_size
+
+    try:
+        while True:
+            data = stream.read(chunk_size - len(buffer))
+            if not data:
+                break
+            if chunk_start + len(buffer) + len(data) > session["length"]:
+                raise SessionError("Range extends past the declared upload length", 416, offset=session["offset"])
+            buffer += data
+            if len(buffer) == chunk_size:
+                session = _persist(db, session, chunk_start, buffer)
+                chunk_start += chunk_size
+                buffer = b""
+    except SessionError:
+        raise
+    except Exception:
+        # Keep whatever arrived before the connection dropped
+        if len(buffer) > session["offset"] - chunk_start:
+            _persist(db, session, chunk_start, buffer)
+        raise
+
+    if len(buffer) > session["offset"] - chunk_start:
+        session = _persist(db, session, chunk_start, buffer)
+    return session
+
+
+def _checksum(db, session):
+    """
+    Returns the SHA-256 of the session's stored chunks, read back in order.
+    """
+    checksum = hashlib.sha256()
+    length = 0
+    for chunk in db.fs.chunks.find({"files_id": session["file_id"]}, {"data": 1}).sort("n", ASCENDING):
+        data = bytes(chunk["data"])
+        checksum.update(data)
+        length += len(data)
+    if length != session["length"]:
+        raise SessionError("Stored upload does not match the declared length", 409, offset=session["offset"])
+    return checksum.hexdigest()
+
+
+def finalize(db, session_id, user, storage_system, publisher, jobs=None, content_index=None, mp3_files=None):
+    """
+    Completes the pending file and queues it exactly like a one-shot upload.
+
+    The session is removed atomically, so of two concurrent finalize calls only
+    one queues the conversion; the other gets a 409. The SHA-256 is computed
+    from the stored chunks, so finished sessions are deduplicated and weighed
+    by size like streamed uploads.
+    """
+    session = get_session(db, session_id, user)
+    if session["offset"] != session["length"]:
+        raise SessionError("Upload is incomplete", 409, offset=session["offset"])
+
+    session = db[SESSIONS_COLLECTION].find_one_and_delete({"_id": session["_id"], "offset": session["length"]})
+    if session is None:
+        raise SessionError("Upload session is already being finalized", 409)
+
+    try:
+        sha256 = _checksum(db, session)
+        db.fs.files.update_one(
+            {"_id": session["file_id"]},
+            {
+                "$set": {"length": session["length"], "uploadDate": _now(), "sha256": sha256},
+                "$unset": {"metadata.pending": ""},
+            },
+        )
+    except Exception:
+        # Put the session back so the client can retry the finalize
+        db[SESSIONS_COLLECTION].insert_one(session)
+        raise
+    logger.info(f"Upload session {session['_id']} finalized as file {session['file_id']} (sha256={sha256})")
+    return util.queue_upload(
+        session["file_id"], sha256, storage_system, publisher, user, content_index=content_index, jobs=jobs,
+        mp3_files=mp3_files, size=session["length"],
+    )
+
+
+def collect_expired(db, storage_system, force=False):
+    """
+    Deletes expired sessions together with their pending GridFS files.
+
+    Runs at most once per UPLOAD_SESSION_GC_INTERVAL per process unless forced.
+    """
+    global _last_gc
+    if not force and time.monotonic() - _last_gc < UPLOAD_SESSION_GC_INTERVAL:
+        return 0
+    _last_gc = time.monotonic()
+
+    removed = 0
+    for session in db[SESSIONS_COLLECTION].find({"expires_at": {"$lt": _now()}}, {"file_id": 1}):
+        try:
+            storage_system.delete(session["file_id"])
+            db[SESSIONS_COLLECTION].delete_one({"_id": session["_id"]})
+            removed += 1
+        except Exception as e:
+            logger.exception(f"Failed to collect expired upload session {session['_id']}: {e}")
+    if removed:
+        logger.info(f"Collected {removed} expired upload sessions")
+    return removed
@@ -1,37 +1,81 @@
-import pika  # For RabbitMQ communication
+import os
 import json
 import time
+import hashlib
+from storage import dedup, files, jobs as job_store, lanes
 from logger import get_logger
 
 logger = get_logger(__name__)
 
-def upload_file_to_storage_and_queue(file_obj, storage_system, rabbitmq_channel, user_access):
+# Streaming upload settings
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 255 * 1024))  # matches the GridFS default chunk size
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 4 * 1024 * 1024 * 1024))  # 4 GiB
+
+
+class UploadTooLarge(Exception):
+    """
+    Raised when an upload exceeds MAX_UPLOAD_BYTES.
+    """
+
+
+def stream_to_storage(stream, storage_system, filename=None, max_bytes=MAX_UPLOAD_BYTES, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Copies a readable stream into a new GridFS file chunk by chunk.
+
+    At most `chunk_size` bytes of the body are held in memory at any time and a
+    SHA-256 checksum is computed on the fly and stored on the file document.
+    The partially written file is aborted if the stream fails or grows past `max_bytes`.
+
+    Returns:
+    - tuple: (file_id, length, sha256 hex digest)
+    """
+    checksum = hashlib.sha256()
+    length = 0
+    grid_in = storage_system.new_file(filename=filename, chunk_size=chunk_size)
     try:
-        file_id = storage_system.put(file_obj)
-        logger.info(f"File uploaded successfully with ID: {file_id}")
-    except Exception as upload_error:
-        logger.exception(f"File upload failed: {upload_error}")
-        return {
-            "status": False,
-            "message": "File upload failed",
-            "details": str(upload_error)
-        }
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            length += len(chunk)
+            if length > max_bytes:
+                raise UploadTooLarge(f"Upload exceeds the maximum size of {max_bytes} bytes")
+            checksum.update(chunk)
+            grid_in.write(chunk)
+        grid_in.sha256 = checksum.hexdigest()
+        grid_in.close()
+    except BaseException:
+        grid_in.abort()
+        raise
 
+    return grid_in._id, length, checksum.hexdigest()
+
+
+def publish_video_message(file_id, storage_system, publisher, user_access, content_sha256=None, job_id=None, queue=lanes.LANE_DEFAULT, size=None):
+    """
+    Publishes the conversion message for a stored file to `queue`, deleting the file again if publishing fails.
+
+    `size` is the upload's length in bytes; the converter weighs its fair scheduling by it.
+    """
     message_payload = {
         "video_file_id": str(file_id),
         "audio_file_id": None,
         "username": user_access.get("username"),
         "email": user_access.get("email")
     }
+    if content_sha256:
+        message_payload["content_sha256"] = content_sha256
+    if job_id:
+        message_payload["job_id"] = str(job_id)
+    if size is not None:
+        message_payload["size"] = size
 
     try:
-        rabbitmq_channel.basic_publish(
-            exchange='',
-            routing_key='video',
-            body=json.dumps(message_payload),
-            properties=pika.BasicProperties(delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE)
+        # Raises on a broker nack, so the rollback below also covers messages the broker dropped
+        confirmed = publisher.publish_and_wait(queue, json.dumps(message_payload))
+        logger.info(
+            f"Message {'published' if confirmed else 'queued in outbox'} for RabbitMQ queue '{queue}': {message_payload}"
         )
-        logger.info(f"Message published to RabbitMQ queue 'video': {message_payload}")
     except Exception as publish_error:
         logger.exception(f"Failed to publish message to RabbitMQ: {publish_error}")
         try:
@@ -58,6 +102,141 @@ def upload_file_to_storage_and_queue(file_obj, storage_system, rabbitmq_channel,
         "message": "File uploaded and message published successfully",
         "details": {
             "file_id": str(file_id),
-            "queue": "video"
+            "queue": queue
+        }
+    }
+
+
+def publish_mp3_message(video_file_id, mp3_file_id, publisher, user_access):
+    """
+    Publishes an already-completed 'mp3' message so the user is notified without a new conversion.
+    """
+    message_payload = {
+        "video_file_id": str(video_file_id),
+        "audio_file_id": str(mp3_file_id),
+        "username": user_access.get("username"),
+        "email": user_access.get("email")
+    }
+    publisher.publish_and_wait('mp3', json.dumps(message_payload))
+    logger.info(f"Message published to RabbitMQ queue 'mp3': {message_payload}")
+
+
+def queue_deduplicated(file_id, sha256, storage_system, publisher, user_access, content_index, job_id=None, mp3_files=None, queue=lanes.LANE_DEFAULT, size=None):
+    """
+    Queues a stored upload, collapsing it onto earlier uploads of the same content.
+
+    New content is published to `queue` as usual. For a duplicate, the fresh
+    copy is deleted and the user either gets the finished mp3 straight away or
+    is attached to the conversion already in flight.
+    """
+    entry, is_new = dedup.claim(content_index, sha256, file_id)
+    if is_new:
+        response = publish_video_message(
+            file_id, storage_system, publisher, user_access, content_sha256=sha256, job_id=job_id, queue=queue, size=size
+        )
+        if not response["status"]:
+            dedup.unclaim(content_index, sha256, file_id)
+        return response
+
+    try:
+        storage_system.delete(file_id)
+    except Exception as delete_error:
+        logger.exception(f"Failed to delete duplicate upload {file_id}: {delete_error}")
+    logger.info(f"Upload {file_id} duplicates content {sha256} stored as {entry['video_file_id']}")
+
+    details = {"file_id": str(entry["video_file_id"]), "deduplicated": True}
+    try:
+        if entry["state"] != dedup.STATE_DONE and dedup.add_waiter(content_index, sha256, user_access, job_id):
+            details["queue"] = queue
+            return {"status": True, "message": "Identical file is already being converted", "details": details}
+
+        entry = content_index.find_one({"_id": sha256})
+        # Restarts the MP3's expiry before the user is told about it
+        files.add_owner(mp3_files, entry["mp3_file_id"], user_access.get("username"))
+        publish_mp3_message(entry["video_file_id"], entry["mp3_file_id"], publisher, user_access)
+        details.update({"queue": "mp3", "audio_file_id": str(entry["mp3_file_id"])})
+        return {"status": True, "message": "Identical file was already converted", "details": details}
+    except Exception as publish_error:
+        logger.exception(f"Failed to attach duplicate upload to content {sha256}: {publish_error}")
+        dedup.unclaim(content_index, sha256, file_id)
+        return {
+            "status": False,
+            "message": "Failed to publish message to RabbitMQ",
+            "details": str(publish_error)
         }
-    }
\ No newline at end of file
+
+
+def queue_upload(file_id, sha256, storage_system, publisher, user_access, content_index=None, jobs=None, mp3_files=None, size=None):
+    """
+    Queues a stored upload for conversion, tracking it as a job when a jobs collection is given.
+
+    The lane is picked from the user's unfinished jobs, so one user's bulk
+    upload queues behind everyone else's work instead of in front of it.
+    """
+    job_id = job_store.create_job(jobs, file_id, user_access) if jobs is not None else None
+    queue = lanes.pick_lane(jobs, user_access.get("username"))
+    if content_index is not None and sha256:
+        response = queue_deduplicated(
+            file_id, sha256, storage_system, publisher, user_access, content_index,
+            job_id=job_id, mp3_files=mp3_files, queue=queue, size=size
+        )
+    else:
+        response = publish_video_message(file_id, storage_system, publisher, user_access, job_id=job_id, queue=queue, size=size)
+
+    if job_id is not None:
+        job_store.record_queue_response(jobs, job_id, response)
+        if response["status"]:
+            response["details"]["job_id"] = str(job_id)
+    return response
+
+
+def upload_file_to_storage_and_queue(file_obj, storage_system, publisher, user_access, content_index=None, jobs=None, mp3_files=None):
+    """
+    Stores a multipart file upload and queues it for conversion.
+
+    Raises UploadTooLarge so the caller can answer with 413, like the streaming path.
+    """
+    try:
+        file_id, length, sha256 = stream_to_storage(file_obj, storage_system, filename=getattr(file_obj, "filename", None))
+        logger.info(f"File uploaded successfully with ID: {file_id}")
+    except UploadTooLarge:
+        raise
+    except Exception as upload_error:
+        logger.exception(f"File upload failed: {upload_error}")
+        return {
+            "status": False,
+            "message": "File upload failed",
+            "details": str(upload_error)
+        }
+
+    return queue_upload(file_id, sha256, storage_system, publisher, user_access, content_index, jobs, mp3_files, size=length)
+
+
+def stream_file_to_storage_and_queue(stream, storage_system, publisher, user_access, filename=None, content_index=None, jobs=None, mp3_files=None):
+    """
+    Streaming counterpart of upload_file_to_storage_and_queue for raw request bodies.
+
+    Raises UploadTooLarge so the caller can answer with 413; every other failure
+    is reported in the returned dict like the buffered path.
+    """
+    started = time.monotonic()
+    try:
+        file_id, length, sha256 = stream_to_storage(stream, storage_system, filename=filename)
+        logger.info(
+            f"File streamed successfully with ID: {file_id} ({length} bytes, sha256={sha256}) "
+            f"in {time.monotonic() - started:.2f}s"
+        )
+    except UploadTooLarge:
+        raise
+    except Exception as upload_error:
+        logger.exception(f"File upload failed: {upload_error}")
+        return {
+            "status": False,
+            "message": "File upload failed",
+            "details": str(upload_error)
+        }
+
+    response = queue_upload(file_id, sha256, storage_system, publisher, user_access, content_index, jobs, mp3_files, size=length)
+    if response["status"]:
+        response["details"].update({"size": length, "sha256": sha256})
+    return response
@@ -0,0 +1,34 @@
+import json
+import os
+import sys
+import mongomock
+import mongomock.gridfs
+import pytest
+
+# The gateway's modules import each other from the service directory, as they do in the image
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+mongomock.gridfs.enable_gridfs_integration()
+
+
+class FakePublisher:
+    """
+    Records what would have been published instead of talking to RabbitMQ.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def publish_and_wait(self, queue, body):
+        self.messages.append((queue, json.loads(body)))
+        return True
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient()["videos-db"]
+
+
+@pytest.fixture
+def publisher():
+    return FakePublisher()
@@ -0,0 +1,47 @@
+from admission import AdmissionGate
+
+
+def gate(readings, high=100, low=50, per_consumer=0):
+    gate = AdmissionGate(pool=None, queues=["video"], high=high, low=low, per_consumer=per_consumer, cache_seconds=0)
+    readings = iter(readings)
+    gate._read = lambda: next(readings)
+    return gate
+
+
+def admitted(gate, count):
+    return [gate.check().admitted for _ in range(count)]
+
+
+def test_refuses_at_high_and_resumes_below_low():
+    readings = [(99, 1), (100, 1), (80, 1), (50, 1), (49, 1), (80, 1)]
+
+    assert admitted(gate(readings), len(readings)) == [True, False, False, False, True, True]
+
+
+def test_without_low_watermark_resumes_below_high():
+    readings = [(100, 1), (100, 1), (99, 1)]
+
+    assert admitted(gate(readings, low=0), len(readings)) == [False, False, True]
+
+
+def test_low_above_high_resumes_below_high():
+    readings = [(100, 1), (99, 1)]
+
+    assert admitted(gate(readings, low=200), len(readings)) == [False, True]
+
+
+def test_per_consumer_limit_scales_with_consumers():
+    readings = [(20, 5), (20, 4), (17, 4), (15, 4)]
+
+    assert admitted(gate(readings, high=0, per_consumer=5), len(readings)) == [True, False, False, True]
+
+
+def test_refusal_grows_retry_after_with_the_backlog():
+    decision = gate([(400, 1)]).check()
+
+    assert not decision.admitted
+    assert decision.retry_after > gate([(100, 1)]).check().retry_after
+
+
+def test_disabled_gate_never_reads():
+    assert gate([], high=0, per_consumer=0).check().admitted
@@ -0,0 +1,139 @@
+import types
+import pytest
+import requests
+from auth_svc import client as client_module
+from auth_svc.client import AuthServiceClient, CircuitBreaker, CircuitOpenError
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(client_module, "time", types.SimpleNamespace(monotonic=lambda: clock.now, sleep=lambda s: None))
+    return clock
+
+
+class Session:
+    """
+    Answers each post with the next scripted outcome: a status code, (status code, headers) or an exception to raise.
+    """
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def post(self, url, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        if isinstance(outcome, tuple):
+            status_code, headers = outcome
+        else:
+            status_code, headers = outcome, {}
+        return types.SimpleNamespace(status_code=status_code, headers=headers)
+
+
+def make_client(*outcomes, failures=2, reset=30):
+    client = AuthServiceClient(base_url="http://auth")
+    client.session = Session(*outcomes)
+    client.breaker = CircuitBreaker(failure_threshold=failures, reset_timeout=reset)
+    return client
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    assert breaker.allow()
+
+    breaker.record_failure()
+
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_breaker_allows_one_trial_after_the_reset_timeout(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.failures == 0
+
+
+def test_failed_trial_reopens_the_circuit(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    breaker.allow()
+
+    breaker.record_failure()
+
+    assert breaker.state == "open"
+    clock.now += 30
+    assert breaker.allow()
+
+
+def test_success_resets_the_failure_count(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert breaker.state == "closed"
+
+
+def test_connection_errors_are_retried(clock):
+    client = make_client(requests.exceptions.ConnectionError("refused"), 200)
+
+    assert client.post("/login").status_code == 200
+    assert client.session.calls == 2
+
+
+def test_open_circuit_fails_without_calling(clock):
+    client = make_client(requests.exceptions.ConnectionError("refused"), requests.exceptions.ConnectionError("refused"))
+
+    # The second failure opens the circuit, so the last retry is not sent
+    with pytest.raises(CircuitOpenError):
+        client.post("/login")
+    with pytest.raises(CircuitOpenError):
+        client.post("/login")
+    assert client.session.calls == 2
+
+
+@pytest.mark.parametrize("error", [requests.exceptions.ChunkedEncodingError("cut off"), requests.exceptions.ContentDecodingError("bad gzip")])
+def test_other_request_errors_settle_the_half_open_trial(clock, error):
+    client = make_client(error, 200, failures=1)
+    client.breaker.record_failure()
+    clock.now += 30
+
+    with pytest.raises(type(error)):
+        client.post("/login")
+    assert client.breaker.state == "open"
+    assert client.session.calls == 1
+
+    clock.now += 30
+    assert client.post("/login").status_code == 200
+    assert client.breaker.state == "closed"
+
+
+def test_unavailable_answers_are_retried(clock):
+    client = make_client(503, 200)
+
+    assert client.post("/login").status_code == 200
+    assert client.session.calls == 2
+
+
+def test_shed_load_is_neither_retried_nor_a_failure(clock):
+    shed = (503, {"Retry-After": "1"})
+    client = make_client(*[shed] * 5, failures=2)
+
+    for _ in range(5):
+        assert client.post("/login").status_code == 503
+
+    assert client.session.calls == 5
+    assert client.breaker.state == "closed"
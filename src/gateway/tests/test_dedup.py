@@ -0,0 +1,96 @@
+import datetime
+import gridfs
+import pytest
+from storage import dedup, files, util
+
+SHA = "a" * 64
+USER = {"username": "bob", "email": "bob@example.com"}
+
+
+@pytest.fixture
+def content_index(db):
+    return db[dedup.CONTENT_INDEX_COLLECTION]
+
+
+def test_first_upload_owns_new_content(content_index):
+    entry, is_new = dedup.claim(content_index, SHA, "video-1")
+
+    assert is_new
+    assert entry["video_file_id"] == "video-1"
+    assert entry["state"] == dedup.STATE_QUEUED
+
+
+def test_duplicate_upload_reuses_the_entry(content_index):
+    dedup.claim(content_index, SHA, "video-1")
+
+    entry, is_new = dedup.claim(content_index, SHA, "video-2")
+
+    assert not is_new
+    assert entry["video_file_id"] == "video-1"
+
+
+def test_failed_content_is_taken_over(content_index):
+    dedup.claim(content_index, SHA, "video-1")
+    content_index.update_one({"_id": SHA}, {"$set": {"state": dedup.STATE_FAILED}})
+
+    entry, is_new = dedup.claim(content_index, SHA, "video-2")
+
+    assert is_new
+    assert entry["video_file_id"] == "video-2"
+    assert entry["state"] == dedup.STATE_QUEUED
+
+
+def test_unclaim_removes_unpublished_content(content_index):
+    dedup.claim(content_index, SHA, "video-1")
+
+    dedup.unclaim(content_index, SHA, "video-1")
+
+    assert content_index.find_one({"_id": SHA}) is None
+
+
+def test_unclaim_with_waiters_marks_content_failed(content_index):
+    dedup.claim(content_index, SHA, "video-1")
+    dedup.claim(content_index, SHA, "video-2")
+    assert dedup.add_waiter(content_index, SHA, USER)
+
+    dedup.unclaim(content_index, SHA, "video-1")
+
+    assert content_index.find_one({"_id": SHA})["state"] == dedup.STATE_FAILED
+    _, is_new = dedup.claim(content_index, SHA, "video-3")
+    assert is_new
+
+
+def test_unclaim_of_a_duplicate_keeps_the_entry(content_index):
+    dedup.claim(content_index, SHA, "video-1")
+    dedup.claim(content_index, SHA, "video-2")
+
+    dedup.unclaim(content_index, SHA, "video-2")
+
+    entry = content_index.find_one({"_id": SHA})
+    assert entry["video_file_id"] == "video-1"
+    assert entry["state"] == dedup.STATE_QUEUED
+
+
+def test_no_waiter_after_conversion_is_done(content_index):
+    dedup.claim(content_index, SHA, "video-1")
+    content_index.update_one({"_id": SHA}, {"$set": {"state": dedup.STATE_DONE}})
+
+    assert not dedup.add_waiter(content_index, SHA, USER)
+
+
+def test_duplicate_of_converted_content_restarts_the_mp3_expiry(db, content_index, publisher):
+    videos = gridfs.GridFS(db)
+    mp3s = gridfs.GridFS(db.client["mp3s-db"])
+    mp3_files = db.client["mp3s-db"][files.MP3_FILES_COLLECTION]
+    mp3_fid = mp3s.put(b"mp3", metadata={"owners": ["alice"]})
+    dedup.claim(content_index, SHA, "video-1")
+    content_index.update_one({"_id": SHA}, {"$set": {"state": dedup.STATE_DONE, "mp3_file_id": mp3_fid}})
+    started = datetime.datetime.now(tz=datetime.timezone.utc)
+
+    response = util.queue_deduplicated(videos.put(b"video"), SHA, videos, publisher, USER, content_index, mp3_files=mp3_files)
+
+    assert response["details"]["audio_file_id"] == str(mp3_fid)
+    metadata = mp3_files.find_one({"_id": mp3_fid})["metadata"]
+    assert metadata["owners"] == ["alice", "bob"]
+    assert metadata["shared_at"].replace(tzinfo=datetime.timezone.utc) >= started.replace(microsecond=0)
+    assert publisher.messages[0][0] == "mp3"
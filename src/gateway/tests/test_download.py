@@ -0,0 +1,112 @@
+import datetime
+import gridfs
+import pytest
+from werkzeug.http import http_date
+from werkzeug.test import EnvironBuilder
+from storage import download
+
+DATA = bytes(range(256)) * 40  # 10240 bytes
+CHUNK = 1024
+
+
+class ServerFileWrapper:
+    """
+    Stands in for gunicorn's wsgi.file_wrapper, which has no seekable().
+    """
+
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(self.blksize), b"")
+
+
+@pytest.fixture
+def grid_out(db):
+    fs = gridfs.GridFS(db)
+    file_id = fs.put(DATA, filename="song.mp3", chunk_size=CHUNK)
+    grid_out = fs.get(file_id)
+
+    # Records the position of every read, to show which bytes were fetched
+    reads = grid_out.reads = []
+    read = grid_out.read
+
+    def recording_read(size=-1):
+        start = grid_out.tell()
+        data = read(size)
+        reads.append((start, len(data)))
+        return data
+
+    grid_out.read = recording_read
+    return grid_out
+
+
+def respond(grid_out, **headers):
+    environ = EnvironBuilder(path="/download", headers=headers).get_environ()
+    environ["wsgi.file_wrapper"] = ServerFileWrapper
+    response = download.build_download_response(grid_out, environ, "song.mp3")
+    return response, b"".join(response.get_app_iter(environ))
+
+
+def test_full_download(grid_out):
+    response, body = respond(grid_out)
+
+    assert response.status_code == 200
+    assert body == DATA
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.headers["ETag"] == f'"{download.file_etag(grid_out)}"'
+
+
+def test_range_reads_only_the_requested_bytes(grid_out):
+    response, body = respond(grid_out, Range="bytes=9000-9099")
+
+    assert response.status_code == 206
+    assert body == DATA[9000:9100]
+    assert response.headers["Content-Range"] == f"bytes 9000-9099/{len(DATA)}"
+    assert min(start for start, _ in grid_out.reads) == 9000
+
+
+def test_suffix_range_reads_only_the_tail(grid_out):
+    response, body = respond(grid_out, Range="bytes=-1000")
+
+    assert response.status_code == 206
+    assert body == DATA[-1000:]
+    assert sum(length for _, length in grid_out.reads) == 1000
+
+
+def test_unsatisfiable_range(grid_out):
+    response, _ = respond(grid_out, Range=f"bytes={len(DATA)}-")
+
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == f"bytes */{len(DATA)}"
+
+
+def test_matching_etag_is_not_modified(grid_out):
+    response, body = respond(grid_out, **{"If-None-Match": f'"{download.file_etag(grid_out)}"'})
+
+    assert response.status_code == 304
+    assert body == b""
+    assert grid_out.reads == []
+
+
+def test_other_etag_gets_the_file(grid_out):
+    response, body = respond(grid_out, **{"If-None-Match": '"stale"'})
+
+    assert response.status_code == 200
+    assert body == DATA
+
+
+def test_unchanged_since_is_not_modified(grid_out):
+    response, _ = respond(grid_out, **{"If-Modified-Since": http_date(grid_out.upload_date)})
+
+    assert response.status_code == 304
+
+
+def test_etag_falls_back_to_id_length_and_date():
+    class Stored:
+        _id = "abc"
+        length = 10
+        upload_date = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+    assert download.file_etag(Stored()) == f"abc-10-{int(Stored.upload_date.timestamp())}"
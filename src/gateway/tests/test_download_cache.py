@@ -0,0 +1,149 @@
+import os
+import gridfs
+import pytest
+from storage import download_cache
+from storage.download_cache import DiskTier, DownloadCache, FileInfo, MemoryTier
+
+
+class InlineFills:
+    """
+    Runs background fills on submit, so a test sees the cache filled when open() returns.
+    """
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, *args):
+        self.submitted.append(args[-1].file_id)
+        fn(*args)
+
+
+@pytest.fixture
+def fs(db):
+    return gridfs.GridFS(db)
+
+
+def make_cache(tmp_path, memory_max_file=100, disk=True, fill_after=2):
+    memory = MemoryTier(max_bytes=1000, max_file=memory_max_file)
+    disk_tier = DiskTier(str(tmp_path), max_bytes=1000, max_file=500, max_age=3600) if disk else None
+    cache = DownloadCache(memory, disk_tier, revalidate=60, fill_after=fill_after)
+    cache._fills = InlineFills()
+    return cache
+
+
+def test_first_miss_is_served_from_gridfs_without_a_copy(fs, tmp_path):
+    file_id = fs.put(b"a" * 50)
+    cache = make_cache(tmp_path)
+
+    file = cache.open(fs, file_id)
+
+    assert isinstance(file, gridfs.GridOut)
+    assert file.read() == b"a" * 50
+    assert cache._fills.submitted == []
+    assert len(cache.disk) == 0
+
+
+def test_second_miss_fills_both_tiers(fs, tmp_path):
+    file_id = fs.put(b"a" * 50)
+    cache = make_cache(tmp_path)
+
+    cache.open(fs, file_id)
+    assert cache.open(fs, file_id).read() == b"a" * 50
+
+    assert cache._fills.submitted == [file_id]
+    assert len(cache.memory) == 1 and len(cache.disk) == 1
+    hit = cache.open(fs, file_id)
+    assert isinstance(hit, download_cache.CachedFile)
+    assert hit.seekable()
+    assert hit.read() == b"a" * 50
+
+
+def test_large_file_is_served_from_disk(fs, tmp_path):
+    file_id = fs.put(b"b" * 300)
+    cache = make_cache(tmp_path, fill_after=1)
+
+    cache.open(fs, file_id)
+    hit = cache.open(fs, file_id)
+
+    assert len(cache.memory) == 0
+    hit.seek(290)
+    assert hit.read() == b"b" * 10
+
+
+def test_file_too_large_for_both_tiers_is_never_filled(fs, tmp_path):
+    file_id = fs.put(b"c" * 600)
+    cache = make_cache(tmp_path, fill_after=1)
+
+    cache.open(fs, file_id)
+
+    assert cache._fills.submitted == []
+
+
+def test_fill_in_progress_is_not_started_again(fs, tmp_path):
+    file_id = fs.put(b"a" * 50)
+    cache = make_cache(tmp_path, fill_after=1)
+    cache._filling.add(file_id)
+
+    cache.open(fs, file_id)
+
+    assert cache._fills.submitted == []
+
+
+def test_failed_fill_serves_from_gridfs_and_can_retry(fs, tmp_path, monkeypatch):
+    file_id = fs.put(b"a" * 50)
+    cache = make_cache(tmp_path, memory_max_file=10, fill_after=1)
+
+    def full_disk(info, grid_out):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(cache.disk, "put", full_disk)
+    assert cache.open(fs, file_id).read() == b"a" * 50
+    assert not cache._filling
+
+    monkeypatch.undo()
+    cache.open(fs, file_id)
+    assert len(cache.disk) == 1
+
+
+def info(file_id, length):
+    return FileInfo(file_id, length, download_cache.datetime.datetime(2024, 1, 1), None, None, 255, 0)
+
+
+class Stored:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size=-1):
+        data, self.data = self.data, b""
+        return data
+
+
+def test_disk_evicts_least_recently_used_without_listing(tmp_path, monkeypatch):
+    disk = DiskTier(str(tmp_path), max_bytes=300, max_file=300, max_age=3600)
+    for name in "abc":
+        disk.put(info(name, 100), Stored(b"x" * 100))
+    disk.open(info("a", 100)).close()
+
+    def no_listing(path):
+        raise AssertionError("evict listed the directory")
+
+    monkeypatch.setattr(download_cache.os, "scandir", no_listing)
+    disk.put(info("d", 100), Stored(b"x" * 100))
+
+    assert disk.size == 300
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(disk.path(info(name, 100))) for name in "acd")
+
+
+def test_disk_index_picks_up_copies_of_other_processes(tmp_path):
+    first = DiskTier(str(tmp_path), max_bytes=300, max_file=300, max_age=3600)
+    second = DiskTier(str(tmp_path), max_bytes=300, max_file=300, max_age=3600)
+    first.put(info("a", 100), Stored(b"x" * 100))
+
+    fileobj = second.open(info("a", 100))
+    assert fileobj.read() == b"x" * 100
+    fileobj.close()
+    assert second.size == 100
+
+    first.evict(reserve=300)
+    assert second.open(info("a", 100)) is None
+    assert second.size == 0
@@ -0,0 +1,68 @@
+import threading
+import pytest
+import main
+from storage import jobs as job_store
+
+USER = {"username": "alice", "email": "alice@example.com"}
+
+
+@pytest.fixture
+def jobs(db, monkeypatch):
+    jobs = db[job_store.JOBS_COLLECTION]
+    monkeypatch.setattr(main, "jobs", jobs)
+    monkeypatch.setattr(main, "authorized_user", lambda: (USER, None))
+    monkeypatch.setattr(main, "JOB_POLL_INTERVAL", 0)
+    monkeypatch.setattr(main, "JOB_STREAM_MAX_SECONDS", 0)
+    monkeypatch.setattr(main, "job_streams", threading.BoundedSemaphore(1))
+    return jobs
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+def events(body):
+    return [dict(line.split(": ", 1) for line in block.splitlines()) for block in body.strip().split("\n\n")]
+
+
+def test_stream_sends_retry_and_the_job_then_closes(jobs, client):
+    job_id = job_store.create_job(jobs, "video", USER)
+
+    response = client.get(f"/jobs/{job_id}/events")
+
+    retry, event = events(response.get_data(as_text=True))
+    assert retry == {"retry": "2000"}
+    assert event["event"] == job_store.STATE_QUEUED
+    assert event["id"] == jobs.find_one({"_id": job_id})["updated_at"].isoformat()
+
+
+def test_reconnect_skips_the_event_it_has_seen(jobs, client):
+    job_id = job_store.create_job(jobs, "video", USER)
+    version = jobs.find_one({"_id": job_id})["updated_at"].isoformat()
+
+    response = client.get(f"/jobs/{job_id}/events", headers={"Last-Event-ID": version})
+
+    assert events(response.get_data(as_text=True)) == [{"retry": "2000"}]
+
+
+def test_reconnect_after_the_final_event_is_told_to_stop(jobs, client):
+    job_id = job_store.create_job(jobs, "video", USER)
+    job_store.record_queue_response(jobs, job_id, {"status": False, "message": "broken"})
+    version = jobs.find_one({"_id": job_id})["updated_at"].isoformat()
+
+    response = client.get(f"/jobs/{job_id}/events", headers={"Last-Event-ID": version})
+
+    assert response.status_code == 204
+
+
+def test_streams_past_the_cap_are_refused(jobs, client):
+    job_id = job_store.create_job(jobs, "video", USER)
+    open_stream = client.get(f"/jobs/{job_id}/events", buffered=False)
+
+    refused = client.get(f"/jobs/{job_id}/events")
+    assert refused.status_code == 503
+    assert refused.headers["Retry-After"] == "2"
+
+    open_stream.close()
+    assert client.get(f"/jobs/{job_id}/events").status_code == 200
@@ -0,0 +1,89 @@
+import datetime
+from concurrent.futures import Future
+import mongomock
+import pytest
+import publisher as publisher_module
+from publisher import Publisher, PublishError
+
+
+class RecordingPublisher(Publisher):
+    """
+    A Publisher whose relay publishes into futures the test settles, instead of a broker.
+    """
+
+    def __init__(self, outbox):
+        super().__init__(parameters=None, outbox=outbox)
+        self.published = []
+
+    def publish(self, routing_key, body, properties=None, exchange=""):
+        future = Future()
+        self.published.append((properties.message_id, future))
+        return future
+
+
+@pytest.fixture
+def outbox():
+    return mongomock.MongoClient()["videos-db"][publisher_module.OUTBOX_COLLECTION]
+
+
+@pytest.fixture
+def publisher(outbox):
+    return RecordingPublisher(outbox)
+
+
+def outboxed(outbox, message_id="m1", attempts=0):
+    outbox.insert_one({
+        "_id": message_id,
+        "exchange": "",
+        "routing_key": "video",
+        "body": b"{}",
+        "next_attempt_at": publisher_module._now() - datetime.timedelta(seconds=1),
+        "attempts": attempts,
+    })
+
+
+def make_due(outbox):
+    outbox.update_many({"dead_at": {"$exists": False}}, {"$set": {"next_attempt_at": publisher_module._now()}})
+
+
+def test_confirmed_relay_removes_the_entry(outbox, publisher):
+    outboxed(outbox)
+
+    publisher._relay_once()
+    [(message_id, future)] = publisher.published
+    future.set_result(None)
+    publisher._relay_once()
+
+    assert message_id == "m1"
+    assert outbox.count_documents({}) == 0
+
+
+def test_rejected_relay_records_the_error(outbox, publisher):
+    outboxed(outbox)
+
+    publisher._relay_once()
+    publisher.published[0][1].set_exception(PublishError("Message could not be routed to 'video'"))
+    publisher._relay_once()
+
+    entry = outbox.find_one({"_id": "m1"})
+    assert entry["attempts"] == 1
+    assert entry["last_error"] == "Message could not be routed to 'video'"
+
+
+def test_entry_is_dead_lettered_after_max_attempts(outbox, publisher, monkeypatch):
+    monkeypatch.setattr(publisher_module, "OUTBOX_MAX_ATTEMPTS", 2)
+    outboxed(outbox)
+
+    for _ in range(3):
+        publisher._relay_once()
+        for _, future in publisher.published:
+            if not future.done():
+                future.set_exception(PublishError("Message was rejected by the broker"))
+        make_due(outbox)
+    publisher._relay_once()
+
+    assert len(publisher.published) == 2
+    entry = outbox.find_one({"_id": "m1"})
+    assert entry["dead_at"] is not None
+    assert "next_attempt_at" not in entry
+    assert entry["last_error"] == "Message was rejected by the broker"
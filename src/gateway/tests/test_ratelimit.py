@@ -0,0 +1,60 @@
+import types
+import pytest
+import ratelimit
+from ratelimit import MemoryBackend, parse_limit, take
+
+
+def test_parse_limit():
+    assert parse_limit("10/60") == (10.0, 10.0 / 60)
+    assert parse_limit("0") is None
+    assert parse_limit("") is None
+    with pytest.raises(ValueError):
+        parse_limit("ten")
+
+
+def test_new_bucket_starts_full():
+    assert take(None, 0, 0, capacity=3, rate=1) == (2, 0.0)
+
+
+def test_empty_bucket_reports_when_a_token_is_due():
+    tokens, retry_after = take(0.25, 10, 10, capacity=3, rate=0.5)
+
+    assert tokens == 0.25
+    assert retry_after == pytest.approx(1.5)
+
+
+def test_bucket_refills_with_time_up_to_capacity():
+    assert take(0, 10, 12, capacity=3, rate=0.5) == (0, 0.0)
+    assert take(0, 0, 1000, capacity=3, rate=0.5) == (2, 0.0)
+    # A clock that went backwards refills nothing
+    assert take(0.5, 10, 5, capacity=3, rate=0.5)[1] > 0
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=100.0)
+    monkeypatch.setattr(ratelimit, "time", types.SimpleNamespace(monotonic=lambda: clock.now, time=lambda: clock.now))
+    return clock
+
+
+def test_memory_backend_limits_bursts(clock):
+    backend = MemoryBackend()
+
+    results = [backend.acquire("upload", "alice", 2, 1.0) for _ in range(3)]
+
+    assert results[:2] == [0.0, 0.0]
+    assert results[2] == pytest.approx(1.0)
+    clock.now += 1
+    assert backend.acquire("upload", "alice", 2, 1.0) == 0.0
+
+
+def test_memory_backend_drops_least_recently_used_buckets(clock):
+    backend = MemoryBackend(max_keys=2)
+    backend.acquire("upload", "alice", 1, 0.001)
+    backend.acquire("upload", "bob", 1, 0.001)
+    # alice is refused, which does not make her bucket recently used
+    assert backend.acquire("upload", "alice", 1, 0.001) > 0
+
+    backend.acquire("upload", "carol", 1, 0.001)
+
+    assert list(backend._buckets) == [("upload", "bob"), ("upload", "carol")]
@@ -0,0 +1,136 @@
+import hashlib
+import io
+import gridfs
+import pytest
+from storage import sessions
+
+USER = {"username": "alice", "email": "alice@example.com"}
+CHUNK = 8
+
+
+class DroppedConnection(io.BytesIO):
+    """
+    A request body whose connection drops after `limit` bytes.
+    """
+
+    def __init__(self, data, limit):
+        super().__init__(data)
+        self.limit = limit
+
+    def read(self, size=-1):
+        if self.tell() >= self.limit:
+            raise ConnectionResetError("client went away")
+        return super().read(min(size, self.limit - self.tell()))
+
+
+@pytest.fixture
+def fs(db):
+    return gridfs.GridFS(db)
+
+
+def open_session(db, fs, length):
+    return sessions.create_session(db, fs, USER, length, "clip.mp4", chunk_size=CHUNK)
+
+
+def test_write_range_advances_offset(db, fs):
+    session = open_session(db, fs, 20)
+
+    session = sessions.write_range(db, session["_id"], USER, 0, io.BytesIO(b"a" * 11))
+
+    assert session["offset"] == 11
+    assert sessions.get_session(db, session["_id"], USER)["offset"] == 11
+
+
+def test_write_range_rejects_wrong_offset(db, fs):
+    session = open_session(db, fs, 20)
+    sessions.write_range(db, session["_id"], USER, 0, io.BytesIO(b"a" * 5))
+
+    with pytest.raises(sessions.SessionError) as error:
+        sessions.write_range(db, session["_id"], USER, 3, io.BytesIO(b"b"))
+
+    assert error.value.status == 409
+    assert error.value.offset == 5
+
+
+def test_write_range_rejects_bytes_past_length(db, fs):
+    session = open_session(db, fs, 4)
+
+    with pytest.raises(sessions.SessionError) as error:
+        sessions.write_range(db, session["_id"], USER, 0, io.BytesIO(b"a" * 5))
+
+    assert error.value.status == 416
+
+
+def test_dropped_connection_keeps_received_bytes_and_resumes(db, fs):
+    data = bytes(range(20))
+    session = open_session(db, fs, len(data))
+
+    with pytest.raises(ConnectionResetError):
+        sessions.write_range(db, session["_id"], USER, 0, DroppedConnection(data, 11))
+    offset = sessions.get_session(db, session["_id"], USER)["offset"]
+    assert offset == 11
+
+    # The resumed range fills the partial chunk left by the dropped request
+    session = sessions.write_range(db, session["_id"], USER, offset, io.BytesIO(data[offset:]))
+    assert session["offset"] == len(data)
+    chunks = db.fs.chunks.find({"files_id": session["file_id"]}).sort("n")
+    assert b"".join(bytes(chunk["data"]) for chunk in chunks) == data
+
+
+def test_finalize_requires_complete_upload(db, fs, publisher):
+    session = open_session(db, fs, 10)
+    sessions.write_range(db, session["_id"], USER, 0, io.BytesIO(b"a" * 4))
+
+    with pytest.raises(sessions.SessionError) as error:
+        sessions.finalize(db, session["_id"], USER, fs, publisher)
+
+    assert error.value.status == 409
+    assert error.value.offset == 4
+    assert publisher.messages == []
+
+
+def test_finalize_completes_file_and_queues_it_with_size_and_hash(db, fs, publisher):
+    data = b"0123456789abcdefghij"
+    session = open_session(db, fs, len(data))
+    sessions.write_range(db, session["_id"], USER, 0, io.BytesIO(data))
+
+    response = sessions.finalize(db, session["_id"], USER, fs, publisher)
+
+    assert response["status"]
+    assert fs.get(session["file_id"]).read() == data
+    sha256 = hashlib.sha256(data).hexdigest()
+    assert db.fs.files.find_one({"_id": session["file_id"]})["sha256"] == sha256
+    [(_, message)] = publisher.messages
+    assert message["size"] == len(data)
+    with pytest.raises(sessions.SessionError) as error:
+        sessions.get_session(db, session["_id"], USER)
+    assert error.value.status == 404
+
+
+def test_finalize_deduplicates_against_earlier_uploads(db, fs, publisher):
+    data = b"same content"
+    content_index = db["content_index"]
+    for _ in range(2):
+        session = open_session(db, fs, len(data))
+        sessions.write_range(db, session["_id"], USER, 0, io.BytesIO(data))
+        sessions.finalize(db, session["_id"], USER, fs, publisher, content_index=content_index)
+
+    # The second upload is attached to the first conversion instead of queueing another
+    assert len(publisher.messages) == 1
+    entry = content_index.find_one({"_id": hashlib.sha256(data).hexdigest()})
+    assert len(entry["waiters"]) == 1
+
+
+def test_concurrent_finalize_queues_once(db, fs, publisher, monkeypatch):
+    data = b"a" * 10
+    session = open_session(db, fs, len(data))
+    session = sessions.write_range(db, session["_id"], USER, 0, io.BytesIO(data))
+    sessions.finalize(db, session["_id"], USER, fs, publisher)
+
+    # A retry that read the session before the first call removed it
+    monkeypatch.setattr(sessions, "get_session", lambda *args: session)
+    with pytest.raises(sessions.SessionError) as error:
+        sessions.finalize(db, session["_id"], USER, fs, publisher)
+
+    assert error.value.status == 409
+    assert len(publisher.messages) == 1
@@ -0,0 +1,58 @@
+import types
+import pytest
+from auth_validate import cache as cache_module
+from auth_validate.cache import TokenCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(cache_module, "time", types.SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def test_hit_until_ttl(clock):
+    cache = TokenCache(ttl=60)
+    cache.put("Bearer a", "alice")
+
+    clock.now += 59
+    assert cache.get("Bearer a") == "alice"
+    clock.now += 1
+    assert cache.get("Bearer a") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert len(cache) == 0
+
+
+def test_token_exp_shortens_ttl(clock):
+    cache = TokenCache(ttl=60)
+    cache.put("Bearer a", "alice", exp=clock.now + 10)
+
+    clock.now += 10
+    assert cache.get("Bearer a") is None
+
+
+def test_expired_token_is_not_cached(clock):
+    cache = TokenCache(ttl=60)
+    cache.put("Bearer a", "alice", exp=clock.now - 1)
+
+    assert len(cache) == 0
+
+
+def test_least_recently_used_is_evicted(clock):
+    cache = TokenCache(max_size=2, ttl=60)
+    cache.put("Bearer a", "alice")
+    cache.put("Bearer b", "bob")
+    cache.get("Bearer a")
+
+    cache.put("Bearer c", "carol")
+
+    assert cache.get("Bearer b") is None
+    assert cache.get("Bearer a") == "alice"
+    assert cache.get("Bearer c") == "carol"
+
+
+def test_raw_tokens_are_not_kept(clock):
+    cache = TokenCache()
+    cache.put("Bearer secret", "alice")
+
+    assert all("secret" not in key for key in cache._entries)
@@ -0,0 +1,153 @@
+import asyncio
+import os
+import aio_pika
+from aio_pika.exceptions import AMQPError
+from send import async_email
+import retry
+from dotenv import load_dotenv
+from logger import get_logger
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = get_logger(__name__)
+
+# RabbitMQ settings
+RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "localhost")
+RABBITMQ_USER = os.getenv("RABBITMQ_USER", "admin")
+RABBITMQ_PASSWORD = os.getenv("RABBITMQ_PASSWORD", "securepassword")
+RABBITMQ_PORT = int(os.getenv("RABBITMQ_PORT", 5672))
+RABBITMQ_RETRY_DELAY = 5  # seconds, doubled per failed attempt
+RABBITMQ_MAX_RETRY_DELAY = 60  # seconds
+
+# Deliveries handled at once; also the prefetch, so RabbitMQ never hands over more than can be worked on
+NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", 200))
+NOTIFY_SEND_TIMEOUT = float(os.getenv("NOTIFY_SEND_TIMEOUT", 60))  # seconds per email, including the wait for an SMTP session
+
+
+async def declare_queues(channel, queue):
+    """
+    Declares `queue` with its delay and dead-letter queues, matching retry.declare.
+    """
+    for attempt in range(1, retry.RETRY_MAX_ATTEMPTS):
+        await channel.declare_queue(
+            retry.retry_queue_name(queue, attempt), durable=True, arguments=retry.retry_queue_arguments(queue, attempt)
+        )
+    await channel.declare_queue(retry.dead_letter_queue_name(queue), durable=True)
+    return await channel.declare_queue(queue, durable=True)
+
+
+async def route_failure(channel, queue, message, reason):
+    """
+    Async counterpart of retry.handle_failure.
+    """
+    target, headers, attempt, dead = retry.route(message.headers, queue, reason)
+    try:
+        await channel.default_exchange.publish(
+            aio_pika.Message(
+                message.body,
+                headers=headers,
+                content_type=message.content_type,
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            ),
+            routing_key=target,
+        )
+    except Exception as e:
+        logger.error(f"Failed to route message to {target}: {e}; requeueing", exc_info=True)
+        await message.nack(requeue=True)
+        return
+    await message.ack()
+    retry.log_routed(target, attempt, dead, reason)
+
+
+async def handle(channel, queue, message, pool, slots):
+    async with slots:
+        logger.info(f"Received message: {message.body}")
+        try:
+            err = await asyncio.wait_for(async_email.notification(message.body, pool), NOTIFY_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            err = f"Email not sent within {NOTIFY_SEND_TIMEOUT} seconds"
+        except Exception as e:
+            logger.error(f"Error in message callback: {e}", exc_info=True)
+            err = e
+
+        try:
+            if err:
+                logger.error(f"Failed to process message: {err}")
+                await route_failure(channel, queue, message, err)
+            else:
+                await message.ack()
+        except (AMQPError, RuntimeError) as e:
+            # The channel went away (aiormq raises ChannelInvalidStateError, a RuntimeError, on a
+            # closed channel); the broker redelivers the message after reconnecting
+            logger.error(f"Could not settle message: {e}")
+
+
+def log_task_error(task):
+    """
+    Logs a delivery task that died with an exception, which nothing else awaits to see.
+    """
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Delivery task failed: {task.exception()}", exc_info=task.exception())
+
+
+async def consume(queue_name):
+    """
+    Consumes `queue_name` with up to NOTIFY_CONCURRENCY deliveries in flight.
+
+    A lost connection is re-established in this loop with capped exponential
+    backoff. Deliveries still in flight when it drops are left unacked, and the
+    broker redelivers them.
+    """
+    pool = async_email.AsyncSMTPPool()
+    slots = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+    tasks = set()
+    delay = RABBITMQ_RETRY_DELAY
+
+    try:
+        while True:
+            try:
+                logger.info("Connecting to RabbitMQ...")
+                connection = await aio_pika.connect(
+                    host=RABBITMQ_HOST, port=RABBITMQ_PORT, login=RABBITMQ_USER, password=RABBITMQ_PASSWORD
+                )
+            except (AMQPError, OSError, asyncio.TimeoutError) as e:
+                logger.error(f"Failed to connect to RabbitMQ: {e}; retrying in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RABBITMQ_MAX_RETRY_DELAY)
+                continue
+            delay = RABBITMQ_RETRY_DELAY
+
+            closed = asyncio.Event()
+            connection.close_callbacks.add(lambda *args: closed.set())
+            try:
+                channel = await connection.channel()
+                await channel.set_qos(prefetch_count=NOTIFY_CONCURRENCY)
+                queue = await declare_queues(channel, queue_name)
+
+                async def on_message(message):
+                    task = asyncio.create_task(handle(channel, queue_name, message, pool, slots))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    task.add_done_callback(log_task_error)
+
+                await queue.consume(on_message)
+                logger.info(
+                    f"Connected to RabbitMQ. Waiting for messages on queue: {queue_name} "
+                    f"({NOTIFY_CONCURRENCY} concurrent deliveries)"
+                )
+                await closed.wait()
+                logger.error("RabbitMQ connection closed; reconnecting")
+            except AMQPError as e:
+                logger.error(f"RabbitMQ connection error: {e}; reconnecting")
+            finally:
+                if tasks:
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                if not connection.is_closed:
+                    await connection.close()
+    finally:
+        await pool.close()
+
+
+def run(queue_name):
+    asyncio.run(consume(queue_name))
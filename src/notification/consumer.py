@@ -3,6 +3,7 @@ import sys
 import os
 import time
 from send import email
+import retry
 from dotenv import load_dotenv
 from logger import get_logger
 # Load environment variables from .env file
@@ -19,6 +20,13 @@ RABBITMQ_PORT = os.getenv("RABBITMQ_PORT", 5672)
 RABBITMQ_RETRY_COUNT = 5
 RABBITMQ_RETRY_DELAY = 5  # seconds
 
+# Micro-batching: deliveries are sent over one SMTP session and acked together
+NOTIFY_BATCH_SIZE = int(os.getenv("NOTIFY_BATCH_SIZE", 50))
+NOTIFY_FLUSH_INTERVAL = float(os.getenv("NOTIFY_FLUSH_INTERVAL", 1.0))  # seconds
+
+# "batch" sends each micro-batch in order on one SMTP session; "async" keeps many deliveries in flight (see async_consumer)
+CONSUMER_MODE = os.getenv("CONSUMER_MODE", "batch")
+
 
 # RabbitMQ connection setup with retries
 def connect_rabbitmq():
@@ -40,45 +48,101 @@ def connect_rabbitmq():
                 raise Exception("Max retries reached. Could not connect to RabbitMQ.")
 
 
-def main():
-    mp3_queue = os.getenv("MP3_QUEUE", "mp3")
+def send_batch(channel, queue, batch, sender):
+    """
+    Sends every message of a batch, routes failures to the retry queues and acks the successes at once.
+    """
+    last_success = None
+    acked = failed = 0
+    for method, properties, body in batch:
+        try:
+            logger.info(f"Received message: {body}")
+            err = email.notification(body, sender)
+        except Exception as e:
+            logger.error(f"Error in message callback: {e}", exc_info=True)
+            err = e
+        if err:
+            logger.error(f"Failed to process message: {err}")
+            retry.handle_failure(channel, queue, method.delivery_tag, properties, body, err)
+            failed += 1
+        else:
+            last_success = method.delivery_tag
+            acked += 1
+
+    # Failures are already settled, so a multiple ack covers exactly the successful deliveries
+    if last_success is not None:
+        channel.basic_ack(delivery_tag=last_success, multiple=True)
+    logger.info(f"Batch of {len(batch)} messages: {acked} acknowledged, {failed} failed.")
+
 
-    # Initialize RabbitMQ connection
-    logger.info("Connecting to RabbitMQ...")
-    connection, channel = connect_rabbitmq()   
+def consume_batches(channel, queue, sender):
+    """
+    Pulls deliveries into micro-batches flushed every NOTIFY_BATCH_SIZE messages or NOTIFY_FLUSH_INTERVAL seconds.
+    """
+    channel.basic_qos(prefetch_count=NOTIFY_BATCH_SIZE)
+    batch = []
+    started = None
+    for method, properties, body in channel.consume(queue, inactivity_timeout=NOTIFY_FLUSH_INTERVAL):
+        if method is not None:
+            if not batch:
+                started = time.monotonic()
+            batch.append((method, properties, body))
+        if batch and (
+            method is None
+            or len(batch) >= NOTIFY_BATCH_SIZE
+            or time.monotonic() - started >= NOTIFY_FLUSH_INTERVAL
+        ):
+            send_batch(channel, queue, batch, sender)
+            batch = []
 
 
+def close_connection(connection):
+    """
+    Closes a connection left over from a failed attempt, so reconnecting does not leak its socket.
+    """
     try:
-        channel.queue_declare(queue=mp3_queue, durable=True)
-        logger.info(f"Connected to RabbitMQ. Waiting for messages on queue: {mp3_queue}")
-
-        def callback(ch, method, properties, body):
-            try:
-                logger.info(f"Received message: {body}")
-                err = email.notification(body)
-                if err:
-                    logger.error(f"Failed to process message: {err}")
-                    ch.basic_nack(delivery_tag=method.delivery_tag)
-                else:
-                    logger.info("Message processed successfully. Acknowledging message.")
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
-            except Exception as e:
-                logger.error(f"Error in message callback: {e}", exc_info=True)
-                ch.basic_nack(delivery_tag=method.delivery_tag)
-
-        channel.basic_consume(queue=mp3_queue, on_message_callback=callback)
-        channel.start_consuming()
-
-    except pika.exceptions.AMQPConnectionError as e:
-        logger.error(f"RabbitMQ connection error: {e}")
-        time.sleep(5)  # Retry delay
-        main()  # Retry connection
-    except KeyboardInterrupt:
-        logger.info("Interrupted by user. Shutting down.")
-        sys.exit(0)
+        if connection.is_open:
+            connection.close()
     except Exception as e:
-        logger.error(f"Unhandled exception in consumer: {e}", exc_info=True)
-        sys.exit(1)
+        logger.warning(f"Failed to close RabbitMQ connection: {e}")
+
+
+def main():
+    mp3_queue = os.getenv("MP3_QUEUE", "mp3")
+
+    if CONSUMER_MODE == "async":
+        import async_consumer
+        try:
+            async_consumer.run(mp3_queue)
+        except KeyboardInterrupt:
+            logger.info("Interrupted by user. Shutting down.")
+        return
+
+    sender = email.get_sender()
+    while True:
+        # Initialize RabbitMQ connection
+        logger.info("Connecting to RabbitMQ...")
+        connection, channel = connect_rabbitmq()
+
+        try:
+            channel.queue_declare(queue=mp3_queue, durable=True)
+            retry.declare(channel, mp3_queue)
+            logger.info(f"Connected to RabbitMQ. Waiting for messages on queue: {mp3_queue}")
+
+            consume_batches(channel, mp3_queue, sender)
+
+        except pika.exceptions.AMQPConnectionError as e:
+            logger.error(f"RabbitMQ connection error: {e}")
+            close_connection(connection)
+            time.sleep(RABBITMQ_RETRY_DELAY)  # Reconnect on the next iteration
+        except KeyboardInterrupt:
+            logger.info("Interrupted by user. Shutting down.")
+            close_connection(connection)
+            sender.close()
+            sys.exit(0)
+        except Exception as e:
+            logger.error(f"Unhandled exception in consumer: {e}", exc_info=True)
+            sys.exit(1)
 
 
 if __name__ == "__main__":
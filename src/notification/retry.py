@@ -0,0 +1,108 @@
+import os
+import pika
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Delayed retry settings
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", 5))  # deliveries before a message is dead-lettered
+RETRY_BASE_DELAY_MS = int(os.getenv("RETRY_BASE_DELAY_MS", 5000))  # delay before the first retry, doubled per attempt
+RETRY_MAX_DELAY_MS = int(os.getenv("RETRY_MAX_DELAY_MS", 10 * 60 * 1000))
+
+ATTEMPT_HEADER = "x-attempt"
+ERROR_HEADER = "x-last-error"
+ORIGIN_HEADER = "x-original-queue"
+
+
+def retry_delay_ms(attempt):
+    return min(RETRY_MAX_DELAY_MS, RETRY_BASE_DELAY_MS * 2 ** (attempt - 1))
+
+
+def retry_queue_name(queue, attempt):
+    # The delay is part of the name because a queue's TTL cannot change once declared
+    return f"{queue}.retry.{retry_delay_ms(attempt)}ms"
+
+
+def dead_letter_queue_name(queue):
+    return f"{queue}.dlq"
+
+
+def retry_queue_arguments(queue, attempt):
+    return {
+        "x-message-ttl": retry_delay_ms(attempt),
+        "x-dead-letter-exchange": "",
+        "x-dead-letter-routing-key": queue,
+    }
+
+
+def declare(channel, queue):
+    """
+    Declares the delay queues and the dead-letter queue for `queue`.
+
+    Each delay queue holds messages for its TTL and then dead-letters them
+    through the default exchange back onto `queue`.
+    """
+    for attempt in range(1, RETRY_MAX_ATTEMPTS):
+        channel.queue_declare(
+            queue=retry_queue_name(queue, attempt),
+            durable=True,
+            arguments=retry_queue_arguments(queue, attempt),
+        )
+    channel.queue_declare(queue=dead_letter_queue_name(queue), durable=True)
+
+
+def attempts(properties):
+    headers = (properties.headers if properties else None) or {}
+    return int(headers.get(ATTEMPT_HEADER, 0))
+
+
+def route(headers, queue, reason):
+    """
+    Picks where a failed delivery goes next and the headers it carries there.
+
+    Returns (target, headers, attempt, dead).
+    """
+    headers = dict(headers or {})
+    attempt = int(headers.get(ATTEMPT_HEADER, 0)) + 1
+    headers.update({ATTEMPT_HEADER: attempt, ERROR_HEADER: str(reason)[:1000], ORIGIN_HEADER: queue})
+
+    dead = attempt >= RETRY_MAX_ATTEMPTS
+    target = dead_letter_queue_name(queue) if dead else retry_queue_name(queue, attempt)
+    return target, headers, attempt, dead
+
+
+def log_routed(target, attempt, dead, reason):
+    if dead:
+        logger.error(f"Message dead-lettered to {target} after {attempt} attempts: {reason}")
+    else:
+        logger.warning(f"Attempt {attempt} failed ({reason}); retrying via {target} in {retry_delay_ms(attempt)} ms")
+
+
+def handle_failure(channel, queue, delivery_tag, properties, body, reason):
+    """
+    Routes a failed delivery to its next delay queue, or to the DLQ after RETRY_MAX_ATTEMPTS.
+
+    The original delivery is acked once the copy is published, so a poison
+    message no longer loops straight back onto the queue. Returns True if the
+    message was dead-lettered.
+    """
+    target, headers, attempt, dead = route(properties.headers if properties else None, queue, reason)
+    try:
+        channel.basic_publish(
+            exchange="",
+            routing_key=target,
+            body=body,
+            properties=pika.BasicProperties(
+                delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE,
+                content_type=properties.content_type if properties else None,
+                headers=headers,
+            ),
+        )
+    except Exception as e:
+        logger.error(f"Failed to route message to {target}: {e}; requeueing", exc_info=True)
+        channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+        return False
+
+    channel.basic_ack(delivery_tag=delivery_tag)
+    log_routed(target, attempt, dead, reason)
+    return dead
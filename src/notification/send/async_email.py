@@ -0,0 +1,110 @@
+import asyncio
+import json
+import os
+import aiosmtplib
+from send.email import (
+    SMTP_HOST, SMTP_PORT, SMTP_STARTTLS, SMTP_AUTH, SMTP_TIMEOUT, SMTP_MAX_MESSAGES_PER_CONNECTION, build_message
+)
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# An SMTP session sends one message at a time, so this caps how many emails are actually on the wire
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", 20))
+
+
+class AsyncSMTPPool:
+    """
+    Up to SMTP_POOL_SIZE SMTP sessions shared by concurrent deliveries.
+
+    Sessions are opened on demand and reused. A session is replaced after
+    SMTP_MAX_MESSAGES_PER_CONNECTION messages, when the server drops it, or
+    when a send is cancelled halfway (e.g. by a per-message timeout).
+    """
+
+    def __init__(self, size=SMTP_POOL_SIZE, host=SMTP_HOST, port=SMTP_PORT, username=None, password=None):
+        self.host = host
+        self.port = port
+        self.username = username if username is not None else os.getenv("GMAIL_ADDRESS")
+        self.password = password if password is not None else os.getenv("GMAIL_PASSWORD")
+        self.sender_address = os.getenv("SMTP_FROM") or self.username or "noreply@localhost"
+        self._slots = asyncio.Semaphore(size)
+        self._idle = []  # (session, messages sent on it)
+
+    async def _connect(self):
+        logger.info(f"Opening SMTP session to {self.host}:{self.port}")
+        session = aiosmtplib.SMTP(hostname=self.host, port=self.port, timeout=SMTP_TIMEOUT, start_tls=SMTP_STARTTLS)
+        await session.connect()
+        try:
+            if SMTP_AUTH:
+                await session.login(self.username, self.password)
+        except BaseException:
+            session.close()
+            raise
+        return session
+
+    async def _acquire(self):
+        while self._idle:
+            session, sent = self._idle.pop()
+            if session.is_connected and sent < SMTP_MAX_MESSAGES_PER_CONNECTION:
+                return session, sent
+            await self._quit(session)
+        return await self._connect(), 0
+
+    async def _quit(self, session):
+        try:
+            await session.quit()
+        except Exception:
+            session.close()
+
+    async def send(self, msg):
+        async with self._slots:
+            session, sent = await self._acquire()
+            try:
+                try:
+                    await session.send_message(msg)
+                except aiosmtplib.SMTPServerDisconnected:
+                    # The server closed the session while it was idle; reconnect once and resend
+                    logger.warning("SMTP session dropped; reconnecting")
+                    session.close()
+                    session, sent = await self._connect(), 0
+                    await session.send_message(msg)
+            except BaseException:
+                # The session may be mid-transaction, so it is never handed out again
+                session.close()
+                raise
+            self._idle.append((session, sent + 1))
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for session, _ in idle:
+            await self._quit(session)
+
+
+async def notification(message, pool):
+    """
+    Async counterpart of send.email.notification; returns None on success or an error string.
+    """
+    try:
+        if SMTP_AUTH and (not pool.username or not pool.password):
+            logger.error("GMAIL_ADDRESS or GMAIL_PASSWORD not set in .env file.")
+            return "Email credentials not configured."
+
+        msg = build_message(message, pool.sender_address)
+
+        logger.info(f"Preparing to send email to {msg['To']}...")
+        await pool.send(msg)
+        logger.info("Email sent successfully.")
+        return None
+
+    except json.JSONDecodeError:
+        logger.error(f"Failed to decode message as JSON: {message}")
+        return "Invalid message format."
+    except aiosmtplib.SMTPException as e:
+        logger.error(f"SMTP error occurred: {e}", exc_info=True)
+        return str(e)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Unhandled exception in email notification: {e}", exc_info=True)
+        return str(e)
@@ -1,6 +1,8 @@
 import smtplib
 import os
 import json
+import time
+import threading
 from email.message import EmailMessage
 from dotenv import load_dotenv
 from logger import get_logger
@@ -11,32 +13,127 @@ load_dotenv()
 # Configure logging
 logger = get_logger(__name__)
 
-def notification(message):
-    try:
-        message = json.loads(message)
-        mp3_fid = message["audio_file_id"]  # Fixed key
-        username = message["username"]
-        email_address = message["email"]
+# SMTP settings; point SMTP_HOST/SMTP_PORT at a local debugging server with SMTP_STARTTLS=false and SMTP_AUTH=false
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "true").lower() == "true"
+SMTP_AUTH = os.getenv("SMTP_AUTH", "true").lower() == "true"
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", 30))  # seconds
+SMTP_MAX_MESSAGES_PER_CONNECTION = int(os.getenv("SMTP_MAX_MESSAGES_PER_CONNECTION", 100))
+SMTP_IDLE_TIMEOUT = float(os.getenv("SMTP_IDLE_TIMEOUT", 60))  # seconds before an idle session is re-checked
+
+
+class SMTPSender:
+    """
+    Keeps one authenticated SMTP session open and reuses it across messages.
+
+    The session is re-established when the server drops it, when it has been
+    idle for SMTP_IDLE_TIMEOUT and fails a NOOP, or after
+    SMTP_MAX_MESSAGES_PER_CONNECTION messages.
+    """
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, username=None, password=None):
+        self.host = host
+        self.port = port
+        self.username = username if username is not None else os.getenv("GMAIL_ADDRESS")
+        self.password = password if password is not None else os.getenv("GMAIL_PASSWORD")
+        self.sender_address = os.getenv("SMTP_FROM") or self.username or "noreply@localhost"
+        self._session = None
+        self._sent = 0
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        logger.info(f"Opening SMTP session to {self.host}:{self.port}")
+        session = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+        try:
+            if SMTP_STARTTLS:
+                session.starttls()
+            if SMTP_AUTH:
+                session.login(self.username, self.password)
+        except Exception:
+            session.close()
+            raise
+        self._session = session
+        self._sent = 0
+
+    def _ensure_session(self):
+        if self._session is not None and self._sent >= SMTP_MAX_MESSAGES_PER_CONNECTION:
+            self.close()
+        if self._session is not None and time.monotonic() - self._last_used > SMTP_IDLE_TIMEOUT:
+            try:
+                self._session.noop()
+            except (smtplib.SMTPException, OSError):
+                self._drop()
+        if self._session is None:
+            self._connect()
+
+    def _drop(self):
+        try:
+            self._session.close()
+        except Exception:
+            pass
+        self._session = None
+
+    def send(self, msg):
+        with self._lock:
+            self._ensure_session()
+            try:
+                self._session.send_message(msg)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                # The server closed the session between messages; reconnect once and resend
+                logger.warning("SMTP session dropped; reconnecting")
+                self._drop()
+                self._connect()
+                self._session.send_message(msg)
+            self._sent += 1
+            self._last_used = time.monotonic()
+
+    def close(self):
+        if self._session is None:
+            return
+        try:
+            self._session.quit()
+        except Exception:
+            pass
+        self._session = None
 
-        sender_address = os.getenv("GMAIL_ADDRESS")
-        sender_password = os.getenv("GMAIL_PASSWORD")
 
-        if not sender_address or not sender_password:
+_default_sender = None
+
+
+def get_sender():
+    global _default_sender
+    if _default_sender is None:
+        _default_sender = SMTPSender()
+    return _default_sender
+
+
+def build_message(message, sender_address):
+    message = json.loads(message)
+    mp3_fid = message["audio_file_id"]  # Fixed key
+    email_address = message["email"]
+
+    msg = EmailMessage()
+    msg.set_content(f"MP3 file with ID:  {mp3_fid}")
+    msg["Subject"] = "MP3 File Ready for Download"
+    msg["From"] = sender_address
+    msg["To"] = email_address
+    return msg
+
+
+def notification(message, sender=None):
+    try:
+        sender = sender or get_sender()
+        if SMTP_AUTH and (not sender.username or not sender.password):
             logger.error("GMAIL_ADDRESS or GMAIL_PASSWORD not set in .env file.")
             return "Email credentials not configured."
 
-        msg = EmailMessage()
-        msg.set_content(f"MP3 file with ID:  {mp3_fid}")
-        msg["Subject"] = "MP3 File Ready for Download"
-        msg["From"] = sender_address
-        msg["To"] = email_address
-
-        logger.info(f"Preparing to send email to {email_address}...")
-        with smtplib.SMTP("smtp.gmail.com", 587) as session:
-            session.starttls()
-            session.login(sender_address, sender_password)
-            session.send_message(msg)
-            logger.info("Email sent successfully.")
+        msg = build_message(message, sender.sender_address)
+
+        logger.info(f"Preparing to send email to {msg['To']}...")
+        sender.send(msg)
+        logger.info("Email sent successfully.")
         return None  # Indicate success
 
     except json.JSONDecodeError: